@@ -19,17 +19,19 @@
  ***************************************************************************/
 """
 import os
-from multiprocessing import cpu_count
+import re
 
 from qgis.PyQt.QtGui import QIcon
 from qgis.PyQt.QtCore import QCoreApplication
-from qgis.core import (QgsProcessing,
+from qgis.core import (QgsProcessing, QgsApplication,
                        QgsProcessingAlgorithm,
                        QgsProcessingParameterMultipleLayers,
                        QgsProcessingParameterRasterDestination, QgsProcessingParameterNumber,
-                       QgsProcessingParameterEnum, QgsProcessingParameterDefinition)
-
-from StackComposed.core import stack_composed
+                       QgsProcessingParameterEnum, QgsProcessingParameterDefinition,
+                       QgsProcessingParameterCrs, QgsProcessingParameterExtent,
+                       QgsProcessingParameterString, QgsProcessingParameterBoolean,
+                       QgsProcessingParameterFile, QgsProcessingParameterRange,
+                       QgsProcessingParameterFeatureSource)
 
 
 class StackComposedAlgorithm(QgsProcessingAlgorithm):
@@ -44,23 +46,66 @@ class StackComposedAlgorithm(QgsProcessingAlgorithm):
 
     INPUTS = 'INPUTS'
     STAT = 'STAT'
+    STAT_EXPRESSION = 'STAT_EXPRESSION'
     BAND = 'BAND'
+    BAND_EXPRESSION = 'BAND_EXPRESSION'
+    CUBE = 'CUBE'
     NODATA_INPUT = 'NODATA_INPUT'
     DATA_TYPE = 'DATA_TYPE'
     NUM_PROCESS = 'NUM_PROCESS'
     CHUNKS = 'CHUNKS'
+    WEIGHTS = 'WEIGHTS'
+    WEIGHT_BAND = 'WEIGHT_BAND'
+    APPROX_RANGE = 'APPROX_RANGE'
+    APPROX_BINS = 'APPROX_BINS'
+    PROGRESS_INTERVAL = 'PROGRESS_INTERVAL'
+    METADATA_CACHE = 'METADATA_CACHE'
+    CHUNK_CACHE_SIZE = 'CHUNK_CACHE_SIZE'
+    FILENAME_PATTERN = 'FILENAME_PATTERN'
+    DATES_FILE = 'DATES_FILE'
+    TARGET_CRS = 'TARGET_CRS'
+    TARGET_RES = 'TARGET_RES'
+    TARGET_EXTENT = 'TARGET_EXTENT'
+    AOI = 'AOI'
+    RESAMPLING = 'RESAMPLING'
+    TEMPORAL_GROUP = 'TEMPORAL_GROUP'
+    TEMPORAL_RANGES = 'TEMPORAL_RANGES'
+    DEDUPE = 'DEDUPE'
+    SOURCE_INDEX = 'SOURCE_INDEX'
     OUTPUT = 'OUTPUT'
+    ZARR_COG = 'ZARR_COG'
+    OUTPUT_STATISTICS = 'OUTPUT_STATISTICS'
+    OVERVIEWS = 'OVERVIEWS'
 
     STAT_KEYS = ['median', 'mean', 'gmean', 'max', 'min', 'std', 'valid_pixels', 'last_pixel', 'jday_last_pixel',
-                 'jday_median', 'linear_trend']
+                 'jday_median', 'linear_trend', 'harmonic', 'approx_median',
+                 'weighted_mean', 'weighted_median', 'custom']
     STAT_DESC = ['Median', 'Arithmetic mean', 'Geometric mean', 'Maximum value', 'Minimum value', 'Standard deviation',
                  'Number of valid pixels', 'Last valid pixel (required filename as metadata)',
                  'Julian day of the last valid pixel (required filename as metadata)',
                  'Julian day of the median value (required filename as metadata)',
-                 'Linear trend least-squares method (required filename as metadata)']
+                 'Linear trend least-squares method (required filename as metadata)',
+                 'Harmonic regression coefficients (required filename as metadata)',
+                 'Approximate median by histograms (for very deep stacks)',
+                 'Weighted mean (required the weights of the images and/or the weight band)',
+                 'Weighted median (required the weights of the images and/or the weight band)',
+                 'Custom statistic from a numpy expression']
 
     TYPES = ['Default', 'Byte', 'UInt16', 'Int16', 'UInt32', 'Int32', 'Float32', 'Float64']
 
+    RESAMPLING_KEYS = ['near', 'bilinear', 'cubic', 'average', 'mode']
+    RESAMPLING_DESC = ['Nearest neighbour', 'Bilinear', 'Cubic', 'Average', 'Mode']
+
+    TEMPORAL_GROUP_KEYS = [None, 'year', 'month', 'year_month', 'date_ranges', 'doy_windows']
+    TEMPORAL_GROUP_DESC = ['None (all images in one band)', 'By year', 'By month (across the years)',
+                           'By year and month', 'Custom date ranges', 'Day-of-year windows']
+
+    OVERVIEWS_KEYS = [None, 'nearest', 'average']
+    OVERVIEWS_DESC = ['None', 'Nearest neighbour', 'Average']
+
+    DEDUPE_KEYS = [None, 'drop', 'merge']
+    DEDUPE_DESC = ['None (all images)', 'Drop the duplicated scenes', 'Merge the scenes of the same date']
+
     def __init__(self):
         super().__init__()
 
@@ -87,6 +132,47 @@ class StackComposedAlgorithm(QgsProcessingAlgorithm):
         - To be in the same projection
         - Have the same pixel size
         - Have pixel registration
+        <p>For images with different pixel size or projection, set the target grid (CRS, pixel size and/or \
+        extent) in the advanced parameters to warp on the fly the images by chunks, without write the warped \
+        images to disk. Without a target pixel size it is the pixel size of the first image (in the target CRS). \
+        The images already in the target grid are not warped, and the target extent alone is a clip of the \
+        wrapper extent.</p>
+        <p>With an area of interest (polygons layer) the wrapper extent is restricted to the polygons, the \
+        chunks outside of them are not read and the pixels outside of the polygons are nodata.</p>
+        <p>The custom statistic is a numpy expression over the array <code>stack</code> with shape (y, x, t) \
+        and nan as nodata, reducing the t-axis, e.g. <code>np.nanmean(stack, axis=2) - np.nanstd(stack, axis=2)</code>, \
+        the arrays <code>date</code> and <code>jday</code> of the images are available (required filename as \
+        metadata). Only the numpy math functions and reducers are allowed.</p>
+        <p>The approximate median is computed streaming the images one at a time in histograms by pixel, \
+        with a memory independent of the number of images, the error is less than the width of the bins \
+        (range of values / number of bins, set in the advanced parameters).</p>
+        <p>The weighted statistics use the weights of the images, a list of numbers by image in the order of the \
+        inputs e.g. <code>1, 0.5, 0.8</code>, or a target date with an optional scale in days for weighting by the \
+        distance to the date e.g. <code>2020-01-15/30</code> (required filename as metadata), and/or a weight band by \
+        pixel in each image (e.g. a quality band).</p>
+        <p>For the median, min, max, percentiles and last pixel, a companion band with the index of the image \
+        (from 1, in the order of the inputs) that produced each pixel can be added in the same pass, the lookup \
+        table of the index to the images paths is saved in the metadata of the output.</p>
+        <p>Instead of the band, a band-math expression over the band numbers of the images can be composed, \
+        such as a spectral index e.g. NDVI for Landsat 8 <code>(b5 - b4) / (b5 + b4)</code>, evaluated by chunk \
+        after read all its bands in one read, without write the index images to disk.</p>
+        <p>With the time cubes input, all the bands of each input (a multi-band GeoTIFF by tile, or the time \
+        dimension of a netCDF/Zarr cube) are the layers of the stack, reading all the time steps of each chunk in \
+        one windowed read. The date of each band is taken from the time dimension, the band metadata or the band \
+        description.</p>
+        <p>The temporal groups compute the statistic for each group of images in one band (by year, month, \
+        custom date ranges e.g. <code>2019-06-01/2019-09-30, 2019-12-01/2020-03-31</code> or day-of-year windows \
+        e.g. <code>152-273, 335-59</code>) reading the stack only once, it required filename as metadata.</p>
+        <p>The duplicated scenes (same sensor, path, row and date parsed from the filename, or the same sensor, \
+        date and footprint without path and row, e.g. different processing versions) can be dropped keeping the first one in the order of the inputs, or all the scenes of \
+        the same date (the adjacent path/row) can be merged in one layer, taking each pixel from the first scene \
+        with valid data.</p>
+        <p>For an output with <code>.zarr</code> extension, the result is written to a chunked Zarr store where \
+        each chunk is computed and written by its own process in parallel, with the CRS and transform attached \
+        (required the zarr package), it can be converted to COG after the process.</p>
+        <p>The statistics (min, max, mean, std) and the histogram of the output bands are computed while they \
+        are written and saved in the output (band metadata and .aux.xml), then Qgis does not re-read the output for \
+        compute them. Optionally, the overviews of the GeoTIFF output are built from the result in memory.</p>
         <p>For the moment, the image formats support are: <code>tif</code>, <code>img</code> and <code>ENVI</code> (hdr)</p>
         '''
         return html_help
@@ -143,7 +229,7 @@ class StackComposedAlgorithm(QgsProcessingAlgorithm):
                 self.tr('All input raster files to process'),
                 QgsProcessing.TypeRaster,
             )
-        parameter_input.setMinimumNumberInputs(2)
+        parameter_input.setMinimumNumberInputs(1)
         self.addParameter(parameter_input)
 
         self.addParameter(
@@ -155,6 +241,35 @@ class StackComposedAlgorithm(QgsProcessingAlgorithm):
             )
         )
 
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.STAT_EXPRESSION,
+                self.tr('Numpy expression for the custom statistic'),
+                defaultValue=None,
+                optional=True
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.WEIGHTS,
+                self.tr('Weights of the images for the weighted statistics (list by image or target date)'),
+                defaultValue=None,
+                optional=True
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.WEIGHT_BAND,
+                self.tr('Weight band by pixel for the weighted statistics'),
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=1,
+                defaultValue=None,
+                optional=True
+            )
+        )
+
         self.addParameter(
             QgsProcessingParameterNumber(
                 self.BAND,
@@ -166,6 +281,25 @@ class StackComposedAlgorithm(QgsProcessingAlgorithm):
             )
         )
 
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.BAND_EXPRESSION,
+                self.tr('Band-math expression instead of the band, e.g. (b5 - b4) / (b5 + b4)'),
+                defaultValue=None,
+                optional=True
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.CUBE,
+                self.tr('Time cubes input: all the bands (or the time dimension of netCDF/Zarr) of each input are '
+                        'the layers of the stack'),
+                defaultValue=False,
+                optional=True
+            )
+        )
+
         self.addParameter(
             QgsProcessingParameterNumber(
                 self.NODATA_INPUT,
@@ -186,12 +320,62 @@ class StackComposedAlgorithm(QgsProcessingAlgorithm):
             )
         )
 
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.TEMPORAL_GROUP,
+                self.tr('Temporal groups, one band per group (required filename as metadata)'),
+                self.TEMPORAL_GROUP_DESC,
+                allowMultiple=False,
+                defaultValue=0,
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.TEMPORAL_RANGES,
+                self.tr('Custom date ranges or day-of-year windows for the temporal groups'),
+                defaultValue=None,
+                optional=True
+            )
+        )
+
+        parameter_dedupe = \
+            QgsProcessingParameterEnum(
+                self.DEDUPE,
+                self.tr('Deduplication of the scenes by sensor, path, row and date (required filename as metadata)'),
+                self.DEDUPE_DESC,
+                allowMultiple=False,
+                defaultValue=0,
+            )
+        parameter_dedupe.setFlags(parameter_dedupe.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(parameter_dedupe)
+
+        parameter_filename_pattern = \
+            QgsProcessingParameterString(
+                self.FILENAME_PATTERN,
+                self.tr('Regular expression for parse the date from the filename (named groups: date, or year '
+                        'and jday, or year, month and day)'),
+                defaultValue=None,
+                optional=True
+            )
+        parameter_filename_pattern.setFlags(parameter_filename_pattern.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(parameter_filename_pattern)
+
+        parameter_dates_file = \
+            QgsProcessingParameterFile(
+                self.DATES_FILE,
+                self.tr('Sidecar file with the date of the images (filename, YYYY-MM-DD by line)'),
+                optional=True
+            )
+        parameter_dates_file.setFlags(parameter_dates_file.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(parameter_dates_file)
+
         parameter_num_process = \
             QgsProcessingParameterNumber(
                 self.NUM_PROCESS,
                 self.tr('Set the number of process'),
                 type=QgsProcessingParameterNumber.Integer,
-                defaultValue=cpu_count(),
+                defaultValue=os.cpu_count(),
                 optional=True
             )
         parameter_num_process.setFlags(parameter_num_process.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
@@ -208,6 +392,114 @@ class StackComposedAlgorithm(QgsProcessingAlgorithm):
         parameter_chunks.setFlags(parameter_chunks.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
         self.addParameter(parameter_chunks)
 
+        parameter_approx_range = \
+            QgsProcessingParameterRange(
+                self.APPROX_RANGE,
+                self.tr('Range of values of the histograms for the approximate median'),
+                type=QgsProcessingParameterNumber.Double,
+                defaultValue=[0, 10000],
+                optional=True
+            )
+        parameter_approx_range.setFlags(parameter_approx_range.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(parameter_approx_range)
+
+        parameter_approx_bins = \
+            QgsProcessingParameterNumber(
+                self.APPROX_BINS,
+                self.tr('Number of bins of the histograms for the approximate median'),
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=1,
+                defaultValue=500,
+                optional=True
+            )
+        parameter_approx_bins.setFlags(parameter_approx_bins.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(parameter_approx_bins)
+
+        parameter_progress_interval = \
+            QgsProcessingParameterNumber(
+                self.PROGRESS_INTERVAL,
+                self.tr('Interval in seconds for report the rate and ETA of the process (0 for disable it)'),
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=0,
+                defaultValue=60,
+                optional=True
+            )
+        parameter_progress_interval.setFlags(parameter_progress_interval.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(parameter_progress_interval)
+
+        parameter_metadata_cache = \
+            QgsProcessingParameterBoolean(
+                self.METADATA_CACHE,
+                self.tr('Cache the images metadata across runs'),
+                defaultValue=True,
+                optional=True
+            )
+        parameter_metadata_cache.setFlags(parameter_metadata_cache.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(parameter_metadata_cache)
+
+        parameter_chunk_cache_size = \
+            QgsProcessingParameterNumber(
+                self.CHUNK_CACHE_SIZE,
+                self.tr('Size in GB of the local cache of the chunks read for repeated runs (0 for disable it)'),
+                type=QgsProcessingParameterNumber.Double,
+                minValue=0,
+                defaultValue=0,
+                optional=True
+            )
+        parameter_chunk_cache_size.setFlags(parameter_chunk_cache_size.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(parameter_chunk_cache_size)
+
+        parameter_target_crs = \
+            QgsProcessingParameterCrs(
+                self.TARGET_CRS,
+                self.tr('Target CRS for warping on the fly the images'),
+                optional=True
+            )
+        parameter_target_crs.setFlags(parameter_target_crs.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(parameter_target_crs)
+
+        parameter_target_res = \
+            QgsProcessingParameterNumber(
+                self.TARGET_RES,
+                self.tr('Target pixel size for warping on the fly the images'),
+                type=QgsProcessingParameterNumber.Double,
+                minValue=0,
+                defaultValue=None,
+                optional=True
+            )
+        parameter_target_res.setFlags(parameter_target_res.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(parameter_target_res)
+
+        parameter_target_extent = \
+            QgsProcessingParameterExtent(
+                self.TARGET_EXTENT,
+                self.tr('Target extent (clip of the wrapper extent)'),
+                optional=True
+            )
+        parameter_target_extent.setFlags(parameter_target_extent.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(parameter_target_extent)
+
+        parameter_aoi = \
+            QgsProcessingParameterFeatureSource(
+                self.AOI,
+                self.tr('Area of interest, compute only the pixels inside the polygons'),
+                [QgsProcessing.TypeVectorPolygon],
+                optional=True
+            )
+        parameter_aoi.setFlags(parameter_aoi.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(parameter_aoi)
+
+        parameter_resampling = \
+            QgsProcessingParameterEnum(
+                self.RESAMPLING,
+                self.tr('Resampling method for warping on the fly the images'),
+                self.RESAMPLING_DESC,
+                allowMultiple=False,
+                defaultValue=0,
+            )
+        parameter_resampling.setFlags(parameter_resampling.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(parameter_resampling)
+
         self.addParameter(
             QgsProcessingParameterRasterDestination(
                 self.OUTPUT,
@@ -215,25 +507,133 @@ class StackComposedAlgorithm(QgsProcessingAlgorithm):
             )
         )
 
+        parameter_source_index = \
+            QgsProcessingParameterBoolean(
+                self.SOURCE_INDEX,
+                self.tr('Add a band with the index of the image that produced each pixel (median, min, max, '
+                        'last pixel)'),
+                defaultValue=False,
+                optional=True
+            )
+        parameter_source_index.setFlags(parameter_source_index.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(parameter_source_index)
+
+        parameter_output_statistics = \
+            QgsProcessingParameterBoolean(
+                self.OUTPUT_STATISTICS,
+                self.tr('Save the statistics and histogram of the output bands computed while they are written'),
+                defaultValue=True,
+                optional=True
+            )
+        parameter_output_statistics.setFlags(parameter_output_statistics.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(parameter_output_statistics)
+
+        parameter_overviews = \
+            QgsProcessingParameterEnum(
+                self.OVERVIEWS,
+                self.tr('Build the overviews of the GeoTIFF output from the result in memory'),
+                self.OVERVIEWS_DESC,
+                allowMultiple=False,
+                defaultValue=0,
+            )
+        parameter_overviews.setFlags(parameter_overviews.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(parameter_overviews)
+
+        parameter_zarr_cog = \
+            QgsProcessingParameterBoolean(
+                self.ZARR_COG,
+                self.tr('Convert the Zarr output to COG (Cloud Optimized GeoTIFF) after the process'),
+                defaultValue=False,
+                optional=True
+            )
+        parameter_zarr_cog.setFlags(parameter_zarr_cog.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(parameter_zarr_cog)
+
+    @staticmethod
+    def layer_source(layer):
+        source = layer.source().split("|layername")[0]
+        # keep the gdal subdatasets sources, such as NETCDF:"cube.nc":ndvi or ZARR:"cube.zarr":/ndvi
+        if re.match(r'^[A-Z0-9_]{2,}:', source):
+            return source
+        return os.path.realpath(source)
+
     def processAlgorithm(self, parameters, context, feedback):
         """
         Here is where the processing itself takes place.
         """
+        # the engine (dask, numpy, gdal) is loaded only when the algorithm is
+        # run, not when the plugin is loaded by Qgis
+        from StackComposed.core import stack_composed
 
         layers = self.parameterAsLayerList(parameters, self.INPUTS, context)
-        images_files = [os.path.realpath(layer.source().split("|layername")[0]) for layer in layers]
+        images_files = [self.layer_source(layer) for layer in layers]
 
         output_file = self.parameterAsOutputLayer(parameters, self.OUTPUT, context)
 
+        # persistent cache of the images metadata in the Qgis settings directory
+        metadata_cache = None
+        if self.parameterAsBoolean(parameters, self.METADATA_CACHE, context):
+            metadata_cache = os.path.join(QgsApplication.qgisSettingsDirPath(), "StackComposed", "images_metadata.sqlite")
+
+        # local cache of the chunks stacks in the Qgis settings directory
+        chunk_cache = os.path.join(QgsApplication.qgisSettingsDirPath(), "StackComposed", "chunks_cache")
+        chunk_cache_size = self.parameterAsDouble(parameters, self.CHUNK_CACHE_SIZE, context) \
+            if parameters.get(self.CHUNK_CACHE_SIZE) is not None else 0
+
+        # target grid for warping on the fly the images
+        target_crs = self.parameterAsCrs(parameters, self.TARGET_CRS, context)
+        target_res = self.parameterAsDouble(parameters, self.TARGET_RES, context) \
+            if parameters.get(self.TARGET_RES) is not None else None
+        target_extent = None
+        if parameters.get(self.TARGET_EXTENT) is not None:
+            extent = self.parameterAsExtent(parameters, self.TARGET_EXTENT, context,
+                                            target_crs if target_crs.isValid() else layers[0].crs())
+            if not extent.isNull():
+                target_extent = [extent.xMinimum(), extent.yMaximum(), extent.xMaximum(), extent.yMinimum()]
+
+        # area of interest, the features of the vector layer (or only the selected features)
+        aoi_source = self.parameterAsSource(parameters, self.AOI, context)
+        aoi = None
+        if aoi_source is not None:
+            # the geometries (WKB) and the CRS of the features
+            aoi = ([feature.geometry().asWkb() for feature in aoi_source.getFeatures() if feature.hasGeometry()],
+                   aoi_source.sourceCrs().toWkt())
+
         stack_composed.run(
             stat=self.STAT_KEYS[self.parameterAsEnum(parameters, self.STAT, context)],
+            stat_expression=self.parameterAsString(parameters, self.STAT_EXPRESSION, context),
+            weights=self.parameterAsString(parameters, self.WEIGHTS, context) or None,
+            weight_band=self.parameterAsInt(parameters, self.WEIGHT_BAND, context)
+            if parameters.get(self.WEIGHT_BAND) is not None else None,
             band=self.parameterAsInt(parameters, self.BAND, context),
+            band_expression=self.parameterAsString(parameters, self.BAND_EXPRESSION, context) or None,
+            cube=self.parameterAsBoolean(parameters, self.CUBE, context),
             nodata=self.parameterAsInt(parameters, self.NODATA_INPUT, context),
             output= output_file,
+            zarr_cog=self.parameterAsBoolean(parameters, self.ZARR_COG, context),
+            output_statistics=self.parameterAsBoolean(parameters, self.OUTPUT_STATISTICS, context),
+            overviews=self.OVERVIEWS_KEYS[self.parameterAsEnum(parameters, self.OVERVIEWS, context)],
+            source_index=self.parameterAsBoolean(parameters, self.SOURCE_INDEX, context),
             output_type=self.TYPES[self.parameterAsEnum(parameters, self.DATA_TYPE, context)],
             num_process=self.parameterAsInt(parameters, self.NUM_PROCESS, context),
             chunksize=self.parameterAsInt(parameters, self.CHUNKS, context),
+            progress_interval=self.parameterAsInt(parameters, self.PROGRESS_INTERVAL, context),
+            approx_range=self.parameterAsRange(parameters, self.APPROX_RANGE, context) or None,
+            approx_bins=self.parameterAsInt(parameters, self.APPROX_BINS, context) or None,
+            metadata_cache=metadata_cache,
+            chunk_cache=chunk_cache,
+            chunk_cache_size=chunk_cache_size,
+            filename_pattern=self.parameterAsString(parameters, self.FILENAME_PATTERN, context) or None,
+            dates_file=self.parameterAsFile(parameters, self.DATES_FILE, context) or None,
             images_files=images_files,
-            feedback=feedback)
+            feedback=feedback,
+            target_crs=target_crs.toWkt() if target_crs.isValid() else None,
+            target_res=target_res,
+            target_extent=target_extent,
+            aoi=aoi,
+            resampling=self.RESAMPLING_KEYS[self.parameterAsEnum(parameters, self.RESAMPLING, context)],
+            temporal_group=self.TEMPORAL_GROUP_KEYS[self.parameterAsEnum(parameters, self.TEMPORAL_GROUP, context)],
+            temporal_ranges=self.parameterAsString(parameters, self.TEMPORAL_RANGES, context),
+            dedupe=self.DEDUPE_KEYS[self.parameterAsEnum(parameters, self.DEDUPE, context)])
 
         return {self.OUTPUT: output_file}
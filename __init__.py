@@ -20,12 +20,13 @@
 """
 import os
 import site
-import pkg_resources
 
 
 def pre_init_plugin():
     extra_libs_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "extlibs"))
     if os.path.isdir(extra_libs_path):
+        # pkg_resources is slow to import, only when it is needed
+        import pkg_resources
         # add to python path
         site.addsitedir(extra_libs_path)
         # pkg_resources doesn't listen to changes on sys.path.
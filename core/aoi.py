@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ StackComposed
+                          A QGIS plugin processing
+ Compute and generate the composed of a raster images stack
+                              -------------------
+        copyright            : (C) 2021-2022 by Xavier Corredor Llano, SMByC
+        email                : xavier.corredor.llano@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from osgeo import gdal, ogr, osr
+
+from StackComposed.core.image import Image
+
+
+class AreaOfInterest:
+    """
+    Area of interest from the polygons (the features of a Qgis layer), reprojected
+    to the projection of the wrapper, for restrict the wrapper extent, skip the
+    chunks outside of the polygons and mask the pixels outside of them
+    """
+
+    def __init__(self, geometries, crs, projection):
+        # the geometries as WKB in the CRS (WKT) of the layer
+        dst_srs = osr.SpatialReference()
+        dst_srs.ImportFromWkt(projection)
+        dst_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+        # all polygons (and the parts of the multipolygons) in one multipolygon
+        polygons = ogr.Geometry(ogr.wkbMultiPolygon)
+        for wkb in geometries:
+            geometry = ogr.CreateGeometryFromWkb(bytes(wkb))
+            if geometry is None or geometry.IsEmpty():
+                continue
+            geometry.FlattenTo2D()
+            geometry = ogr.ForceTo(geometry, ogr.wkbMultiPolygon)
+            for part in range(geometry.GetGeometryCount()):
+                polygons.AddGeometry(geometry.GetGeometryRef(part))
+        if polygons.IsEmpty():
+            raise ValueError("the area of interest does not have polygons")
+
+        if crs:
+            src_srs = osr.SpatialReference()
+            src_srs.ImportFromWkt(crs)
+            if not src_srs.IsSame(dst_srs):
+                src_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+                polygons.Transform(osr.CoordinateTransformation(src_srs, dst_srs))
+        # the union of all polygons at once in the projection of the wrapper
+        geometry = polygons.UnionCascaded()
+
+        self.projection = dst_srs.ExportToWkt()
+        # the geometry is kept as WKB for rasterize it in each thread
+        self.wkb = geometry.ExportToWkb()
+        min_x, max_x, min_y, max_y = geometry.GetEnvelope()
+        self.extent = [min_x, max_y, max_x, min_y]
+
+    def rasterize(self, geotransform, x_size, y_size, all_touched=False):
+        """
+        Rasterize the area of interest in the grid, return the mask (y, x)
+        of the pixels inside the polygons
+        """
+        raster = gdal.GetDriverByName("MEM").Create("", x_size, y_size, 1, gdal.GDT_Byte)
+        raster.SetGeoTransform(geotransform)
+        raster.SetProjection(self.projection)
+        vector = ogr.GetDriverByName("Memory").CreateDataSource("")
+        layer = vector.CreateLayer("aoi", geom_type=ogr.wkbMultiPolygon)
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetGeometry(ogr.CreateGeometryFromWkb(self.wkb))
+        layer.CreateFeature(feature)
+        gdal.RasterizeLayer(raster, [1], layer, burn_values=[1],
+                            options=["ALL_TOUCHED=TRUE"] if all_touched else [])
+        mask = raster.GetRasterBand(1).ReadAsArray().astype(bool)
+        del raster, vector, layer, feature
+        return mask
+
+    def chunks_mask(self, y_chunks, x_chunks):
+        """
+        The mask (y, x) of the chunks that touch the area of interest, from
+        the polygons rasterized in the grid of the chunks
+        """
+        min_x, max_y = Image.wrapper_extent[0], Image.wrapper_extent[1]
+        # the grid with one pixel by chunk, all chunks have the same size except the last ones
+        geotransform = (min_x, x_chunks[0] * Image.wrapper_x_res, 0, max_y, 0, -y_chunks[0] * Image.wrapper_y_res)
+        return self.rasterize(geotransform, len(x_chunks), len(y_chunks), all_touched=True)
+
+    def window_mask(self, xc, xc_size, yc, yc_size):
+        """
+        The mask (y, x) of the pixels of the chunk inside the area of interest
+        """
+        geotransform = (Image.wrapper_extent[0] + xc * Image.wrapper_x_res, Image.wrapper_x_res, 0,
+                        Image.wrapper_extent[1] - yc * Image.wrapper_y_res, 0, -Image.wrapper_y_res)
+        return self.rasterize(geotransform, xc_size, yc_size)
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ StackComposed
+                          A QGIS plugin processing
+ Compute and generate the composed of a raster images stack
+                              -------------------
+        copyright            : (C) 2021-2022 by Xavier Corredor Llano, SMByC
+        email                : xavier.corredor.llano@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import ast
+import re
+import numpy as np
+
+# the names of the bands in the expressions: b1, b2, ...
+BAND_NAME = re.compile(r"^b(\d+)$")
+
+
+# the numpy names allowed in the expressions: the reducers along an axis, the
+# element-wise functions (ufuncs), the constants and the data types, without the
+# functions of input/output (e.g. np.save, np.load, np.fromfile) or submodules
+NUMPY_NAMES = frozenset([
+    # reducers
+    "nanmean", "nanmedian", "nanstd", "nanvar", "nanmin", "nanmax", "nansum", "nanprod", "nanpercentile",
+    "nanquantile", "nanargmin", "nanargmax", "nancumsum", "nancumprod", "mean", "median", "std", "var", "min",
+    "max", "amin", "amax", "sum", "prod", "percentile", "quantile", "argmin", "argmax", "average", "ptp",
+    "count_nonzero", "any", "all", "cumsum", "cumprod", "diff", "sort", "argsort", "take_along_axis",
+    # element-wise functions
+    "abs", "absolute", "sqrt", "square", "power", "exp", "exp2", "expm1", "log", "log2", "log10", "log1p", "sin",
+    "cos", "tan", "arcsin", "arccos", "arctan", "arctan2", "hypot", "sinh", "cosh", "tanh", "deg2rad", "rad2deg",
+    "floor", "ceil", "round", "rint", "trunc", "sign", "clip", "minimum", "maximum", "fmin", "fmax", "add",
+    "subtract", "multiply", "divide", "true_divide", "floor_divide", "mod", "fmod", "isnan", "isfinite", "isinf",
+    "isclose", "where", "select", "logical_and", "logical_or", "logical_not", "logical_xor", "nan_to_num",
+    "full_like", "zeros_like", "ones_like", "expand_dims", "stack", "concatenate",
+    # constants and data types
+    "nan", "inf", "pi", "e", "newaxis", "float32", "float64", "int16", "int32", "int64", "uint8", "uint16",
+    "bool_",
+])
+
+# the attributes allowed of the arrays (and the numpy functions), without the
+# input/output methods (e.g. tofile, dump)
+ARRAY_ATTRIBUTES = frozenset([
+    "shape", "ndim", "size", "dtype", "T", "astype", "mean", "sum", "prod", "min", "max", "std", "var", "any",
+    "all", "argmin", "argmax", "cumsum", "cumprod", "clip", "round", "reshape", "copy", "reduce", "accumulate",
+])
+
+
+def parse_expression(expression, valid_name, kind, names_help):
+    """
+    Parse the numpy expression (eval mode) allowing only the valid names
+    (valid_name(name) is True), the numpy names of NUMPY_NAMES as np.<name>
+    and the array attributes of ARRAY_ATTRIBUTES, return the syntax tree
+    """
+    tree = ast.parse(expression, "<{}>".format(kind), "eval")
+    nodes = list(ast.walk(tree))
+    # the 'np' names used as np.<name>
+    numpy_nodes = set()
+    for node in nodes:
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == "np":
+            if node.attr not in NUMPY_NAMES:
+                raise ValueError("the numpy name 'np.{}' is not allowed in the {}".format(node.attr, kind))
+            numpy_nodes.add(node)
+            numpy_nodes.add(node.value)
+    for node in nodes:
+        if node in numpy_nodes:
+            continue
+        if isinstance(node, ast.Name) and node.id == "np":
+            raise ValueError("the name 'np' is only allowed as np.<function> in the {}".format(kind))
+        if isinstance(node, ast.Name) and not valid_name(node.id):
+            raise ValueError("invalid name '{}' in the {}, use {}".format(node.id, kind, names_help))
+        if isinstance(node, ast.Attribute) and node.attr not in ARRAY_ATTRIBUTES:
+            raise ValueError("invalid attribute '{}' in the {}".format(node.attr, kind))
+    return tree
+
+
+class BandExpression:
+    """
+    Band-math expression over the band numbers of the image (b1, b2, ...),
+    such as a spectral index, evaluated per chunk after read all the bands
+    required in one read, with the 'np' name available and nan as nodata
+
+    Examples:
+        (b5 - b4) / (b5 + b4)
+        np.where(b3 > 0, b4 / b3, np.nan)
+    """
+
+    def __init__(self, expression):
+        self.expression = expression.strip()
+        # only the bands and the allowed numpy names and array attributes
+        tree = parse_expression(self.expression, BAND_NAME.match, "band expression", "b1, b2, ... and np")
+        self.bands = sorted({int(BAND_NAME.match(node.id).group(1)) for node in ast.walk(tree)
+                             if isinstance(node, ast.Name) and node.id != "np"})
+        if not self.bands or self.bands[0] < 1:
+            raise ValueError("the band expression must use the bands of the images: b1, b2, ...")
+        self.code = compile(tree, "<band expression>", "eval")
+
+    def __str__(self):
+        return self.expression
+
+    def evaluate(self, bands_chunks):
+        """
+        Evaluate the expression with the chunks (y, x) of the bands by band
+        number, the invalid results (e.g. division by zero) are nan
+        """
+        namespace = {"np": np}
+        namespace.update({"b{}".format(band): bands_chunks[band] for band in self.bands})
+        with np.errstate(divide="ignore", invalid="ignore"):
+            result = np.array(eval(self.code, {"__builtins__": {}}, namespace), dtype=np.float32)
+        result[~np.isfinite(result)] = np.nan
+        return result
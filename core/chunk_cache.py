@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ StackComposed
+                          A QGIS plugin processing
+ Compute and generate the composed of a raster images stack
+                              -------------------
+        copyright            : (C) 2021-2022 by Xavier Corredor Llano, SMByC
+        email                : xavier.corredor.llano@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import hashlib
+import os
+import threading
+import time
+import numpy as np
+
+from StackComposed.core.image import Image
+
+
+class ChunkCache:
+    """
+    Local cache on disk of the stacks of the chunks (y, x, t) read from the
+    images, for the repeated runs over the same inputs with other statistic
+    or parameters. The stacks are saved compressed and keyed by the inputs
+    (files, modification time and size, layers, nodata and the wrapper grid)
+    and the window of the chunk, the least recently used stacks are deleted
+    when the size of the cache exceeds the maximum size (bytes)
+    """
+
+    def __init__(self, cache_dir, max_size, inputs_key):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.inputs_key = inputs_key
+        os.makedirs(cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        # delete the temporary files left by the interrupted runs, older than this run
+        start_time = time.time()
+        for entry in os.scandir(cache_dir):
+            if entry.is_file() and entry.name.endswith(".tmp.npz") and entry.stat().st_mtime < start_time:
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+        self._size = sum(entry.stat().st_size for entry in os.scandir(cache_dir)
+                         if entry.is_file() and entry.name.endswith(".npz") and ".tmp." not in entry.name)
+        if self._size > self.max_size:
+            self.evict()
+
+    @staticmethod
+    def make_inputs_key(images, resampling=None):
+        """
+        The key of the inputs of the run: the images with the layers and the
+        nodata, the nodata from the arguments and the wrapper grid
+        """
+        inputs = []
+        for image in images:
+            # the files of the image, or all the files of the merged scenes
+            inputs.append((image.get_file_keys(), [str(layer) for layer in image.layers], image.nodata,
+                           image.warped))
+        inputs.append((Image.nodata_from_arg, Image.projection, Image.wrapper_extent, Image.wrapper_x_res,
+                       Image.wrapper_y_res, Image.wrapper_shape, resampling))
+        return hashlib.sha1(repr(inputs).encode()).hexdigest()
+
+    def get_path(self, window):
+        window_key = hashlib.sha1(repr((self.inputs_key, window)).encode()).hexdigest()
+        return os.path.join(self.cache_dir, window_key + ".npz")
+
+    def get(self, window):
+        """
+        Get the stack of the chunk window cached, None if it is not cached
+        """
+        path = self.get_path(window)
+        try:
+            with np.load(path) as cached:
+                stack = cached["stack"]
+            # the access time for the least recently used eviction
+            os.utime(path)
+        except (OSError, KeyError, ValueError):
+            return None
+        return stack
+
+    def put(self, window, stack):
+        path = self.get_path(window)
+        # write to a temporary file and rename it for the concurrent workers, the
+        # stack is saved in its own data type, without loss
+        tmp_path = "{}.{}.tmp.npz".format(path[:-4], threading.get_ident())
+        np.savez_compressed(tmp_path, stack=stack)
+        with self._lock:
+            # the size of the stack replaced (cached by other worker or run) is not counted twice
+            old_size = os.path.getsize(path) if os.path.isfile(path) else 0
+            os.replace(tmp_path, path)
+            self._size += os.path.getsize(path) - old_size
+            if self._size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        """
+        Delete the least recently used stacks until the 90% of the maximum size
+        """
+        entries = sorted((entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                         for entry in os.scandir(self.cache_dir) if entry.is_file() and entry.name.endswith(".npz")
+                         and ".tmp." not in entry.name)
+        self._size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self._size <= 0.9 * self.max_size:
+                break
+            try:
+                os.remove(path)
+                self._size -= size
+            except OSError:
+                pass
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ StackComposed
+                          A QGIS plugin processing
+ Compute and generate the composed of a raster images stack
+                              -------------------
+        copyright            : (C) 2021-2022 by Xavier Corredor Llano, SMByC
+        email                : xavier.corredor.llano@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import numpy as np
+
+from StackComposed.core.image import Image
+
+
+class MergedImage(Image):
+    """
+    Virtual layer of the images of the same acquisition (the duplicated scenes
+    and the adjacent scenes of the same date), one layer along the z-axis of
+    the stack. The pixels are taken from the first image, in the order of the
+    inputs, with valid data in the pixel
+    """
+
+    def __init__(self, images):
+        self.images = images
+        base_image = images[0]
+        # the metadata of the base image with the extent that cover all images
+        metadata = {
+            "extent": [min(image.extent[0] for image in images), max(image.extent[1] for image in images),
+                       max(image.extent[2] for image in images), min(image.extent[3] for image in images)],
+            "x_res": base_image.x_res,
+            "y_res": base_image.y_res,
+            "n_bands": min(image.n_bands for image in images),
+            "data_types": base_image.data_types,
+            "nodata": base_image.nodata,
+            "projection": base_image.projection,
+            "filename_metadata": base_image.filename_metadata,
+            "datetime_tag": base_image.datetime_tag,
+            "band_dates": base_image.band_dates,
+            "time_units": base_image.time_units,
+        }
+        super().__init__(";".join(image.file_path for image in images), metadata)
+        self.warped = any(image.warped for image in images)
+        # the images are read by its own, not mapped as one file
+        self._memmap_available = False
+        self.layers = base_image.layers
+        self.layers_metadata = base_image.layers_metadata
+
+    def close(self):
+        [image.close() for image in self.images]
+
+    def get_file_keys(self):
+        return [file_key for image in self.images for file_key in image.get_file_keys()]
+
+    def set_bounds(self):
+        [image.set_bounds() for image in self.images]
+        super().set_bounds()
+
+    def covers(self, xc, xc_size, yc, yc_size):
+        return any(image.covers(xc, xc_size, yc, yc_size) for image in self.images)
+
+    def get_chunk_in_wrapper(self, bands, xc, xc_size, yc, yc_size):
+        """
+        Get the array (y, x, bands) of the bands adjusted into the wrapper matrix
+        for the respective chunk, filling the pixels without valid data (in the
+        first band) with the next images, the next images are not read when all
+        pixels are filled
+        """
+        chunk_matrix = None
+        for image in self.images:
+            if not image.intersects(xc, xc_size, yc, yc_size):
+                continue
+            image_chunk = image.get_chunk_in_wrapper(bands, xc, xc_size, yc, yc_size)
+            if chunk_matrix is None:
+                chunk_matrix = image_chunk
+            else:
+                missing = np.isnan(chunk_matrix[:, :, 0])
+                chunk_matrix[missing] = image_chunk[missing]
+            if not np.isnan(chunk_matrix[:, :, 0]).any():
+                break
+        if chunk_matrix is None:
+            # the chunk is inside the extent of the scenes but between them
+            return np.full((yc_size, xc_size, len(bands)), np.nan)
+        return chunk_matrix
+
+
+def dedupe_images(images, mode):
+    """
+    Detect the duplicated scenes, same (version, sensor, path, row, date) in the
+    filename metadata, or the same (version, sensor, date) and footprint for the
+    scenes without path and row (e.g. Sentinel-2), and drop them keeping the
+    first one in the order of the inputs ('drop'), or merge all the scenes of the same acquisition, same
+    (version, sensor, date) and grid, in one virtual layer ('merge'). The
+    images without the sensor or date parsed are kept. Return the images and
+    the position in the input images of the first image of each one
+    """
+    groups = {}
+    for position, image in enumerate(images):
+        metadata = image.filename_metadata
+        key = position
+        if metadata is not None and metadata[1] is not None and metadata[4] is not None:
+            version, sensor, path, row, date, _ = metadata
+            if mode == "drop" and path is not None and row is not None:
+                key = (version, sensor, path, row, date)
+            elif mode == "drop":
+                key = (version, sensor, date, image.projection, tuple(round(coord, 1) for coord in image.extent))
+            elif mode == "merge":
+                key = (version, sensor, date, image.projection, round(image.x_res, 1), round(image.y_res, 1))
+        groups.setdefault(key, []).append(position)
+
+    deduped_images = []
+    for positions in groups.values():
+        if len(positions) == 1 or mode == "drop":
+            deduped_images.append(images[positions[0]])
+        else:
+            deduped_images.append(MergedImage([images[position] for position in positions]))
+    return deduped_images, [positions[0] for positions in groups.values()]
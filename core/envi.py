@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ StackComposed
+                          A QGIS plugin processing
+ Compute and generate the composed of a raster images stack
+                              -------------------
+        copyright            : (C) 2021-2022 by Xavier Corredor Llano, SMByC
+        email                : xavier.corredor.llano@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import os
+import numpy as np
+
+# ENVI data types codes to numpy
+ENVI_DATA_TYPES = {1: np.uint8, 2: np.int16, 3: np.int32, 4: np.float32, 5: np.float64,
+                   12: np.uint16, 13: np.uint32, 14: np.int64, 15: np.uint64}
+
+
+def get_header_path(dataset_path):
+    """
+    Search the ENVI header file of the dataset, None if it is not an ENVI dataset
+    """
+    for header_path in [os.path.splitext(dataset_path)[0] + ".hdr", dataset_path + ".hdr",
+                        os.path.splitext(dataset_path)[0] + ".HDR", dataset_path + ".HDR"]:
+        if header_path != dataset_path and os.path.isfile(header_path):
+            return header_path
+
+
+def read_envi_header(header_path):
+    """
+    Read the ENVI header file as a dict with the keys in lowercase, the
+    values in braces can be in several lines
+    """
+    header = {}
+    with open(header_path, "r") as header_file:
+        lines = iter(header_file.read().splitlines())
+    if next(lines, "").strip() != "ENVI":
+        raise ValueError("the file is not an ENVI header: {}".format(header_path))
+    for line in lines:
+        if "=" not in line:
+            continue
+        key, value = [item.strip() for item in line.split("=", 1)]
+        if value.startswith("{"):
+            while not value.endswith("}"):
+                value += next(lines).strip()
+        header[key.lower()] = value
+    return header
+
+
+def envi_memmap(dataset_path):
+    """
+    Map the ENVI binary file directly in memory (zero-copy) using the
+    interleave, data type, byte order and offset of the header. Return the
+    array view with shape (bands, lines, samples), or None for the datasets
+    that are not uncompressed ENVI files
+    """
+    header_path = get_header_path(dataset_path)
+    if header_path is None:
+        return None
+    try:
+        header = read_envi_header(header_path)
+        if int(header.get("file compression", 0)) != 0:
+            return None
+        samples, lines, bands = int(header["samples"]), int(header["lines"]), int(header["bands"])
+        data_type = np.dtype(ENVI_DATA_TYPES[int(header["data type"])])
+        offset = int(header.get("header offset", 0))
+        interleave = header.get("interleave", "bsq").lower()
+    except (KeyError, ValueError, StopIteration):
+        return None
+    data_type = data_type.newbyteorder(">" if int(header.get("byte order", 0)) == 1 else "<")
+
+    if interleave == "bsq":
+        shape, axes = (bands, lines, samples), (0, 1, 2)
+    elif interleave == "bil":
+        shape, axes = (lines, bands, samples), (1, 0, 2)
+    elif interleave == "bip":
+        shape, axes = (lines, samples, bands), (2, 0, 1)
+    else:
+        return None
+
+    try:
+        if os.path.getsize(dataset_path) < offset + data_type.itemsize * samples * lines * bands:
+            return None
+        raw_data = np.memmap(dataset_path, dtype=data_type, mode="r", offset=offset, shape=shape)
+    except (OSError, ValueError):
+        # e.g. too many files opened or not enough address space, then it is read with gdal
+        return None
+    return raw_data.transpose(axes)
@@ -19,10 +19,13 @@
  ***************************************************************************/
 """
 import os
+import threading
 import numpy as np
 from osgeo import gdal
 
-from StackComposed.core.parse import parse_filename
+from StackComposed.core.band_math import BandExpression
+from StackComposed.core.envi import envi_memmap
+from StackComposed.core.parse import parse_filename, parse_band_date
 
 
 class Image:
@@ -36,11 +39,92 @@ class Image:
     # no data values from arguments
     nodata_from_arg = None
 
-    def __init__(self, file_path):
+    def __init__(self, file_path, metadata=None):
         self.file_path = self.get_dataset_path(file_path)
+        # the path used for read the data, it is different to the file path
+        # when the image is warped on the fly to the target grid
+        self.read_path = self.file_path
+        self.warped = False
+        # the in-memory source VRT of the warped image for its nodata, if it is required
+        self.source_path = None
+        # gdal datasets opened by thread for the warped images
+        self._datasets = {}
+        self._datasets_lock = threading.Lock()
+        # if the image is an uncompressed ENVI/raw file that can be memory-mapped (None if unknown)
+        self._memmap_available = None
+        # the metadata of the image (geoproperties, bands, nodata and the
+        # filename metadata), it can be get from the metadata cache
+        if metadata is None:
+            metadata = self.read_metadata(self.file_path)
         ### set geoproperties ###
-        # setting the extent, pixel sizes and projection
-        gdal_file = gdal.Open(self.file_path, gdal.GA_ReadOnly)
+        # extent and pixel sizes
+        self.extent = list(metadata["extent"])
+        self.x_res = metadata["x_res"]
+        self.y_res = metadata["y_res"]
+        # number of bands
+        self.n_bands = metadata["n_bands"]
+        # data type and no data value by band
+        self.data_types = metadata["data_types"]
+        self.nodata = metadata["nodata"]
+        # projection
+        self.projection = metadata["projection"]
+        if Image.projection is None:
+            Image.projection = self.projection
+        # metadata parsed from the filename, None if the filename cannot be parsed
+        self.filename_metadata = metadata["filename_metadata"]
+        self.datetime_tag = metadata.get("datetime_tag")
+        # the date of the bands for the time cubes and the time units (netCDF/Zarr)
+        self.band_dates = metadata.get("band_dates") or [None] * self.n_bands
+        self.time_units = metadata.get("time_units")
+        # the bands of the image used as layers along the z-axis of the stack,
+        # one band or all bands of the image for the time cubes
+        self.layers = None
+        self.layers_metadata = None
+        # output type
+        self.output_type = None
+
+    @staticmethod
+    def read_metadata(file_path):
+        """
+        Read the metadata of the image from the file
+        """
+        gdal_file = gdal.Open(file_path, gdal.GA_ReadOnly)
+        if gdal_file is None:
+            raise IOError("cannot open the image: {}".format(file_path))
+        min_x, x_res, x_skew, max_y, y_skew, y_res = gdal_file.GetGeoTransform()
+        max_x = min_x + (gdal_file.RasterXSize * x_res)
+        min_y = max_y + (gdal_file.RasterYSize * y_res)
+        bands = [gdal_file.GetRasterBand(band) for band in range(1, gdal_file.RasterCount + 1)]
+        try:
+            filename_metadata = parse_filename(file_path)
+        except Exception:
+            filename_metadata = None
+        # the acquisition date in the gdal metadata tags, fallback for the filename metadata
+        datetime_tag = gdal_file.GetMetadataItem("ACQUISITIONDATETIME", "IMAGERY") or \
+            gdal_file.GetMetadataItem("TIFFTAG_DATETIME")
+        # the date of each band for the time cubes, from the time dimension of
+        # netCDF/Zarr, the band metadata or the band description
+        band_dates = [band.GetMetadataItem("NETCDF_DIM_time") or band.GetMetadataItem("DIM_time_VALUE") or
+                      band.GetMetadataItem("DATE") or band.GetMetadataItem("ACQUISITIONDATETIME") or
+                      band.GetDescription() or None for band in bands]
+        metadata = {
+            "extent": [min_x, max_y, max_x, min_y],
+            "x_res": abs(float(x_res)),
+            "y_res": abs(float(y_res)),
+            "n_bands": gdal_file.RasterCount,
+            "data_types": [gdal.GetDataTypeName(band.DataType) for band in bands],
+            "nodata": [band.GetNoDataValue() for band in bands],
+            "projection": gdal_file.GetProjectionRef(),
+            "filename_metadata": filename_metadata,
+            "datetime_tag": datetime_tag,
+            "band_dates": band_dates,
+            "time_units": gdal_file.GetMetadataItem("time#units"),
+        }
+        del gdal_file, bands
+        return metadata
+
+    def set_geoproperties(self, gdal_file):
+        # setting the extent and pixel sizes
         min_x, x_res, x_skew, max_y, y_skew, y_res = gdal_file.GetGeoTransform()
         max_x = min_x + (gdal_file.RasterXSize * x_res)
         min_y = max_y + (gdal_file.RasterYSize * y_res)
@@ -49,14 +133,6 @@ class Image:
         # pixel sizes
         self.x_res = abs(float(x_res))
         self.y_res = abs(float(y_res))
-        # number of bands
-        self.n_bands = gdal_file.RasterCount
-        # projection
-        if Image.projection is None:
-            Image.projection = gdal_file.GetProjectionRef()
-        del gdal_file
-        # output type
-        self.output_type = None
 
     @staticmethod
     def get_dataset_path(file_path):
@@ -71,6 +147,98 @@ class Image:
         else:
             return file_path
 
+    def get_file_keys(self):
+        """
+        The files of the image with its modification time and size (None if
+        it is not a local file) for detect the changes of the inputs
+        """
+        dataset_path = Image.get_dataset_path(self.file_path)
+        file_key = None
+        if dataset_path is not None and os.path.isfile(dataset_path):
+            stat = os.stat(dataset_path)
+            file_key = (stat.st_mtime, stat.st_size)
+        return [(self.file_path, file_key)]
+
+    def warp(self, dst_projection, x_res=None, y_res=None, resampling="near"):
+        """
+        Set the image to be read through an in-memory warped VRT in the target
+        projection and resolution (x, y), the pixels are aligned to the target resolution.
+        The warped VRT is not written to disk and the data is warped by chunk
+        """
+        self.close()
+        gdal_file = gdal.Open(self.file_path, gdal.GA_ReadOnly)
+        # mask the source pixels before the resampling with the nodata of the file of
+        # each band and the numeric nodata from arguments, the warped output is float
+        # with nan as nodata (the nodata conditions are applied to the warped values)
+        nodata_arg = Image.nodata_from_arg if isinstance(Image.nodata_from_arg, (int, float)) else None
+        bands_nodata = [gdal_file.GetRasterBand(band).GetNoDataValue() for band in range(1, gdal_file.RasterCount + 1)]
+        if nodata_arg is None:
+            src_nodata = " ".join("nan" if nodata is None else str(nodata) for nodata in bands_nodata) \
+                if any(nodata is not None for nodata in bands_nodata) else None
+        else:
+            if any(nodata is not None and nodata != nodata_arg for nodata in bands_nodata):
+                # both values are masked: the nodata of the file is set to the nodata from
+                # arguments through an in-memory source VRT
+                self.source_path = "/vsimem/StackComposed/{}_{}.src.vrt".format(
+                    id(self), os.path.basename(self.file_path))
+                gdal_file = gdal.BuildVRT(
+                    self.source_path, gdal_file, VRTNodata=str(nodata_arg),
+                    srcNodata=" ".join(str(nodata_arg if nodata is None else nodata) for nodata in bands_nodata))
+            src_nodata = nodata_arg
+
+        self.read_path = "/vsimem/StackComposed/{}_{}.vrt".format(id(self), os.path.basename(self.file_path))
+        warp_options = dict(format="VRT", dstSRS=dst_projection, resampleAlg=resampling,
+                            srcNodata=src_nodata, dstNodata=np.nan,
+                            workingType=gdal.GDT_Float32, outputType=gdal.GDT_Float32)
+        if x_res is not None:
+            warp_options.update(xRes=x_res, yRes=y_res, targetAlignedPixels=True)
+        warped_file = gdal.Warp(self.read_path, gdal_file, **warp_options)
+        self.set_geoproperties(warped_file)
+        self.projection = warped_file.GetProjectionRef()
+        self.warped = True
+        del gdal_file, warped_file
+
+    def get_dataset(self):
+        """
+        Get the gdal dataset for read the image, the warped images keep one
+        dataset opened by thread to reuse the warp transformer across chunks
+        """
+        if not self.warped:
+            return gdal.Open(self.read_path, gdal.GA_ReadOnly)
+        thread_id = threading.get_ident()
+        with self._datasets_lock:
+            if thread_id not in self._datasets:
+                self._datasets[thread_id] = gdal.Open(self.read_path, gdal.GA_ReadOnly)
+            return self._datasets[thread_id]
+
+    def get_memmap(self):
+        """
+        Map in memory the data (bands, lines, samples) of the uncompressed
+        ENVI/raw images, None for the other formats, the warped images or the
+        files that cannot be mapped (read with gdal). The map is made by chunk
+        and released after copy the window, without keep a file descriptor
+        opened by image
+        """
+        if self.warped or self._memmap_available is False:
+            return None
+        raw_data = envi_memmap(self.file_path)
+        self._memmap_available = raw_data is not None
+        return raw_data
+
+    def close(self):
+        """
+        Release the datasets opened and the in-memory warped VRT
+        """
+        with self._datasets_lock:
+            self._datasets.clear()
+        if self.warped:
+            gdal.Unlink(self.read_path)
+            self.read_path = self.file_path
+            self.warped = False
+        if self.source_path is not None:
+            gdal.Unlink(self.source_path)
+            self.source_path = None
+
     def set_bounds(self):
         # bounds for image with respect to wrapper
         # the 0,0 is left-upper corner
@@ -79,24 +247,89 @@ class Image:
         self.yi_min = round((Image.wrapper_extent[1] - self.extent[1]) / Image.wrapper_y_res)
         self.yi_max = round(Image.wrapper_shape[0] - (self.extent[3] - Image.wrapper_extent[3]) / Image.wrapper_y_res)
 
+    def set_layers(self, band, cube=False):
+        """
+        Set the bands used as layers along the z-axis of the stack, the
+        specific band (or band-math expression) or all the bands (time
+        steps) for the time cubes
+        """
+        self.layers = list(range(1, self.n_bands + 1)) if cube else [band]
+
     def set_metadata_from_filename(self):
-        self.landsat_version, self.sensor, self.path, self.row, self.date, self.jday = parse_filename(self.file_path)
+        if self.filename_metadata is None:
+            # parse again for raise the error
+            self.filename_metadata = parse_filename(self.file_path)
+        self.landsat_version, self.sensor, self.path, self.row, self.date, self.jday = self.filename_metadata
+        self.layers_metadata = [self.filename_metadata]
 
-    def get_chunk(self, band, xoff, xsize, yoff, ysize):
+    def set_metadata_from_bands(self):
         """
-        Get the array of the band for the respective chunk
+        Set the metadata of each layer of the time cube with the date of the bands
         """
-        gdal_file = gdal.Open(self.file_path, gdal.GA_ReadOnly)
-        raster_band = gdal_file.GetRasterBand(band).ReadAsArray(xoff, yoff, xsize, ysize)
-        raster_band = raster_band.astype(np.float32)
+        self.layers_metadata = []
+        for band in self.layers:
+            try:
+                date = parse_band_date(self.band_dates[band - 1], self.time_units)
+            except (TypeError, ValueError) as err:
+                raise Exception("Cannot get the date of the band {} for: {}\n\n{}".format(band, self.file_path, err))
+            base_metadata = self.filename_metadata[0:4] if self.filename_metadata else (None, None, None, None)
+            self.layers_metadata.append(tuple(base_metadata) + (date, date.timetuple().tm_yday))
+
+    def intersects(self, xc, xc_size, yc, yc_size):
+        """
+        Check if the image has data inside the respective chunk of the wrapper
+        """
+        return not (xc >= self.xi_max or xc + xc_size <= self.xi_min or
+                    yc >= self.yi_max or yc + yc_size <= self.yi_min)
+
+    def covers(self, xc, xc_size, yc, yc_size):
+        """
+        Check if the image covers completely the respective chunk of the wrapper
+        """
+        return self.xi_min <= xc and xc + xc_size <= self.xi_max and \
+               self.yi_min <= yc and yc + yc_size <= self.yi_max
+
+    def get_chunk(self, bands, xoff, xsize, yoff, ysize):
+        """
+        Get the array (y, x, bands) of the bands for the respective chunk, all
+        bands are read in one windowed read. The bands can be band-math
+        expressions, evaluated after read its bands in the same read
+        """
+        layers = bands
+        bands = list(dict.fromkeys(band for layer in layers
+                                   for band in (layer.bands if isinstance(layer, BandExpression) else [layer])))
+        raw_data = self.get_memmap()
+        if raw_data is not None:
+            # read without gdal, the window of the contiguous bands is a view of the memory-mapped
+            # file (basic slicing), the data is copied when it is converted to float32 and the map
+            # is released
+            rows, cols = slice(yoff, yoff + ysize), slice(xoff, xoff + xsize)
+            if bands == list(range(bands[0], bands[0] + len(bands))):
+                raster_band = raw_data[bands[0] - 1:bands[-1], rows, cols]
+            else:
+                raster_band = np.stack([raw_data[band - 1, rows, cols] for band in bands])
+        else:
+            gdal_file = self.get_dataset()
+            if len(bands) == 1:
+                raster_band = gdal_file.GetRasterBand(bands[0]).ReadAsArray(xoff, yoff, xsize, ysize)[np.newaxis]
+            else:
+                raster_band = gdal_file.ReadAsArray(xoff, yoff, xsize, ysize, band_list=bands)
+            del gdal_file
+        raster_band = np.moveaxis(raster_band, 0, 2).astype(np.float32)
+        del raw_data
 
-        # convert the no data values from file to NaN
-        nodata_from_file = gdal_file.GetRasterBand(band).GetNoDataValue()
-        if nodata_from_file is not None:
-            raster_band[raster_band == nodata_from_file] = np.nan
+        # convert the no data values from file to NaN, the warped images have NaN as nodata
+        for layer, band in enumerate(bands):
+            nodata_from_file = None if self.warped else self.nodata[band - 1]
+            if nodata_from_file is not None:
+                layer_band = raster_band[:, :, layer]
+                layer_band[layer_band == nodata_from_file] = np.nan
+        nodata_from_file = None if self.warped else self.nodata[bands[0] - 1]
 
-        # convert the no data values set from arguments to NaN
-        if Image.nodata_from_arg is not None and Image.nodata_from_arg != nodata_from_file:
+        # convert the no data values set from arguments to NaN, the numeric value
+        # was masked in the source pixels of the warped images
+        if Image.nodata_from_arg is not None and Image.nodata_from_arg != nodata_from_file and \
+                not (self.warped and isinstance(Image.nodata_from_arg, (int, float))):
             if isinstance(Image.nodata_from_arg, (int, float)):
                 raster_band[raster_band == Image.nodata_from_arg] = np.nan
             else:
@@ -112,13 +345,17 @@ class Image:
                     elif condition[0] == "==":
                         raster_band[raster_band == condition[1]] = np.nan
 
-        del gdal_file
+        if layers != bands:
+            # evaluate the band-math expressions with the bands read (nan as nodata)
+            bands_chunks = {band: raster_band[:, :, idx] for idx, band in enumerate(bands)}
+            raster_band = np.stack([layer.evaluate(bands_chunks) if isinstance(layer, BandExpression)
+                                    else bands_chunks[layer] for layer in layers], axis=2)
 
         return raster_band
 
-    def get_chunk_in_wrapper(self, band, xc, xc_size, yc, yc_size):
+    def get_chunk_in_wrapper(self, bands, xc, xc_size, yc, yc_size):
         """
-        Get the array of the band adjusted into the wrapper matrix for the respective chunk
+        Get the array (y, x, bands) of the bands adjusted into the wrapper matrix for the respective chunk
         """
         # bounds for chunk with respect to wrapper
         # the 0,0 is left-upper corner
@@ -128,11 +365,11 @@ class Image:
         yc_max = yc+yc_size
 
         # check if the current chunk is outside of the image
-        if xc_min >= self.xi_max or xc_max <= self.xi_min or yc_min >= self.yi_max or yc_max <= self.yi_min:
+        if not self.intersects(xc, xc_size, yc, yc_size):
             return None
         else:
             # initialize the chunk with a nan matrix
-            chunk_matrix = np.full((yc_size, xc_size), np.nan)
+            chunk_matrix = np.full((yc_size, xc_size, len(bands)), np.nan)
 
             # set bounds for get the array chunk in image
             xoff = 0 if xc_min <= self.xi_min else xc_min - self.xi_min
@@ -153,7 +390,7 @@ class Image:
             y_max = y_min + ysize if y_min + ysize < yc_max else yc_max
 
             # fill with the chunk data of the image in the corresponding position
-            chunk_matrix[y_min:y_max, x_min:x_max] = self.get_chunk(band, xoff, xsize, yoff, ysize)
+            chunk_matrix[y_min:y_max, x_min:x_max] = self.get_chunk(bands, xoff, xsize, yoff, ysize)
 
             return chunk_matrix
 
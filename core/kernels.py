@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ StackComposed
+                          A QGIS plugin processing
+ Compute and generate the composed of a raster images stack
+                              -------------------
+        copyright            : (C) 2021-2022 by Xavier Corredor Llano, SMByC
+        email                : xavier.corredor.llano@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import numpy as np
+
+# the compiled backend is optional, without numba the kernels run in python
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# the target of the compiled kernels, 'cpu' because the chunks are already
+# processed in parallel by the dask threads
+KERNELS_TARGET = "cpu"
+
+
+def pixel_reducer(kernel, vectorized=None):
+    """
+    Make a reducer of the (y, x, t) stack chunk from a kernel for one pixel
+    written as a simple loop over the time series: kernel(values, dates, jdays)
+    returning a float, with nan as nodata in the values, the dates as days
+    since 1970-01-01 and the julian days of the layers (zeros if the
+    statistic does not require them). The kernel is compiled with numba
+    (guvectorize in nopython mode) if it is available, otherwise the
+    vectorized numpy reducer of the kernel, vectorized(stack_chunk, metadata)
+    with the same result, is used if it is given, else the kernel is called
+    for each pixel (e.g. the kernels of the users)
+    """
+    gufunc = None
+    if numba is not None:
+        pixel_kernel = numba.njit(kernel)
+
+        @numba.guvectorize(["void(float64[:], float64[:], float64[:], float64[:])"], "(t),(t),(t)->()",
+                           nopython=True, target=KERNELS_TARGET)
+        def gufunc(values, dates, jdays, result):
+            result[0] = pixel_kernel(values, dates, jdays)
+
+    def reducer(stack_chunk, metadata):
+        if gufunc is None and vectorized is not None:
+            return vectorized(stack_chunk, metadata)
+
+        depth = stack_chunk.shape[2]
+        dates = np.asarray(metadata["date"], dtype="datetime64[D]").astype(np.float64) \
+            if "date" in metadata else np.zeros(depth)
+        jdays = np.asarray(metadata["jday"], dtype=np.float64) if "jday" in metadata else np.zeros(depth)
+        stack_chunk = np.ascontiguousarray(stack_chunk, dtype=np.float64)
+
+        if gufunc is not None:
+            return gufunc(stack_chunk, dates, jdays)
+
+        result = np.empty(stack_chunk.shape[0:2])
+        for y, x in np.ndindex(result.shape):
+            result[y, x] = kernel(stack_chunk[y, x], dates, jdays)
+        return result
+
+    return reducer
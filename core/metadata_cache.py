@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ StackComposed
+                          A QGIS plugin processing
+ Compute and generate the composed of a raster images stack
+                              -------------------
+        copyright            : (C) 2021-2022 by Xavier Corredor Llano, SMByC
+        email                : xavier.corredor.llano@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import datetime
+import json
+import os
+import sqlite3
+
+from StackComposed.core.image import Image
+from StackComposed.utils.parallel import parallel_map
+
+
+class MetadataCache:
+    """
+    Persistent cache across runs of the images metadata (footprint, resolution,
+    bands, data types, nodata, projection and the filename metadata) in a
+    SQLite file, the entries are keyed by path and are valid while the
+    modification time and size of the file do not change
+    """
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+        with self.connect() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS images "
+                               "(path TEXT PRIMARY KEY, mtime REAL, size INTEGER, metadata TEXT)")
+
+    def connect(self):
+        return sqlite3.connect(self.cache_file, timeout=30)
+
+    @staticmethod
+    def file_key(file_path):
+        stat = os.stat(file_path)
+        return stat.st_mtime, stat.st_size
+
+    @staticmethod
+    def encode(metadata):
+        metadata = dict(metadata)
+        if metadata["filename_metadata"] is not None:
+            metadata["filename_metadata"] = list(metadata["filename_metadata"])
+            metadata["filename_metadata"][4] = metadata["filename_metadata"][4].isoformat()
+        return json.dumps(metadata)
+
+    @staticmethod
+    def decode(metadata):
+        metadata = json.loads(metadata)
+        if metadata["filename_metadata"] is not None:
+            metadata["filename_metadata"][4] = datetime.date.fromisoformat(metadata["filename_metadata"][4])
+            metadata["filename_metadata"] = tuple(metadata["filename_metadata"])
+        return metadata
+
+    def get(self, files_keys):
+        """
+        Get the valid metadata cached for the files, files_keys is a dict
+        of path -> (mtime, size)
+        """
+        cached = {}
+        paths = list(files_keys)
+        with self.connect() as connection:
+            # query by batches for the limit of variables in SQLite
+            for idx in range(0, len(paths), 500):
+                batch = paths[idx:idx + 500]
+                query = "SELECT path, mtime, size, metadata FROM images WHERE path IN ({})".format(
+                    ", ".join("?" * len(batch)))
+                for path, mtime, size, metadata in connection.execute(query, batch):
+                    if files_keys[path] == (mtime, size):
+                        cached[path] = self.decode(metadata)
+        return cached
+
+    def put(self, files_keys, files_metadata):
+        with self.connect() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO images (path, mtime, size, metadata) VALUES (?, ?, ?, ?)",
+                [(path,) + files_keys[path] + (self.encode(metadata),) for path, metadata in files_metadata.items()])
+
+
+def get_images_metadata(files_paths, cache_file=None, num_workers=None, feedback=None):
+    """
+    Get the metadata of all images, the images not cached (or modified) are
+    read in parallel and saved in the cache. Without cache file all images
+    are read in parallel. Return the metadata by image (None if it cannot be
+    read) and the errors by position of the image
+    """
+    files_paths = [Image.get_dataset_path(file_path) for file_path in files_paths]
+    unique_paths = list(dict.fromkeys(files_paths))
+    errors = {}
+
+    cache = MetadataCache(cache_file) if cache_file else None
+    files_metadata = {}
+    if cache is not None:
+        files_keys, _ = parallel_map(MetadataCache.file_key, unique_paths, num_workers)
+        files_keys = {path: key for path, key in zip(unique_paths, files_keys) if key is not None}
+        files_metadata = cache.get(files_keys)
+
+    missing = [file_path for file_path in unique_paths if file_path not in files_metadata]
+    if missing:
+        missing_metadata, missing_errors = parallel_map(Image.read_metadata, missing, num_workers, feedback)
+        missing_metadata = {path: metadata for path, metadata in zip(missing, missing_metadata) if metadata is not None}
+        missing_errors = {missing[idx]: err for idx, err in missing_errors.items()}
+        if cache is not None:
+            cache.put(files_keys, {path: metadata for path, metadata in missing_metadata.items() if path in files_keys})
+        files_metadata.update(missing_metadata)
+        errors = {idx: missing_errors[file_path] for idx, file_path in enumerate(files_paths)
+                  if file_path in missing_errors}
+
+    return [files_metadata.get(file_path) for file_path in files_paths], errors
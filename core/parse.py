@@ -20,101 +20,198 @@
 """
 import datetime
 import os
+import re
+
+import numpy as np
 
 
 def calc_date(year, jday):
     return (datetime.datetime(year, 1, 1) + datetime.timedelta(jday - 1)).date()
 
 
-#### LANDSAT PARSE FILENAME ####
-
-
-def parse_landsat_ID_oldFilename(file_path):
-    """
-    Parse the original structure of old Landsat filename
-
-    Examples:
-        LC80070592016320LGN00_band1.tif
+LANDSAT_SENSORS = {"E": "ETM", "O": "OLI", "C": "OLI", "T": "TM", "M": "MSS"}
+
+# precompiled patterns of the filenames supported, the named groups are:
+# version, sensor, path, row and the date as 'date' (with the format
+# of the pattern) or 'year' and 'jday'
+FILENAME_PATTERNS = [
+    # SMBYC structure of Landsat filename
+    #   Landsat_8_53_020601_7ETM_Reflec_SR_Enmask.tif
+    (re.compile(r"^LANDSAT_(?P<path>\d+)_(?P<row>\d+)_(?P<date>\d{6})_(?P<version>\d)(?P<sensor>[A-Z+]+)"), "%y%m%d"),
+    # new Landsat filename, collection 1 and 2
+    #   LC08_L1TP_007059_20161115_20170318_01_T2_b1.tif
+    #   LC09_L2SP_007059_20220315_20220317_02_T1_SR_B4.TIF
+    (re.compile(r"^L(?P<sensor>[EOCTM])(?P<version>\d{2})_\w{4}_(?P<path>\d{3})(?P<row>\d{3})_(?P<date>\d{8})_"),
+     "%Y%m%d"),
+    # old Landsat filename
+    #   LC80070592016320LGN00_band1.tif
+    (re.compile(r"^L(?P<sensor>[EOCTM])(?P<version>\d)(?P<path>\d{3})(?P<row>\d{3})(?P<year>\d{4})(?P<jday>\d{3})"), None),
+    # Sentinel-2 SAFE product, the path is the relative orbit and the row is the tile
+    #   S2A_MSIL2A_20190305T153621_N0211_R068_T18NVL_20190305T195312.SAFE
+    (re.compile(r"^(?P<version>S2[ABCD])_MSI(?P<sensor>L\w{2})_(?P<date>\d{8})T\d{6}_N\d{4}_R(?P<path>\d{3})_"
+                r"T(?P<row>\d{2}[A-Z]{3})_"), "%Y%m%d"),
+    # Sentinel-2 COG product
+    #   S2A_18NVL_20190305_0_L2A_B04.tif
+    (re.compile(r"^(?P<version>S2[ABCD])_(?P<row>\d{1,2}[A-Z]{3})_(?P<date>\d{8})_"), "%Y%m%d"),
+    # Sentinel-2 band of the granule
+    #   T18NVL_20190305T153621_B04_10m.jp2
+    (re.compile(r"^T(?P<row>\d{2}[A-Z]{3})_(?P<date>\d{8})T\d{6}"), "%Y%m%d"),
+]
+
+# the date formats of the gdal metadata tags
+DATETIME_TAG_FORMATS = ["%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S", "%Y:%m:%d %H:%M:%S", "%Y-%m-%d", "%Y%m%d"]
+
+
+def metadata_from_match(match, date_format):
     """
-    filename = os.path.basename(file_path).split("_")[0].split(".")[0]
-    filename = filename.upper()
-    if filename[1] == "E":
-        sensor = "ETM"
-    if filename[1] in ["O", "C"]:
-        sensor = "OLI"
-    if filename[1] == "T":
-        sensor = "TM"
-    landsat_version = int(filename[2])
-    path = int(filename[3:6])
-    row = int(filename[6:9])
-    year = int(filename[9:13])
-    jday = int(filename[13:16])
-    date = calc_date(year, jday)
-    return landsat_version, sensor, path, row, date, jday
-
-
-def parse_landsat_ID_newFilename(file_path):
+    Build the metadata (version, sensor, path, row, date, jday) from the
+    named groups matched in the filename
     """
-    Parse the original structure of new Landsat filename
-
-    Examples:
-        LC08_L1TP_007059_20161115_20170318_01_T2_b1.tif
-    """
-    filename = os.path.basename(file_path).split("_")[0:4]
-    filename = [i.upper() for i in filename]
-    if filename[0][1] == "E":
-        sensor = "ETM"
-    if filename[0][1] in ["O", "C"]:
-        sensor = "OLI"
-    if filename[0][1] == "T":
-        sensor = "TM"
-    landsat_version = int(filename[0][-1])
-    path = int(filename[2][0:3])
-    row = int(filename[2][3:6])
-    year = int(filename[3][0:4])
-    month = int(filename[3][4:6])
-    day = int(filename[3][6:8])
-    date = datetime.date(year, month, day)
+    fields = match.groupdict()
+    version = fields.get("version")
+    sensor = fields.get("sensor")
+    if version is not None and version.isdigit():
+        version = int(version)
+    if sensor is not None and len(sensor) == 1:
+        sensor = LANDSAT_SENSORS[sensor]
+    if version is not None and str(version).startswith("S2"):
+        sensor = "MSI"
+    path = int(fields["path"]) if fields.get("path") else None
+    row = fields.get("row")
+    row = int(row) if row and row.isdigit() else row
+
+    if fields.get("date"):
+        for fmt in ([date_format] if date_format else []) + ["%Y%m%d", "%Y-%m-%d", "%y%m%d"]:
+            try:
+                date = datetime.datetime.strptime(fields["date"], fmt).date()
+                break
+            except ValueError:
+                continue
+        else:
+            raise ValueError("cannot parse the date '{}'".format(fields["date"]))
+    elif fields.get("jday"):
+        date = calc_date(int(fields["year"]), int(fields["jday"]))
+    else:
+        date = datetime.date(int(fields["year"]), int(fields["month"]), int(fields["day"]))
     jday = date.timetuple().tm_yday
-    return landsat_version, sensor, path, row, date, jday
+    return version, sensor, path, row, date, jday
 
 
-#### SMBYC structure of Landsat filename
+def parse_datetime_tag(datetime_tag):
+    """
+    Parse the acquisition date from the gdal metadata tags (such as
+    ACQUISITIONDATETIME or TIFFTAG_DATETIME)
+    """
+    datetime_tag = datetime_tag.strip().rstrip("Z").split(".")[0]
+    for fmt in DATETIME_TAG_FORMATS:
+        try:
+            date = datetime.datetime.strptime(datetime_tag, fmt).date()
+            return None, None, None, None, date, date.timetuple().tm_yday
+        except ValueError:
+            continue
+    raise ValueError("cannot parse the date tag '{}'".format(datetime_tag))
 
 
-def parse_SMBYC_filename(file_path):
+def parse_band_date(band_date, time_units=None):
     """
-    Parse the SMBYC structure of Landsat filename
+    Parse the date of a band of a time cube, a date string or a numeric value
+    of the time dimension with the time units of netCDF/Zarr
 
     Examples:
-        Landsat_8_53_020601_7ETM_Reflec_SR_Enmask.tif
+        2019-03-05
+        17960 (days since 1970-01-01)
     """
-    filename = os.path.basename(file_path).split(".")[0]
-    path = int(filename.split("_")[1])
-    row = int(filename.split("_")[2])
-    date = datetime.datetime.strptime(filename.split("_")[3], "%y%m%d").date()
-    jday = date.timetuple().tm_yday
-    landsat_version = int(filename.split("_")[4][0])
-    sensor = filename.split("_")[4][1::]
-    return landsat_version, sensor, path, row, date, jday
-
+    band_date = str(band_date).strip()
+    if time_units and re.match(r"^-?[\d.]+$", band_date):
+        units, since = [item.strip() for item in time_units.split("since")]
+        since = datetime.datetime.strptime(since.split(" ")[0].split("T")[0], "%Y-%m-%d")
+        units = units.lower() if units.lower().endswith("s") else units.lower() + "s"
+        return (since + datetime.timedelta(**{units: float(band_date)})).date()
+    match = re.search(r"(\d{4})-?(\d{2})-?(\d{2})", band_date)
+    if match is None:
+        raise ValueError("the band date '{}' is not a valid date".format(band_date))
+    return datetime.date(*[int(item) for item in match.groups()])
+
+
+def read_dates_file(dates_file):
+    """
+    Read the sidecar file with the date of the images, one image by line with
+    the filename (or path) and the date (YYYY-MM-DD) separated by comma,
+    semicolon or spaces. Return a dict of filename -> date
 
-def parse_filename(file_path):
+    Examples:
+        LC08_L1TP_007059_20161115_20170318_01_T2_b1.tif, 2016-11-15
+    """
+    dates = {}
+    with open(dates_file, "r") as dates_lines:
+        for line in dates_lines:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            filename, date = [item for item in re.split(r"[,;\s]+", line) if item][0:2]
+            dates[os.path.basename(filename)] = datetime.datetime.strptime(date, "%Y-%m-%d").date()
+    return dates
+
+
+def parse_filename(file_path, pattern=None):
     """
-    Extract metadata from filename
+    Extract metadata from filename, using the user pattern (a regular
+    expression with named groups) if it is defined or the patterns supported
     """
     root, filename = os.path.split(file_path)
+    patterns = FILENAME_PATTERNS
+    if pattern is not None:
+        patterns = [(re.compile(pattern) if isinstance(pattern, str) else pattern, None)]
 
     try:
-        if filename.startswith("Landsat"):
-            # SMBYC format
-            return parse_SMBYC_filename(file_path)
-        elif filename[4] == "_":
-            # new ESPA filename
-            return parse_landsat_ID_newFilename(file_path)
-        else:
-            # old filename
-            return parse_landsat_ID_oldFilename(file_path)
+        for regex, date_format in patterns:
+            match = regex.search(filename) if pattern is not None else regex.match(filename.upper())
+            if match:
+                return metadata_from_match(match, date_format)
+        raise ValueError("the filename does not match with the structure of the filenames supported")
     except Exception as err:
         raise Exception("Cannot parse filename for: {}\n\n{}".format(file_path, err))
 
+
+def parse_filenames(files_paths, pattern=None, dates_file=None, datetime_tags=None):
+    """
+    Resolve the metadata for a whole list of files, in order: the date in
+    the sidecar dates file, the user pattern, the filename patterns supported
+    and the date in the gdal metadata tags. Return the metadata by file, None
+    for the files that cannot be resolved
+    """
+    if isinstance(pattern, str) and pattern:
+        pattern = re.compile(pattern)
+    dates = read_dates_file(dates_file) if dates_file else {}
+    datetime_tags = datetime_tags or [None] * len(files_paths)
+
+    files_metadata = []
+    for file_path, datetime_tag in zip(files_paths, datetime_tags):
+        metadata = None
+        date = dates.get(os.path.basename(file_path))
+        if date is not None:
+            metadata = None, None, None, None, date, date.timetuple().tm_yday
+        for patterns_args in ([pattern] if pattern else []) + [None]:
+            if metadata is not None:
+                break
+            try:
+                metadata = parse_filename(file_path, patterns_args)
+            except Exception:
+                pass
+        if metadata is None and datetime_tag:
+            try:
+                metadata = parse_datetime_tag(datetime_tag)
+            except ValueError:
+                pass
+        files_metadata.append(metadata)
+    return files_metadata
+
+
+def dates_arrays(files_metadata):
+    """
+    Compact numpy arrays of the dates (datetime64[D]) and julian days of the
+    metadata of the files, ready for the time-aware statistics
+    """
+    dates = np.array([metadata[4] for metadata in files_metadata], dtype="datetime64[D]")
+    jdays = np.array([metadata[5] for metadata in files_metadata], dtype=np.int16)
+    return dates, jdays
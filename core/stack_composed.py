@@ -18,43 +18,297 @@
  *                                                                         *
  ***************************************************************************/
 """
+import os
 import warnings
 import numpy as np
 from osgeo import gdal, osr
 
 from qgis.core import QgsProcessingException
 
+from StackComposed.core.aoi import AreaOfInterest
+from StackComposed.core.band_math import BandExpression
+from StackComposed.core.chunk_cache import ChunkCache
+from StackComposed.core.dedupe import dedupe_images
 from StackComposed.core.image import Image
-from StackComposed.core.stats import statistic
+from StackComposed.core.metadata_cache import get_images_metadata
+from StackComposed.core.parse import parse_filenames
+from StackComposed.core.stats import statistic, chunks_cost, Canceled, get_statistic, make_expression_statistic, approx_percentile, \
+    parse_weights, make_weights
+from StackComposed.core.temporal import make_groups
+from StackComposed.core.writers import write_gtiff, write_zarr, zarr_to_cog, is_zarr, NUMPY_TYPES
+from StackComposed.utils.parallel import parallel_map
+from StackComposed.utils.progress import ProgressBar
 
 
-def run(stat, band, nodata, output, output_type, num_process, chunksize, images_files, feedback):
+def report_errors(errors, max_errors=50):
+    """
+    Raise all the errors found together in one report
+    """
+    if not errors:
+        return
+    report = "\n".join("  - " + error for error in errors[:max_errors])
+    if len(errors) > max_errors:
+        report += "\n  ... and {} more errors".format(len(errors) - max_errors)
+    raise QgsProcessingException("\n\nError: {} problems found in the input images:\n{}\n".format(len(errors), report))
+
+
+def in_target_grid(image, target_srs=None, target_x_res=None, target_y_res=None):
+    """
+    Check if the image is in the projection and the pixel size (x, y) of the
+    target grid (None for any), then it is not required to warp it
+    """
+    if target_srs is not None:
+        image_srs = osr.SpatialReference()
+        image_srs.ImportFromWkt(image.projection)
+        if not image_srs.IsSame(target_srs):
+            return False
+    return target_x_res is None or (np.isclose(image.x_res, target_x_res) and np.isclose(image.y_res, target_y_res))
+
+
+def align_extent(extent, origin, x_res, y_res):
+    """
+    Align the extent [min_x, max_y, max_x, min_y] outward to the pixels of the
+    grid with the origin (x, y) and the pixel size
+    """
+    min_x, max_y, max_x, min_y = extent
+    return [origin[0] + np.floor((min_x - origin[0]) / x_res) * x_res,
+            origin[1] - np.floor((origin[1] - max_y) / y_res) * y_res,
+            origin[0] + np.ceil((max_x - origin[0]) / x_res) * x_res,
+            origin[1] - np.ceil((origin[1] - min_y) / y_res) * y_res]
+
+
+def run(stat, band, nodata, output, output_type, num_process, chunksize, images_files, feedback,
+        target_crs=None, target_res=None, target_extent=None, resampling="near",
+        temporal_group=None, temporal_ranges=None, stat_expression=None, metadata_cache=None,
+        filename_pattern=None, dates_file=None, cube=False, zarr_cog=False, approx_range=None, approx_bins=None,
+        weights=None, weight_band=None, source_index=False, progress_interval=60, band_expression=None,
+        chunk_cache=None, chunk_cache_size=None, aoi=None, dedupe=None, output_statistics=True, overviews=None):
     # ignore warnings
     warnings.filterwarnings("ignore")
 
     feedback.pushInfo("\nLoading and prepare images in path(s):")
 
-    # load images
-    images = [Image(img) for img in images_files]
+    # get the statistic from the registry, or make the custom statistic of the expression for this run
+    if stat == 'custom' and not (stat_expression or "").strip():
+        raise QgsProcessingException("\n\nError: the custom statistic required the numpy expression of the "
+                                     "statistic\n")
+    try:
+        stat_def = make_expression_statistic(stat_expression) if stat == 'custom' else get_statistic(stat)
+    except (ValueError, SyntaxError) as err:
+        raise QgsProcessingException("\n\nError: invalid statistic: {}\n".format(err))
+
+    # the weights of the images and/or the weight band for the weighted statistics
+    try:
+        weights = parse_weights(weights) if weights else None
+    except ValueError as err:
+        raise QgsProcessingException("\n\nError: invalid weights of the images: {}\n".format(err))
+    if 'weight' in stat_def.metadata and weights is None and not weight_band:
+        raise QgsProcessingException("\n\nError: the statistic '{}' required the weights of the images and/or "
+                                     "the weight band\n".format(stat))
+
+    # the date of the images is required for some statistics, the temporal
+    # groups and the weights by the distance to a target date
+    dates_required = 'date' in stat_def.metadata or 'jday' in stat_def.metadata or bool(temporal_group) or \
+        ('weight' in stat_def.metadata and isinstance(weights, tuple))
+
+    # the band-math expression (e.g. a spectral index) evaluated by chunk instead of the band
+    if band_expression:
+        if cube:
+            raise QgsProcessingException("\n\nError: the band expression is not available for the time cubes, "
+                                         "all the bands of the time cubes are the layers\n")
+        try:
+            band = BandExpression(band_expression)
+        except (ValueError, SyntaxError) as err:
+            raise QgsProcessingException("\n\nError: invalid band expression: {}\n".format(err))
+
+    # the deduplication of the scenes is by image, not by the bands of the time cubes
+    if dedupe and cube:
+        raise QgsProcessingException("\n\nError: the deduplication of the scenes is not available for the time "
+                                     "cubes\n")
+
+    # the companion band with the index of the image that produced each pixel
+    if source_index and stat_def.source_index is None:
+        raise QgsProcessingException("\n\nError: the source index band is not available for the statistic '{}'\n"
+                                     .format(stat))
 
-    if len(images) <= 1:
+    # the histograms of the approximate percentiles
+    if approx_range is not None and approx_range[0] >= approx_range[1]:
+        raise QgsProcessingException("\n\nError: invalid range of values for the approximate percentiles: "
+                                     "{} - {}\n".format(*approx_range))
+    if (approx_range is not None or approx_bins) and \
+            (stat == 'approx_median' or stat.startswith('approx_percentile_')):
+        # the statistic with the range and bins of the histograms only for this run
+        stat_def = approx_percentile(stat, approx_range, approx_bins)
+
+    # the Zarr output required the zarr package
+    if is_zarr(output):
+        try:
+            import zarr
+        except ImportError:
+            raise QgsProcessingException(
+                "\n\nError: the Zarr output required the 'zarr' python package, install it or use a GeoTIFF output.\n")
+
+    # load images, the metadata of the images is read in parallel or get from the cache
+    feedback.setProgressText("Loading the images metadata")
+    images_metadata, read_errors = get_images_metadata(images_files, metadata_cache, num_process, feedback)
+    if feedback.isCanceled():
+        return
+    errors = ["cannot read the image '{}': {}".format(images_files[idx], err) for idx, err in read_errors.items()]
+    images = [Image(img, metadata) for img, metadata in zip(images_files, images_metadata) if metadata is not None]
+
+    # set the layers of each image along the z-axis of the stack, the band to
+    # process or all the bands (time steps) for the time cubes
+    [image.set_layers(band, cube) for image in images]
+    n_layers = sum(len(image.layers) for image in images)
+
+    if (len(images_files) if not cube else n_layers) <= 1:
         raise QgsProcessingException(
-            "\n\nError: StackComposed required at least 2 or more images to process.\n")
+            "\n\nError: StackComposed required at least 2 or more images (or bands in the time cubes) to process.\n")
+
+    # resolve the metadata of the images in batch with the user pattern, the
+    # dates file and the gdal metadata tags, for the images not parsed yet
+    if (dates_required or dedupe) and \
+            (filename_pattern or dates_file or any(image.filename_metadata is None for image in images)):
+        try:
+            filenames_metadata = parse_filenames([image.file_path for image in images], filename_pattern,
+                                                 dates_file, [image.datetime_tag for image in images])
+        except (IOError, ValueError) as err:
+            raise QgsProcessingException("\n\nError: cannot resolve the dates of the images: {}\n".format(err))
+        for image, filename_metadata in zip(images, filenames_metadata):
+            if filename_metadata is not None:
+                image.filename_metadata = filename_metadata
+
+    # check the band and the filename metadata for all images
+    for image in images:
+        if not cube and max(band.bands if band_expression else [band]) > image.n_bands:
+            errors.append("the image '{0}' don't have the band {1} needed to process".format(
+                image.file_path, max(band.bands if band_expression else [band])))
+        if weight_band and 'weight' in stat_def.metadata and weight_band > image.n_bands:
+            errors.append("the image '{0}' don't have the weight band {1}".format(image.file_path, weight_band))
+        # for some statistics that required filename (or the bands date for time cubes) as metadata
+        if dates_required:
+            try:
+                if cube:
+                    image.set_metadata_from_bands()
+                else:
+                    image.set_metadata_from_filename()
+            except Exception as err:
+                errors.append(str(err).replace("\n\n", ": "))
+
+    # warp on the fly all images to the target grid if the projection or the pixel size of some
+    # image is different, the target extent alone is applied to the wrapper without warping
+    target_srs = None
+    if target_crs not in [None, '']:
+        target_srs = osr.SpatialReference()
+        target_srs.ImportFromWkt(target_crs)
+    # the target pixel size is square, the pixel size of the warped base image can be not square
+    target_x_res = target_y_res = target_res if target_res not in [None, 0] else None
+    if target_srs is not None and target_x_res is None and in_target_grid(images[0], target_srs):
+        # the pixel size of the first image already in the target CRS, for warping the images
+        # with other pixel size
+        target_x_res, target_y_res = images[0].x_res, images[0].y_res
+    use_target_grid = (target_srs is not None or target_x_res is not None) and \
+        not all(in_target_grid(image, target_srs, target_x_res, target_y_res) for image in images)
+
+    # check the pixel size and projection of the images that are not warped
+    if not use_target_grid:
+        feedback.pushInfo("  checking pixel size and projection")
+        base_srs = osr.SpatialReference()
+        base_srs.ImportFromWkt(images[0].projection)
+        for image in images:
+            if round(image.x_res, 1) != round(images[0].x_res, 1) or \
+               round(image.y_res, 1) != round(images[0].y_res, 1):
+                errors.append(
+                    "the image '{}' don't have the same pixel size to the base image: {}x{} vs {}x{}."
+                    " Set the target grid (CRS and/or pixel size) for warping on the fly the images with"
+                    " different pixel size"
+                    .format(image.file_path, round(image.x_res, 1), round(image.y_res, 1),
+                            round(images[0].x_res, 1), round(images[0].y_res, 1)))
+            image_srs = osr.SpatialReference()
+            image_srs.ImportFromWkt(image.projection)
+            if not image_srs.IsSame(base_srs):
+                feedback.pushInfo("  warning: the image '{}' don't have the same projection to the base image, set"
+                                  " the target grid for warping it on the fly".format(image.file_path))
+
+    # all the problems found in the input images in one report, before any processing
+    report_errors(errors)
 
     # save nodata set from arguments
     Image.nodata_from_arg = nodata
 
+    # the projection of the base image
+    Image.projection = images[0].projection
+
+    if use_target_grid:
+        if target_srs is None:
+            target_crs = images[0].projection
+        if target_x_res is None:
+            # use the resolution of the first image in the target projection
+            images[0].warp(target_crs, resampling=resampling)
+            target_x_res, target_y_res = images[0].x_res, images[0].y_res
+        feedback.pushInfo("  warping images on the fly to the target grid with {} resampling".format(resampling))
+        feedback.setProgressText("Warping the images to the target grid")
+        _, warp_errors = parallel_map(lambda image: image.warp(target_crs, target_x_res, target_y_res, resampling),
+                                      images, num_process, feedback)
+        if feedback.isCanceled():
+            [image.close() for image in images]
+            return
+        report_errors(["cannot warp the image '{}': {}".format(images[idx].file_path, err)
+                       for idx, err in warp_errors.items()])
+        Image.projection = target_crs
+
+    # drop the duplicated scenes or merge the scenes of the same acquisition in one layer
+    if dedupe:
+        input_images = images
+        images, first_positions = dedupe_images(input_images, dedupe)
+        if dedupe == "drop":
+            [image.close() for position, image in enumerate(input_images) if position not in first_positions]
+        if isinstance(weights, np.ndarray) and len(weights) == len(input_images):
+            # the weight of the first image of each scene
+            weights = weights[first_positions]
+        feedback.pushInfo("  {} scenes {} from {} images".format(
+            len(images), "kept" if dedupe == "drop" else "after merge the same date", len(input_images)))
+        n_layers = sum(len(image.layers) for image in images)
+
     # get wrapper extent
-    min_x = min([image.extent[0] for image in images])
-    max_y = max([image.extent[1] for image in images])
-    max_x = max([image.extent[2] for image in images])
-    min_y = min([image.extent[3] for image in images])
+    if target_extent is not None:
+        # the target extent [min_x, max_y, max_x, min_y] aligned to the target resolution for the
+        # warped images, else aligned to the pixels of the images (a clip of the wrapper)
+        if use_target_grid:
+            min_x, max_y, max_x, min_y = align_extent(target_extent, (0, 0), target_x_res, target_y_res)
+        else:
+            min_x, max_y, max_x, min_y = align_extent(target_extent, images[0].extent[0:2],
+                                                      images[0].x_res, images[0].y_res)
+    else:
+        min_x = min([image.extent[0] for image in images])
+        max_y = max([image.extent[1] for image in images])
+        max_x = max([image.extent[2] for image in images])
+        min_y = min([image.extent[3] for image in images])
     Image.wrapper_extent = [min_x, max_y, max_x, min_y]
 
     # define the properties for the raster wrapper
-    Image.wrapper_x_res = images[0].x_res
-    Image.wrapper_y_res = images[0].y_res
-    Image.wrapper_shape = (int((max_y-min_y)/Image.wrapper_y_res), int((max_x-min_x)/Image.wrapper_x_res))  # (y,x)
+    Image.wrapper_x_res = target_x_res if use_target_grid else images[0].x_res
+    Image.wrapper_y_res = target_y_res if use_target_grid else images[0].y_res
+
+    # shrink the wrapper extent to the area of interest, aligned to the pixels of the wrapper
+    if aoi:
+        try:
+            aoi = AreaOfInterest(aoi[0], aoi[1], Image.projection)
+        except (RuntimeError, ValueError) as err:
+            raise QgsProcessingException("\n\nError: invalid area of interest: {}\n".format(err))
+        # the same rule of the target extent, a clip of the wrapper aligned to its pixels
+        aoi_min_x, aoi_max_y, aoi_max_x, aoi_min_y = \
+            align_extent(aoi.extent, (min_x, max_y), Image.wrapper_x_res, Image.wrapper_y_res)
+        min_x, max_y, max_x, min_y = max(min_x, aoi_min_x), min(max_y, aoi_max_y), \
+            min(max_x, aoi_max_x), max(min_y, aoi_min_y)
+        if min_x >= max_x or min_y >= max_y:
+            raise QgsProcessingException("\n\nError: the area of interest does not intersect the images\n")
+        Image.wrapper_extent = [min_x, max_y, max_x, min_y]
+        feedback.pushInfo("  restricted to the area of interest")
+    else:
+        aoi = None
+    Image.wrapper_shape = (int(round((max_y-min_y)/Image.wrapper_y_res)),
+                           int(round((max_x-min_x)/Image.wrapper_x_res)))  # (y,x)
 
     # reset the chunksize with the min of width/high if apply
     if chunksize > min(Image.wrapper_shape):
@@ -62,92 +316,123 @@ def run(stat, band, nodata, output, output_type, num_process, chunksize, images_
 
     # some information about process
     feedback.pushInfo("  images to process: {0}".format(len(images)))
-    feedback.pushInfo("  band to process: {0}".format(band))
+    if cube:
+        feedback.pushInfo("  layers to process (bands of the time cubes): {0}".format(n_layers))
+    else:
+        feedback.pushInfo("  {0} to process: {1}".format("band expression" if band_expression else "band", band))
     feedback.pushInfo("  pixels size: {0} x {1}".format(round(Image.wrapper_x_res, 1), round(Image.wrapper_y_res, 1)))
     feedback.pushInfo("  wrapper size: {0} x {1} pixels".format(Image.wrapper_shape[1], Image.wrapper_shape[0]))
     feedback.pushInfo("  running in {0} cores with chunks size {1}".format(num_process, chunksize))
 
-    # check
-    feedback.pushInfo("  checking band and pixel size: ")
-    for image in images:
-        if band > image.n_bands:
-            raise QgsProcessingException(
-                "\n\nError: the image '{0}' don't have the band {1} needed to process\n".format(image.file_path, band))
-        if round(image.x_res, 1) != round(Image.wrapper_x_res, 1) or \
-           round(image.y_res, 1) != round(Image.wrapper_y_res, 1):
-            raise QgsProcessingException(
-                "\n\nError: the image '{}' don't have the same pixel size to the base image: {}x{} vs {}x{}."
-                  " The stack-composed is not enabled for process yet images with different pixel size.\n"
-                  .format(image.file_path, round(image.x_res, 1), round(image.y_res, 1),
-                          round(Image.wrapper_x_res, 1), round(Image.wrapper_x_res, 1)))
-    feedback.pushInfo("ok")
-
     # set bounds for all images
     [image.set_bounds() for image in images]
 
-    # for some statistics that required filename as metadata
-    if stat in ["last_pixel", "jday_last_pixel", "jday_median", "linear_trend"]:
-        [image.set_metadata_from_filename() for image in images]
+    # the local cache of the chunks stacks read for the repeated runs over the same inputs
+    if chunk_cache and chunk_cache_size:
+        chunk_cache = ChunkCache(chunk_cache, chunk_cache_size * 1024**3,
+                                 ChunkCache.make_inputs_key(images, resampling if use_target_grid else None))
+        feedback.pushInfo("  using the local cache of the chunks stacks (max {} GB)".format(chunk_cache_size))
+    else:
+        chunk_cache = None
+
+    # make the temporal groups of images, one band for each group
+    groups = None
+    if temporal_group:
+        try:
+            layers_metadata = [metadata for image in images for metadata in image.layers_metadata]
+            groups = make_groups(temporal_group, [metadata[4] for metadata in layers_metadata],
+                                 [metadata[5] for metadata in layers_metadata], temporal_ranges)
+        except ValueError as err:
+            raise QgsProcessingException("\n\nError: invalid temporal groups: {}\n".format(err))
+        if not groups:
+            raise QgsProcessingException("\n\nError: there are not temporal groups to process\n")
+        feedback.pushInfo("  temporal groups ({}): {}".format(
+            len(groups), ", ".join("{} [{}]".format(name, np.count_nonzero(mask)) for name, mask in groups)))
+
+    # the weights of the layers, for the weight by image or by the date
+    if weights is not None and 'weight' in stat_def.metadata:
+        try:
+            weights = make_weights(weights, [len(image.layers) for image in images],
+                                   [metadata[4] for image in images for metadata in image.layers_metadata]
+                                   if isinstance(weights, tuple) else None)
+        except ValueError as err:
+            raise QgsProcessingException("\n\nError: invalid weights of the images: {}\n".format(err))
+        feedback.pushInfo("  weights of the images: {}".format(", ".join("{:g}".format(w) for w in weights)))
+    if weight_band and 'weight' in stat_def.metadata:
+        feedback.pushInfo("  weight band by pixel: {}".format(weight_band))
 
     # choose the default data type based on the statistic
     if output_type in [None, '', 'Default']:
-        if stat in ['median', 'mean', 'gmean', 'max', 'min', 'last_pixel', 'jday_last_pixel',
-                    'jday_median'] or stat.startswith(('percentile_', 'trim_mean_')):
-            gdal_output_type = gdal.GDT_UInt16
-        if stat in ['std', 'snr']:
-            gdal_output_type = gdal.GDT_Float32
-        if stat in ['valid_pixels']:
-            if len(images) < 256:
-                gdal_output_type = gdal.GDT_Byte
-            else:
-                gdal_output_type = gdal.GDT_UInt16
-        if stat in ['linear_trend']:
-            gdal_output_type = gdal.GDT_Int32
-    else:
-        if output_type == 'Byte': gdal_output_type = gdal.GDT_Byte
-        if output_type == 'UInt16': gdal_output_type = gdal.GDT_UInt16
-        if output_type == 'UInt32': gdal_output_type = gdal.GDT_UInt32
-        if output_type == 'Int16': gdal_output_type = gdal.GDT_Int16
-        if output_type == 'Int32': gdal_output_type = gdal.GDT_Int32
-        if output_type == 'Float32': gdal_output_type = gdal.GDT_Float32
-        if output_type == 'Float64': gdal_output_type = gdal.GDT_Float64
+        output_type = stat_def.get_output_type(n_layers)
+        # the band expressions (such as spectral indices) are not integers
+        if band_expression and output_type == 'UInt16':
+            output_type = 'Float32'
+    gdal_output_type = getattr(gdal, "GDT_" + output_type)
+    if source_index and gdal_output_type not in [gdal.GDT_Float32, gdal.GDT_Float64] and \
+            np.iinfo(NUMPY_TYPES[gdal_output_type]).max < n_layers:
+        raise QgsProcessingException("\n\nError: the output data type {} cannot store the source index of {} "
+                                     "layers, use a larger data type\n".format(output_type, n_layers))
     for image in images:
         image.output_type = gdal_output_type
 
     ### process ###
     # Calculate the statistics
-    feedback.pushInfo("\nProcessing the {} for band {}:".format(stat, band))
-    output_array = statistic(stat, images, band, num_process, chunksize, feedback)
+    process_text = "Processing the {} for {}".format(stat, "the time cubes" if cube else "band {}".format(band)
+                                                     if not band_expression else "the band expression")
+    feedback.pushInfo("\n{}:".format(process_text))
+    feedback.setProgressText(process_text)
+    output_array = statistic(stat_def, images, chunksize, feedback, groups,
+                             weights=weights if 'weight' in stat_def.metadata else None, weight_band=weight_band,
+                             source_index=source_index, chunk_cache=chunk_cache, aoi=aoi)
+    band_names = [name for name, mask in groups] if groups is not None else None
+    if stat_def.outputs:
+        # the bands of the statistic with several bands, for each group
+        band_names = stat_def.outputs if groups is None else \
+            ["{}_{}".format(name, output) for name in band_names for output in stat_def.outputs]
+
+    # the lookup table of the source index (position of the layer in the stack, from 1) to the images
+    output_metadata = None
+    if source_index:
+        band_names = band_names or [stat]
+        band_names = band_names + [name + "_source_index" for name in band_names]
+        sources = [image.file_path if not cube else "{}:band{}".format(image.file_path, layer)
+                   for image in images for layer in image.layers]
+        output_metadata = {"SOURCE_INDEX_{}".format(index): source for index, source in enumerate(sources, start=1)}
+
+    try:
+        # the progress weighted by the pixels by layers read in each chunk
+        costs = chunks_cost(images, output_array.chunks[1], output_array.chunks[2])
+        if aoi is not None:
+            # the chunks outside of the area of interest are not computed
+            aoi_chunks = aoi.chunks_mask(output_array.chunks[1], output_array.chunks[2])
+            costs = {block: cost if aoi_chunks[block] else 0 for block, cost in costs.items()}
+        with ProgressBar(feedback=feedback, costs=costs, info_interval=progress_interval):
+            if is_zarr(output):
+                # write the blocks in parallel to the chunked store
+                output_statistics = write_zarr(output, output_array, gdal_output_type, num_process, band_names,
+                                               output_metadata, output_statistics)
+            else:
+                output_array = output_array.compute(num_workers=num_process, scheduler="threads")
+    except Canceled:
+        # the workers abort the chunks in process, and dask does not start the
+        # pending chunks, release the chunks computed
+        output_array = None
+    finally:
+        # release the datasets and warped images
+        [image.close() for image in images]
 
     if feedback.isCanceled():
+        # nothing is written for the GeoTIFF, and the Zarr store created by the run was deleted
         return
 
     ### save result ###
-    # create output raster
-    driver = gdal.GetDriverByName('GTiff')
-    nbands = 1
-    outRaster = driver.Create(output, Image.wrapper_shape[1], Image.wrapper_shape[0],
-                              nbands, gdal_output_type)
-    outband = outRaster.GetRasterBand(nbands)
-
-    # set nodata value depend of the output type
-    if gdal_output_type in [gdal.GDT_Byte, gdal.GDT_UInt16, gdal.GDT_UInt32, gdal.GDT_Int16, gdal.GDT_Int32]:
-        outband.SetNoDataValue(0)
-    if gdal_output_type in [gdal.GDT_Float32, gdal.GDT_Float64]:
-        outband.SetNoDataValue(np.nan)
-
-    # write band
-    outband.WriteArray(output_array)
-
-    # set projection and geotransform
-    outRasterSRS = osr.SpatialReference()
-    outRasterSRS.ImportFromWkt(Image.projection)
-    outRaster.SetProjection(outRasterSRS.ExportToWkt())
-    outRaster.SetGeoTransform((Image.wrapper_extent[0], Image.wrapper_x_res, 0,
-                               Image.wrapper_extent[1], 0, -Image.wrapper_y_res))
+    if is_zarr(output):
+        if zarr_cog:
+            feedback.setProgressText("Converting the Zarr output to COG")
+            zarr_to_cog(output, os.path.splitext(output.rstrip("/\\"))[0] + ".tif", output_statistics)
+    else:
+        feedback.setProgressText("Writing the output{}".format(" and its overviews" if overviews else ""))
+        write_gtiff(output, output_array, gdal_output_type, band_names, output_metadata, output_statistics, overviews)
 
     # clean
-    del driver, outRaster, outband, outRasterSRS, output_array
-
-
-
+    del output_array
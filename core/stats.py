@@ -18,176 +18,773 @@
  *                                                                         *
  ***************************************************************************/
 """
+import datetime
+import re
 import dask.array as da
 import numpy as np
 
+from StackComposed.core.band_math import parse_expression
 from StackComposed.core.image import Image
-from StackComposed.utils.progress import ProgressBar
+from StackComposed.core.kernels import pixel_reducer
+from StackComposed.core.parse import dates_arrays
+
+
+class Statistic:
+    """
+    Statistic for reduce the stack along the z-axis (time) for each pixel,
+    the reducer is a vectorized function with the arguments (stack_chunk, metadata)
+    where the stack chunk is the (y, x, t) array of the chunk with nan as nodata
+    and return the (y, x) array of the statistic
+    """
+
+    def __init__(self, name, func, dense_func=None, identity=False, metadata=(), output_type='UInt16',
+                 fill_value=np.nan, masked_input=False, stream=None, source_index=None, outputs=None,
+                 description=None):
+        self.name = name
+        # the streaming statistics can be reduced from the full stack too
+        self.func = func if func is not None else stream_reducer(stream)
+        # the same statistic without the nan-variants of numpy, used when the
+        # chunk is fully covered by all images without nan values
+        self.dense_func = dense_func
+        # the result for only one image in the chunk is the same image
+        self.identity = identity
+        # the metadata required by image, from the filename: 'date' and/or 'jday', or
+        # the 'weight' of the layers (by layer, or by pixel with shape (y, x, t))
+        self.metadata = tuple(metadata)
+        # the default output data type (gdal name), or a function of the number of images
+        self.output_type = output_type
+        # the value for pixels and chunks without data
+        self.fill_value = fill_value
+        # the reducer receives a numpy masked array (masked the nodata) instead of nan values
+        self.masked_input = masked_input
+        # factory of an accumulator (shape, depth) with the methods update(layer) and
+        # result(), for consume the layers one at a time without make the stack
+        self.stream = stream
+        # function (stack_chunk, metadata, result) that returns the index (y, x) along
+        # the t-axis of the layer that produced the result of each pixel
+        self.source_index = source_index
+        # the names of the bands for the statistics with several bands, the
+        # reducer returns the array (bands, y, x)
+        self.outputs = list(outputs) if outputs else None
+        self.description = description or name
+
+    def get_output_type(self, n_images):
+        if callable(self.output_type):
+            return self.output_type(n_images)
+        return self.output_type
+
+    def reduce(self, stack_chunk, metadata, covered=False):
+        """
+        Compute the statistic for the stack of the chunk using the fast paths if apply
+        """
+        if stack_chunk.shape[2] == 1 and self.identity:
+            # only one image in the chunk, the statistic is the same image
+            return stack_chunk[:, :, 0]
+
+        # the chunk is fully covered by all images (constant depth) and without
+        # nodata, then use the faster numpy functions without the nan handling
+        if self.dense_func is not None and covered and not np.isnan(stack_chunk).any():
+            return self.dense_func(stack_chunk, metadata)
+
+        if self.masked_input:
+            return np.ma.filled(self.func(np.ma.masked_invalid(stack_chunk), metadata), self.fill_value)
+
+        return self.func(stack_chunk, metadata)
+
+
+def nearest_index(stack_chunk, metadata, result):
+    """
+    The index of the layer with the nearest valid value to the result of the
+    statistic (the same value for min, max or the nearest element to the
+    median), the first layer in the stack for the ties
+    """
+    distance = np.abs(stack_chunk - result[:, :, np.newaxis])
+    distance[np.isnan(distance)] = np.inf
+    return np.argmin(distance, axis=2)
+
+
+def last_index(stack_chunk, metadata, result):
+    """
+    The index of the layer of the last valid pixel by the date of the layers
+    """
+    date_rank = np.empty(len(metadata['date']), dtype=int)
+    # stable sort, the last layer in the stack for the same dates
+    date_rank[np.argsort(metadata['date'], kind='stable')] = np.arange(len(metadata['date']))
+    return np.argmax(np.where(np.isnan(stack_chunk), -1, date_rank), axis=2)
+
+
+def stream_reducer(stream):
+    """
+    Reducer over the (y, x, t) stack for the streaming statistics, adding
+    the layers of the stack one by one to the accumulator
+    """
+    def stat_func(stack_chunk, metadata):
+        accumulator = stream(stack_chunk.shape[0:2], stack_chunk.shape[2])
+        for t in range(stack_chunk.shape[2]):
+            accumulator.update(stack_chunk[:, :, t])
+        return accumulator.result()
+    return stat_func
+
+
+class HistogramPercentile:
+    """
+    Approximate percentile for each pixel by a histogram of fixed bins, the
+    layers are added one at a time and the memory is the (pixels, bins)
+    counts, independent of the depth of the stack. The values outside of
+    the range are counted in the first or last bin. The value inside the
+    bin is interpolated assuming the values uniformly distributed in it,
+    then the error is less than the width of the bins (range / bins)
+    """
+    # the default range of the values and number of bins of the histograms
+    value_range = (0, 10000)
+    bins = 500
+
+    def __init__(self, percentile, shape, depth, value_range=None, bins=None):
+        self.percentile = percentile
+        self.shape = shape
+        # the range and bins of the run, without change the defaults
+        if value_range is not None:
+            self.value_range = tuple(value_range)
+        if bins:
+            self.bins = bins
+        self.lower = float(self.value_range[0])
+        self.width = (float(self.value_range[1]) - self.lower) / self.bins
+        # the smallest data type for counts up to the depth of the stack
+        dtype = np.uint8 if depth < 2**8 else np.uint16 if depth < 2**16 else np.uint32
+        self.counts = np.zeros((shape[0] * shape[1], self.bins), dtype=dtype)
+
+    def update(self, layer):
+        layer = layer.ravel()
+        valid = np.flatnonzero(~np.isnan(layer))
+        bin_index = np.clip(np.floor((layer[valid] - self.lower) / self.width), 0, self.bins - 1).astype(int)
+        # each pixel has only one value by layer, without repeated indexes
+        self.counts[valid, bin_index] += 1
+
+    def order_value(self, counts, cumulative, rank):
+        """
+        The value of the k-th (rank from 1) valid value of each pixel, at the
+        position of the value inside its bin
+        """
+        bin_index = np.minimum((cumulative < rank[:, None]).sum(axis=1), self.bins - 1)
+        pixels = np.arange(len(rank))
+        in_bin = counts[pixels, bin_index].astype(float)
+        below = cumulative[pixels, bin_index] - in_bin
+        fraction = np.clip((rank - below - 0.5) / np.maximum(in_bin, 1), 0, 1)
+        return self.lower + (bin_index + fraction) * self.width
+
+    def result(self, batch=65536):
+        result = np.full(self.counts.shape[0], np.nan)
+        # by batches of pixels for limit the memory of the cumulative counts
+        for start in range(0, self.counts.shape[0], batch):
+            counts = self.counts[start:start + batch]
+            with_data = np.flatnonzero(counts.any(axis=1))
+            counts = counts[with_data]
+            cumulative = np.cumsum(counts, axis=1, dtype=np.uint32)
+            # the fractional rank of the percentile in the valid values, interpolated
+            # between the two nearest values as numpy (linear interpolation)
+            rank = self.percentile / 100.0 * (cumulative[:, -1] - 1) + 1
+            lower_rank = np.floor(rank)
+            lower_value = self.order_value(counts, cumulative, lower_rank)
+            upper_value = self.order_value(counts, cumulative, np.ceil(rank))
+            result[start + with_data] = lower_value + (rank - lower_rank) * (upper_value - lower_value)
+        return result.reshape(self.shape)
+
+
+# registry of the statistics by name, and the statistics with parameters in
+# the name by prefix (such as percentile_NN) with a factory of the statistic
+STATISTICS = {}
+PREFIX_STATISTICS = {}
+
+
+def register_statistic(name, func, **kwargs):
+    """
+    Register a statistic (reducer) for use it by name, it can be called at
+    runtime for add custom reducers, see the Statistic class for the arguments
+    """
+    STATISTICS[name] = Statistic(name, func, **kwargs)
+    return STATISTICS[name]
+
+
+def register_prefix_statistic(prefix, factory):
+    """
+    Register a statistic with parameters in the name, the factory receives the
+    full name of the statistic (e.g. percentile_10) and returns the Statistic
+    """
+    PREFIX_STATISTICS[prefix] = factory
+
+
+def get_statistic(stat):
+    if stat in STATISTICS:
+        return STATISTICS[stat]
+    for prefix, factory in PREFIX_STATISTICS.items():
+        if stat.startswith(prefix):
+            return factory(stat)
+    raise ValueError("the statistic '{}' is not registered, the options are: {}".format(
+        stat, ", ".join(list(STATISTICS) + [prefix + "*" for prefix in PREFIX_STATISTICS])))
+
+
+# the names available in the expressions of the custom statistics
+EXPRESSION_NAMES = ('stack', 'date', 'jday')
+
+
+def make_expression_statistic(expression, name='custom'):
+    """
+    Make a custom statistic (for the run, not registered) from a numpy
+    expression over the (y, x, t) array 'stack' (nan as nodata), with the
+    'date' and 'jday' names and the allowed numpy names available, as the
+    band expressions
+
+    Examples:
+        np.nanmean(stack, axis=2) - np.nanstd(stack, axis=2)
+    """
+    tree = parse_expression(expression.strip(), lambda key: key in EXPRESSION_NAMES, "statistic expression",
+                            "stack, date, jday and np")
+    code = compile(tree, "<statistic expression>", "eval")
+    metadata = [key for key in ('date', 'jday') if key in code.co_names]
+
+    def stat_func(stack_chunk, metadata):
+        namespace = {"np": np, "stack": stack_chunk, "date": metadata.get("date"), "jday": metadata.get("jday")}
+        return np.asarray(eval(code, {"__builtins__": {}}, namespace), dtype=float)
+
+    return Statistic(name, stat_func, metadata=metadata, output_type='Float32', description=expression)
+
+
+# call built in numpy statistical functions, with a specified axis. if
+# axis=2 means it will Compute along the 'depth' axis, per pixel.
+# with the return being n by m, the shape of each band.
+#
+
+# Compute the median
+register_statistic('median', lambda stack_chunk, metadata: np.nanmedian(stack_chunk, axis=2),
+                   dense_func=lambda stack_chunk, metadata: np.median(stack_chunk, axis=2), identity=True,
+                   source_index=nearest_index)
+
+# Compute the arithmetic mean
+register_statistic('mean', lambda stack_chunk, metadata: np.nanmean(stack_chunk, axis=2),
+                   dense_func=lambda stack_chunk, metadata: np.mean(stack_chunk, axis=2), identity=True)
+
+
+# Compute the geometric mean
+def gmean(stack_chunk, metadata):
+    product = np.nanprod(stack_chunk, axis=2)
+    count = np.count_nonzero(np.nan_to_num(stack_chunk), axis=2)
+    gmean = np.array([p ** (1.0 / c) for p, c in zip(product, count)])
+    gmean[gmean == 1] = np.nan
+    return gmean
+
+
+register_statistic('gmean', gmean)
+
+# Compute the maximum value
+register_statistic('max', lambda stack_chunk, metadata: np.nanmax(stack_chunk, axis=2),
+                   dense_func=lambda stack_chunk, metadata: np.max(stack_chunk, axis=2), identity=True,
+                   source_index=nearest_index)
+
+# Compute the minimum value
+register_statistic('min', lambda stack_chunk, metadata: np.nanmin(stack_chunk, axis=2),
+                   dense_func=lambda stack_chunk, metadata: np.min(stack_chunk, axis=2), identity=True,
+                   source_index=nearest_index)
 
+# Compute the standard deviation
+register_statistic('std', lambda stack_chunk, metadata: np.nanstd(stack_chunk, axis=2),
+                   dense_func=lambda stack_chunk, metadata: np.std(stack_chunk, axis=2), output_type='Float32')
 
-def statistic(stat, images, band, num_process, chunksize, feedback):
-    # create a empty initial wrapper raster for managed dask parallel
-    # in chunks and storage result
-    wrapper_array = da.empty(Image.wrapper_shape, chunks=chunksize)
-    chunksize = wrapper_array.chunks[0][0]
-
-    # call built in numpy statistical functions, with a specified axis. if
-    # axis=2 means it will Compute along the 'depth' axis, per pixel.
-    # with the return being n by m, the shape of each band.
-    #
-
-    # Compute the median
-    if stat == 'median':
-        def stat_func(stack_chunk, metadata):
-            return np.nanmedian(stack_chunk, axis=2)
-
-    # Compute the arithmetic mean
-    if stat == 'mean':
-        def stat_func(stack_chunk, metadata):
-            return np.nanmean(stack_chunk, axis=2)
-
-    # Compute the geometric mean
-    if stat == 'gmean':
-        def stat_func(stack_chunk, metadata):
-            product = np.nanprod(stack_chunk, axis=2)
-            count = np.count_nonzero(np.nan_to_num(stack_chunk), axis=2)
-            gmean = np.array([p ** (1.0 / c) for p, c in zip(product, count)])
-            gmean[gmean == 1] = np.nan
-            return gmean
-
-    # Compute the maximum value
-    if stat == 'max':
-        def stat_func(stack_chunk, metadata):
-            return np.nanmax(stack_chunk, axis=2)
-
-    # Compute the minimum value
-    if stat == 'min':
-        def stat_func(stack_chunk, metadata):
-            return np.nanmin(stack_chunk, axis=2)
-
-    # Compute the standard deviation
-    if stat == 'std':
-        def stat_func(stack_chunk, metadata):
-            return np.nanstd(stack_chunk, axis=2)
-
-    # Compute the valid pixels
-    # this count the valid data (no nans) across the z-axis
-    if stat == 'valid_pixels':
-        def stat_func(stack_chunk, metadata):
-            return stack_chunk.shape[2] - np.isnan(stack_chunk).sum(axis=2)
-
-    # Compute the percentile NN
-    if stat.startswith('percentile_'):
-        p = int(stat.split('_')[1])
-        def stat_func(stack_chunk, metadata):
-            return np.nanpercentile(stack_chunk, p, axis=2)
-
-    # Compute the last valid pixel
-    if stat == 'last_pixel':
-        def last_pixel(pixel_time_series, index_sort):
-            if np.isnan(pixel_time_series).all():
-                return np.nan
-            for index in index_sort:
-                if not np.isnan(pixel_time_series[index]):
-                    return pixel_time_series[index]
-
-        def stat_func(stack_chunk, metadata):
-            index_sort = np.argsort(metadata['date'])[::-1]  # from the most recent to the oldest
-            return np.apply_along_axis(last_pixel, 2, stack_chunk, index_sort)
-
-    # Compute the julian day of the last valid pixel
-    if stat == 'jday_last_pixel':
-        def jday_last_pixel(pixel_time_series, index_sort, jdays):
-            if np.isnan(pixel_time_series).all():
-                return 0  # better np.nan but there is bug with multiprocessing with return nan value here
-            for index in index_sort:
-                if not np.isnan(pixel_time_series[index]):
-                    return jdays[index]
-
-        def stat_func(stack_chunk, metadata):
-            index_sort = np.argsort(metadata['date'])[::-1]  # from the most recent to the oldest
-            return np.apply_along_axis(jday_last_pixel, 2, stack_chunk, index_sort, metadata['jday'])
-
-    # Compute the julian day of the median value
-    if stat == 'jday_median':
-        def jday_median(pixel_time_series, index_sort, jdays):
-            if np.isnan(pixel_time_series).all():
-                return 0  # better np.nan but there is bug with multiprocessing with return nan value here
-            jdays = [jdays[index] for index in index_sort if not np.isnan(pixel_time_series[index])]
-            return np.ceil(np.median(jdays))
-
-        def stat_func(stack_chunk, metadata):
-            index_sort = np.argsort(metadata['date'])  # from the oldest to most recent
-            return np.apply_along_axis(jday_median, 2, stack_chunk, index_sort, metadata['jday'])
-
-    # Compute the trimmed median with lower limit and upper limit
-    if stat.startswith('trim_mean_'):
-        # TODO: check this stats when the time series have few data
-        lower = int(stat.split('_')[2])
-        upper = int(stat.split('_')[3])
-        def trim_mean(pixel_time_series):
-            if np.isnan(pixel_time_series).all():
-                return 0  # better np.nan but there is bug with multiprocessing with return nan value here
-            pts = pixel_time_series[~np.isnan(pixel_time_series)]
-            if len(pts) <= 2:
-                return np.percentile(pts, (lower+upper)/2)
-            return np.mean(pts[(pts >= np.percentile(pts, lower)) & (pts <= np.percentile(pts, upper))])
-
-        def stat_func(stack_chunk, metadata):
-            return np.apply_along_axis(trim_mean, 2, stack_chunk)
-
-    # Compute the linear trend using least-squares method
-    if stat == 'linear_trend':
-        def linear_trend(pixel_time_series, index_sort, date_list):
-            if np.isnan(pixel_time_series).all() or len(pixel_time_series[~np.isnan(pixel_time_series)]) == 1:
-                return np.nan
-            # Unix timestamp in days
-            x = [int(int(date_list[index].strftime("%s")) / 86400) for index in index_sort]
-            x = [i-x[0] for i in x]  # diff from minimum
-            pts = np.array([pixel_time_series[index] for index in index_sort])
-            y = np.ma.array(pts, mask=np.isnan(pts))
-
-            ssxm, ssxym, ssyxm, ssym = np.ma.cov(x, y, bias=1).flat
-            slope = ssxym / ssxm
-            return slope*1000000
-
-        def stat_func(stack_chunk, metadata):
-            index_sort = np.argsort(metadata['date'])  # from the oldest to most recent
-            return np.apply_along_axis(linear_trend, 2, stack_chunk, index_sort, metadata['date'])
+# Compute the valid pixels
+# this count the valid data (no nans) across the z-axis
+register_statistic('valid_pixels',
+                   lambda stack_chunk, metadata: stack_chunk.shape[2] - np.isnan(stack_chunk).sum(axis=2),
+                   dense_func=lambda stack_chunk, metadata: np.full(stack_chunk.shape[0:2], stack_chunk.shape[2]),
+                   output_type=lambda n_images: 'Byte' if n_images < 256 else 'UInt16')
+
+
+# Compute the percentile NN
+def percentile(stat):
+    p = int(stat.split('_')[1])
+    return Statistic(stat, lambda stack_chunk, metadata: np.nanpercentile(stack_chunk, p, axis=2),
+                     dense_func=lambda stack_chunk, metadata: np.percentile(stack_chunk, p, axis=2), identity=True,
+                     source_index=nearest_index)
+
+
+register_prefix_statistic('percentile_', percentile)
+
+
+# Compute the approximate median and percentile NN streaming the layers
+# in histograms, with bounded memory for very deep stacks, the range and
+# bins of the histograms can be set for the run
+def approx_percentile(stat, value_range=None, bins=None):
+    p = 50 if stat == 'approx_median' else int(stat.split('_')[2])
+    return Statistic(stat, None,
+                     stream=lambda shape, depth: HistogramPercentile(p, shape, depth, value_range, bins))
+
+
+STATISTICS['approx_median'] = approx_percentile('approx_median')
+register_prefix_statistic('approx_percentile_', approx_percentile)
+
+
+# Compute the weighted mean and median with the weights of the layers, by
+# layer (images weights) or by pixel (weight band), nodata has weight 0
+def valid_weights(stack_chunk, metadata):
+    weights = np.nan_to_num(np.broadcast_to(metadata['weight'], stack_chunk.shape))
+    return np.where(np.isnan(stack_chunk), 0, weights)
+
+
+def weighted_mean(stack_chunk, metadata):
+    weights = valid_weights(stack_chunk, metadata)
+    total = weights.sum(axis=2)
+    result = np.full(total.shape, np.nan)
+    np.divide((weights * np.nan_to_num(stack_chunk)).sum(axis=2), total, out=result, where=total > 0)
+    return result
+
+
+register_statistic('weighted_mean', weighted_mean, metadata=['weight'])
+
+
+def weighted_median(stack_chunk, metadata):
+    weights = valid_weights(stack_chunk, metadata)
+    # sort the values (the nan at the end) with its weights
+    index_sort = np.argsort(stack_chunk, axis=2)
+    values = np.take_along_axis(stack_chunk, index_sort, axis=2)
+    cumulative = np.cumsum(np.take_along_axis(weights, index_sort, axis=2), axis=2)
+    half = cumulative[:, :, -1:] / 2
+    # the first value that reaches the half of the total weight, if it is
+    # exactly the half, the mean with the next value (as the median)
+    lower = np.take_along_axis(values, np.argmax(cumulative >= half, axis=2)[:, :, np.newaxis], axis=2)
+    upper = np.take_along_axis(values, np.argmax(cumulative > half, axis=2)[:, :, np.newaxis], axis=2)
+    median = (lower[:, :, 0] + upper[:, :, 0]) / 2
+    median[half[:, :, 0] <= 0] = np.nan
+    return median
+
+
+register_statistic('weighted_median', weighted_median, metadata=['weight'])
+
+
+def parse_weights(weights):
+    """
+    Parse the weights of the images for the weighted statistics, a list of
+    numbers by image in the order of the inputs, or a target date with an
+    optional scale in days (30 by default) for weighting the images by the
+    distance to the date: 1 / (1 + days / scale)
+
+    Examples:
+        1, 0.5, 0.8
+        2020-01-15/30
+    """
+    if re.match(r"^\s*\d{4}-\d{2}-\d{2}", weights):
+        target_date, _, scale = weights.strip().partition("/")
+        target_date = datetime.datetime.strptime(target_date.strip(), "%Y-%m-%d").date()
+        scale = float(scale) if scale.strip() else 30
+        if scale <= 0:
+            raise ValueError("the scale in days must be positive: {}".format(weights))
+        return target_date, scale
+    weights = np.array([float(weight) for weight in weights.split(",")])
+    if (weights < 0).any():
+        raise ValueError("the weights must be positive: {}".format(", ".join(str(weight) for weight in weights)))
+    return weights
+
+
+def make_weights(weights, layers_count, dates=None):
+    """
+    Make the weights of the layers from the weights parsed, the weight of
+    each image is for all its layers, the dates are required for the
+    weights by the distance to a target date
+    """
+    if isinstance(weights, tuple):
+        target_date, scale = weights
+        days = np.abs((np.array(dates, dtype="datetime64[D]") - np.datetime64(target_date)).astype(int))
+        return 1 / (1 + days / scale)
+    if len(weights) != len(layers_count):
+        raise ValueError("there are {} weights for {} images".format(len(weights), len(layers_count)))
+    return np.repeat(weights, layers_count)
+
+
+# Compute the harmonic regression of the time series: the intercept, trend
+# (by year), the cosine and sine coefficients of each harmonic (annual,
+# semiannual, ...) and the RMSE, all pixels are fitted at once solving the
+# normal equations masked by the valid values, for harmonic_N with N harmonics
+def harmonic(stat):
+    harmonics = int(stat.split('_')[1]) if stat != 'harmonic' else 1
+    outputs = ['intercept', 'trend'] + \
+              [name + str(k) for k in range(1, harmonics + 1) for name in ('cos', 'sin')] + ['rmse']
+
+    def stat_func(stack_chunk, metadata):
+        rows, cols, depth = stack_chunk.shape
+        # the design matrix (t, p) with the time in years since 1970-01-01
+        years = np.asarray(metadata['date'], dtype="datetime64[D]").astype(float) / 365.25
+        design = [np.ones(depth), years]
+        for k in range(1, harmonics + 1):
+            design += [np.cos(2 * np.pi * k * years), np.sin(2 * np.pi * k * years)]
+        design = np.stack(design, axis=1)
+        n_coefficients = design.shape[1]
+
+        values = stack_chunk.reshape(-1, depth)
+        valid = ~np.isnan(values)
+        valid_values = np.where(valid, values, 0)
+        # the normal equations (X^T W X) b = X^T W y for all pixels, with W the valid mask
+        normal_matrix = (valid.astype(float) @ (design[:, :, np.newaxis] * design[:, np.newaxis, :])
+                         .reshape(depth, -1)).reshape(-1, n_coefficients, n_coefficients)
+        normal_vector = valid_values @ design
+        n_valid = valid.sum(axis=1)
+
+        # only the pixels with more valid values than coefficients
+        coefficients = np.full((values.shape[0], n_coefficients), np.nan)
+        fit = n_valid > n_coefficients
+        try:
+            coefficients[fit] = np.linalg.solve(normal_matrix[fit], normal_vector[fit][:, :, np.newaxis])[:, :, 0]
+        except np.linalg.LinAlgError:
+            # some pixels are singular (e.g. the values in the same dates)
+            coefficients[fit] = (np.linalg.pinv(normal_matrix[fit]) @ normal_vector[fit][:, :, np.newaxis])[:, :, 0]
+
+        residuals = np.where(valid, values - coefficients @ design.T, 0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rmse = np.sqrt((residuals ** 2).sum(axis=1) / n_valid)
+        return np.concatenate([coefficients.T, rmse[np.newaxis]]).reshape(n_coefficients + 1, rows, cols)
+
+    return Statistic(stat, stat_func, metadata=['date'], output_type='Float32', outputs=outputs)
+
+
+STATISTICS['harmonic'] = harmonic('harmonic')
+register_prefix_statistic('harmonic_', harmonic)
+
+
+# The time series statistics are kernels by pixel written as loops over the
+# time series (nan as nodata), compiled with numba if it is available
+
+
+# Compute the last valid pixel
+def last_pixel(values, dates, jdays):
+    last = -1
+    for t in range(values.shape[0]):
+        if not np.isnan(values[t]) and (last == -1 or dates[t] >= dates[last]):
+            last = t
+    if last == -1:
+        return np.nan
+    return values[last]
+
+
+def last_pixel_vectorized(stack_chunk, metadata):
+    last = last_index(stack_chunk, metadata, None)
+    return np.take_along_axis(stack_chunk, last[:, :, np.newaxis], axis=2)[:, :, 0]
+
+
+register_statistic('last_pixel', pixel_reducer(last_pixel, last_pixel_vectorized), identity=True, metadata=['date'],
+                   source_index=last_index)
+
+
+# Compute the julian day of the last valid pixel
+def jday_last_pixel(values, dates, jdays):
+    last = -1
+    for t in range(values.shape[0]):
+        if not np.isnan(values[t]) and (last == -1 or dates[t] >= dates[last]):
+            last = t
+    if last == -1:
+        return 0  # better np.nan but there is bug with multiprocessing with return nan value here
+    return jdays[last]
+
+
+def jday_last_pixel_vectorized(stack_chunk, metadata):
+    last_jday = np.asarray(metadata['jday'], dtype=np.float64)[last_index(stack_chunk, metadata, None)]
+    return np.where(np.isnan(stack_chunk).all(axis=2), 0, last_jday)
+
+
+register_statistic('jday_last_pixel', pixel_reducer(jday_last_pixel, jday_last_pixel_vectorized),
+                   metadata=['date', 'jday'], fill_value=0)
+
+
+# Compute the julian day of the median value
+def jday_median(values, dates, jdays):
+    valid_jdays = jdays[~np.isnan(values)]
+    if valid_jdays.shape[0] == 0:
+        return 0  # better np.nan but there is bug with multiprocessing with return nan value here
+    return np.ceil(np.median(valid_jdays))
+
+
+def jday_median_vectorized(stack_chunk, metadata):
+    valid_jdays = np.where(np.isnan(stack_chunk), np.nan, np.asarray(metadata['jday'], dtype=np.float64))
+    return np.nan_to_num(np.ceil(np.nanmedian(valid_jdays, axis=2)), nan=0)
+
+
+register_statistic('jday_median', pixel_reducer(jday_median, jday_median_vectorized), metadata=['date', 'jday'],
+                   fill_value=0)
+
+
+# Compute the trimmed median with lower limit and upper limit
+def trim_mean(stat):
+    # TODO: check this stats when the time series have few data
+    lower = int(stat.split('_')[2])
+    upper = int(stat.split('_')[3])
+
+    def trim_mean(values, dates, jdays):
+        pts = values[~np.isnan(values)]
+        if pts.shape[0] == 0:
+            return 0  # better np.nan but there is bug with multiprocessing with return nan value here
+        if pts.shape[0] <= 2:
+            return np.percentile(pts, (lower + upper) / 2)
+        return np.mean(pts[(pts >= np.percentile(pts, lower)) & (pts <= np.percentile(pts, upper))])
+
+    def trim_mean_vectorized(stack_chunk, metadata):
+        # the percentiles from the sorted time series (the nan at the end), faster than nanpercentile
+        sorted_stack = np.sort(stack_chunk, axis=2)
+        count = np.count_nonzero(~np.isnan(stack_chunk), axis=2)
+
+        def percentile(q):
+            position = (np.maximum(count, 1) - 1) * q / 100
+            below = np.floor(position).astype(int)
+            above = np.minimum(below + 1, np.maximum(count - 1, 0))
+            below_values = np.take_along_axis(sorted_stack, below[:, :, np.newaxis], axis=2)[:, :, 0]
+            above_values = np.take_along_axis(sorted_stack, above[:, :, np.newaxis], axis=2)[:, :, 0]
+            return below_values + (above_values - below_values) * (position - below)
 
-    # Compute the statistical for the respective chunk
-    def calc(block, block_id=None, chunksize=None):
-        if feedback.isCanceled():
-            return
+        inside = (stack_chunk >= percentile(lower)[:, :, np.newaxis]) & \
+                 (stack_chunk <= percentile(upper)[:, :, np.newaxis])
+        result = np.nanmean(np.where(inside, stack_chunk, np.nan), axis=2)
+        result = np.where(count <= 2, percentile((lower + upper) / 2), result)
+        result[count == 0] = 0
+        return result
 
-        yc = block_id[0] * chunksize
-        yc_size = block.shape[0]
-        xc = block_id[1] * chunksize
-        xc_size = block.shape[1]
+    return Statistic(stat, pixel_reducer(trim_mean, trim_mean_vectorized), fill_value=0)
+
+
+register_prefix_statistic('trim_mean_', trim_mean)
+
+
+# Compute the linear trend using least-squares method
+def linear_trend(values, dates, jdays):
+    # the slope of the valid values by the days of the dates
+    valid = ~np.isnan(values)
+    n = valid.sum()
+    if n <= 1:
+        return np.nan
+    x = dates[valid]
+    y = values[valid]
+    x_mean = x.mean()
+    denominator = ((x - x_mean) ** 2).sum()
+    if denominator == 0:
+        # all valid values in the same date
+        return np.nan
+    slope = ((x - x_mean) * (y - y.mean())).sum() / denominator
+    return slope*1000000
+
+
+def linear_trend_vectorized(stack_chunk, metadata):
+    valid = ~np.isnan(stack_chunk)
+    dates = np.asarray(metadata['date'], dtype='datetime64[D]').astype(np.float64)
+    x = np.where(valid, dates, np.nan)
+    x_diff = np.nan_to_num(x - np.nanmean(x, axis=2, keepdims=True))
+    y_diff = np.nan_to_num(stack_chunk - np.nanmean(stack_chunk, axis=2, keepdims=True))
+    denominator = (x_diff ** 2).sum(axis=2)
+    result = np.full(stack_chunk.shape[0:2], np.nan)
+    np.divide((x_diff * y_diff).sum(axis=2), denominator, out=result,
+              where=(valid.sum(axis=2) > 1) & (denominator > 0))
+    return result*1000000
+
+
+register_statistic('linear_trend', pixel_reducer(linear_trend, linear_trend_vectorized), metadata=['date'],
+                   output_type='Int32')
+
+
+def chunks_cost(images, y_chunks, x_chunks):
+    """
+    The expected cost of each chunk by block index (y, x), the pixels by
+    layers of the images read inside the chunk, from the bounds of the images
+    """
+    y_bounds = np.cumsum((0,) + tuple(y_chunks))
+    x_bounds = np.cumsum((0,) + tuple(x_chunks))
+    # the rows and columns of each image (k) inside each chunk, with shape (k, chunks)
+    rows = np.clip(np.minimum(y_bounds[1:], [[image.yi_max] for image in images]) -
+                   np.maximum(y_bounds[:-1], [[image.yi_min] for image in images]), 0, None)
+    cols = np.clip(np.minimum(x_bounds[1:], [[image.xi_max] for image in images]) -
+                   np.maximum(x_bounds[:-1], [[image.xi_min] for image in images]), 0, None)
+    layers = np.array([len(image.layers) for image in images])
+    costs = np.einsum("ky,kx,k->yx", rows, cols, layers)
+    return {(y, x): int(costs[y, x]) for y in range(costs.shape[0]) for x in range(costs.shape[1])}
+
+
+class Canceled(Exception):
+    """
+    Raised in the workers when the process is canceled, for abort the dask
+    computation instead of assemble a broken array
+    """
+
+
+# the maximum memory (bytes) by worker for compute a chunk, over it the chunk
+# is processed in sub-windows one after another
+STACK_MEMORY_BUDGET = 2**30
+# the peak memory of compute a chunk in times of its stack (y, x, t) float64: the
+# chunks of the images with the stack concatenated, or the stack with the copy of
+# the temporal group and the temporaries of the reducers (e.g. nanpercentile)
+STACK_MEMORY_FACTOR = 3
+
+
+def statistic(stat, images, chunksize, feedback, groups=None, memory_budget=STACK_MEMORY_BUDGET,
+              weights=None, weight_band=None, source_index=False, chunk_cache=None, aoi=None):
+    # the statistic by name or the Statistic made for the run
+    stat = get_statistic(stat) if isinstance(stat, str) else stat
+
+    # the layers of each image along the z-axis of the stack, one band of each
+    # image or all the bands (time steps) of the time cubes
+    layers_count = np.array([len(image.layers) for image in images])
+
+    # the temporal groups of layers (name, mask), the statistic is computed
+    # for each group in one band, by default only one group with all layers
+    if groups is None:
+        groups = [(stat.name, np.ones(layers_count.sum(), dtype=bool))]
+    # the bands of the statistic for each group
+    n_stat_bands = len(stat.outputs) if stat.outputs else 1
+    n_bands = len(groups) * n_stat_bands
+    # the companion bands with the source index of each group after the bands of the statistic
+    n_outputs = n_bands * 2 if source_index else n_bands
 
-        # make stack reading all images only in specific chunk
-        chunks_list = [image.get_chunk_in_wrapper(band, xc, xc_size, yc, yc_size) for image in images]
-        # delete empty chunks
-        mask_none = [False if x is None else True for x in chunks_list]
-        chunks_list = np.array([i for i in chunks_list if i is not None])
+    # create a empty initial wrapper raster for managed dask parallel
+    # in chunks and storage result, with shape (bands, y, x)
+    wrapper_array = da.empty((n_outputs,) + Image.wrapper_shape, chunks=(n_outputs, chunksize, chunksize))
+    chunksize = wrapper_array.chunks[1][0]
+
+    # the chunks that touch the area of interest, the others are not read or computed
+    aoi_chunks = aoi.chunks_mask(wrapper_array.chunks[1], wrapper_array.chunks[2]) if aoi is not None else None
+
+    # the metadata required by the statistic for all layers
+    layers_metadata = {}
+    if 'date' in stat.metadata or 'jday' in stat.metadata:
+        layers_metadata["date"], layers_metadata["jday"] = \
+            dates_arrays([metadata for image in images for metadata in image.layers_metadata])
+    if 'weight' in stat.metadata:
+        layers_metadata["weight"] = np.ones(layers_count.sum()) if weights is None else np.asarray(weights, float)
+    # the weight band is read with the layers of each image in the same read
+    extra_bands = [weight_band] if weight_band and 'weight' in stat.metadata else []
+
+    # stop the work of the chunk when the process is canceled, it is checked
+    # at the start of the chunk and between the reads of the images
+    def check_canceled():
+        if feedback.isCanceled():
+            raise Canceled()
+
+    # Compute the streaming statistic for the respective chunk, reading the
+    # images one at a time and adding its layers to the accumulator of each
+    # group, without make the stack
+    def calc_stream(images_in_chunk, layers_overlap, xc, xc_size, yc, yc_size):
+        groups_masks = [group_mask[layers_overlap] for _, group_mask in groups]
+        accumulators = [stat.stream((yc_size, xc_size), group_mask.sum()) if group_mask.any() else None
+                        for group_mask in groups_masks]
+        layer_index = 0
+        for image in images_in_chunk:
+            check_canceled()
+            image_chunk = image.get_chunk_in_wrapper(image.layers, xc, xc_size, yc, yc_size)
+            for t in range(image_chunk.shape[2]):
+                for accumulator, group_mask in zip(accumulators, groups_masks):
+                    if accumulator is not None and group_mask[layer_index]:
+                        accumulator.update(image_chunk[:, :, t])
+                layer_index += 1
+            del image_chunk
+
+        result = np.full((n_bands, yc_size, xc_size), stat.fill_value, dtype=float)
+        for n, accumulator in enumerate(accumulators):
+            if accumulator is not None:
+                result[n] = accumulator.result()
+        return result
 
-        if not chunks_list.size:
-            # all chunks are empty, return the chunk with nan
-            return np.full((yc_size, xc_size), np.nan)
+    # Compute the statistical for the respective chunk
+    def calc(block, block_id=None, chunksize=None):
+        check_canceled()
+
+        yc = block_id[1] * chunksize
+        yc_size = block.shape[1]
+        xc = block_id[2] * chunksize
+        xc_size = block.shape[2]
+
+        if aoi is None:
+            return calc_window(xc, xc_size, yc, yc_size)
+
+        if not aoi_chunks[block_id[1], block_id[2]]:
+            # the chunk is outside of the area of interest
+            return np.broadcast_to(float(stat.fill_value), (n_outputs, yc_size, xc_size))
+        result = calc_window(xc, xc_size, yc, yc_size)
+        # mask the pixels of the chunk outside of the polygons of the area of interest
+        aoi_mask = aoi.window_mask(xc, xc_size, yc, yc_size)
+        if not aoi_mask.all():
+            result = np.where(aoi_mask, result, float(stat.fill_value))
+        return result
+
+    # Compute the statistical for the window of the wrapper (the chunk or a part of it)
+    def calc_window(xc, xc_size, yc, yc_size):
+        # images with data inside the chunk, only these are read
+        mask_overlap = np.array([image.intersects(xc, xc_size, yc, yc_size) for image in images])
+
+        if not mask_overlap.any():
+            # all chunks are empty, return the chunk with the fill value without allocate it
+            return np.broadcast_to(float(stat.fill_value), (n_outputs, yc_size, xc_size))
+
+        images_in_chunk = [image for image, overlap in zip(images, mask_overlap) if overlap]
+        layers_overlap = np.repeat(mask_overlap, layers_count)
+
+        if stat.stream is not None:
+            return calc_stream(images_in_chunk, layers_overlap, xc, xc_size, yc, yc_size)
+
+        # the peak memory of the stack of the chunk (float64) with the depth of the
+        # overlapping images exceeds the memory budget, then split the chunk in sub-windows
+        # processed sequentially, the result is the same (exact) with a bounded memory
+        depth = layers_overlap.sum() * (2 if extra_bands else 1)
+        pixel_bytes = depth * 8 * STACK_MEMORY_FACTOR
+        if yc_size * xc_size * pixel_bytes > memory_budget and yc_size * xc_size > 1:
+            pixels = max(1, memory_budget // pixel_bytes)
+            rows, cols = (pixels // xc_size, xc_size) if pixels >= xc_size else (1, pixels)
+            return np.concatenate(
+                [np.concatenate([calc_window(x, min(cols, xc + xc_size - x), y, min(rows, yc + yc_size - y))
+                                 for x in range(xc, xc + xc_size, cols)], axis=2)
+                 for y in range(yc, yc + yc_size, rows)], axis=1)
+
+        covered = all(image.covers(xc, xc_size, yc, yc_size) for image in images_in_chunk)
+
+        # make stack reading all images only in specific chunk, only once for all groups,
+        # or load it from the local cache of the chunks stacks of previous runs
+        window = (xc, xc_size, yc, yc_size, tuple(extra_bands))
+        images_stack = chunk_cache.get(window) if chunk_cache is not None else None
+        if images_stack is None:
+            images_chunks = []
+            for image in images_in_chunk:
+                check_canceled()
+                images_chunks.append(image.get_chunk_in_wrapper(image.layers + extra_bands, xc, xc_size, yc, yc_size))
+            images_stack = np.concatenate(images_chunks, axis=2)
+            del images_chunks
+            if chunk_cache is not None:
+                chunk_cache.put(window, images_stack)
 
         # for some statistics that required filename as metadata
-        metadata = {}
-        if stat in ["last_pixel", "jday_last_pixel", "jday_median", "linear_trend"]:
-            metadata["date"] = np.array([image.date for image in images])[mask_none]
-        if stat in ["jday_last_pixel", "jday_median"]:
-            metadata["jday"] = np.array([image.jday for image in images])[mask_none]
-
-        stack_chunk = np.stack(chunks_list, axis=2)
-        return stat_func(stack_chunk, metadata)
-
-    # process
-    with ProgressBar(feedback=feedback):
-        map_blocks = da.map_blocks(calc, wrapper_array, chunks=wrapper_array.chunks, chunksize=chunksize, dtype=float)
-        result_array = map_blocks.compute(num_workers=num_process, scheduler="threads")
-
-    return result_array
+        metadata = {key: value[layers_overlap] for key, value in layers_metadata.items()}
+
+        if extra_bands:
+            # the weight band (the last band read) of each image is the weight by pixel for all its layers
+            bands_count = np.array([len(image.layers) + 1 for image in images_in_chunk])
+            weight_columns = np.cumsum(bands_count) - 1
+            pixel_weights = np.repeat(images_stack[:, :, weight_columns], bands_count - 1, axis=2)
+            metadata["weight"] = pixel_weights * metadata["weight"]
+            stack_chunk = np.delete(images_stack, weight_columns, axis=2)
+        else:
+            stack_chunk = images_stack
+        del images_stack
+
+        # the position of the layers of the chunk in the whole stack
+        layers_position = np.flatnonzero(layers_overlap)
+
+        # compute the statistic for each temporal group
+        result = np.full((n_outputs, yc_size, xc_size), stat.fill_value, dtype=float)
+        for n, (group_name, group_mask) in enumerate(groups):
+            group_index = np.flatnonzero(group_mask[layers_overlap])
+            if not group_index.size:
+                continue
+            if group_index.size == stack_chunk.shape[2]:
+                # all layers in the chunk are in the group
+                group_stack, group_metadata = stack_chunk, metadata
+            else:
+                group_stack = stack_chunk[:, :, group_index]
+                group_metadata = {key: value[..., group_index] for key, value in metadata.items()}
+            result[n * n_stat_bands:(n + 1) * n_stat_bands] = stat.reduce(group_stack, group_metadata, covered)
+            if source_index:
+                # the position (from 1) in the whole stack of the layer that produced each pixel
+                layer_index = stat.source_index(group_stack, group_metadata, result[n])
+                result[n_bands + n] = np.where(np.isnan(result[n]), np.nan,
+                                               layers_position[group_index][layer_index] + 1)
+        return result
+
+    # the process is lazy, it is computed (in memory or writing the blocks in
+    # parallel) with the output
+    return da.map_blocks(calc, wrapper_array, chunks=wrapper_array.chunks, chunksize=chunksize, dtype=float)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ StackComposed
+                          A QGIS plugin processing
+ Compute and generate the composed of a raster images stack
+                              -------------------
+        copyright            : (C) 2021-2022 by Xavier Corredor Llano, SMByC
+        email                : xavier.corredor.llano@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import datetime
+import numpy as np
+
+TEMPORAL_GROUPS = ['year', 'month', 'year_month', 'date_ranges', 'doy_windows']
+
+
+def parse_date_ranges(ranges):
+    """
+    Parse the custom date ranges as a list of (start, end) dates
+
+    Examples:
+        2019-06-01/2019-09-30, 2019-12-01/2020-03-31
+    """
+    date_ranges = []
+    for date_range in ranges.split(","):
+        start, end = date_range.strip().split("/")
+        start = datetime.datetime.strptime(start.strip(), "%Y-%m-%d").date()
+        end = datetime.datetime.strptime(end.strip(), "%Y-%m-%d").date()
+        if start > end:
+            raise ValueError("the start date is after the end date in the range: {}".format(date_range))
+        date_ranges.append((start, end))
+    return date_ranges
+
+
+def parse_doy_windows(windows):
+    """
+    Parse the day-of-year windows as a list of (start, end) julian days, the
+    window can wrap around the end of the year
+
+    Examples:
+        152-273, 335-59
+    """
+    doy_windows = []
+    for window in windows.split(","):
+        start, end = [int(jday) for jday in window.strip().split("-")]
+        if not (1 <= start <= 366 and 1 <= end <= 366):
+            raise ValueError("the julian days must be between 1 and 366 in the window: {}".format(window))
+        doy_windows.append((start, end))
+    return doy_windows
+
+
+def make_groups(temporal_group, dates, jdays, ranges=None):
+    """
+    Make the temporal groups of the images, return a list of (name, mask)
+    where the mask select the images (by position) inside each group
+    """
+    dates = np.array(dates, dtype="datetime64[D]")
+    jdays = np.array(jdays)
+    years = dates.astype("datetime64[Y]").astype(int) + 1970
+    months = dates.astype("datetime64[M]").astype(int) % 12 + 1
+
+    if temporal_group == 'year':
+        return [(str(year), years == year) for year in np.unique(years)]
+
+    if temporal_group == 'month':
+        return [("month_{:02d}".format(month), months == month) for month in np.unique(months)]
+
+    if temporal_group == 'year_month':
+        year_months = np.unique(dates.astype("datetime64[M]"))
+        return [(str(year_month), dates.astype("datetime64[M]") == year_month) for year_month in year_months]
+
+    if temporal_group == 'date_ranges':
+        return [("{}/{}".format(start, end), (dates >= np.datetime64(start)) & (dates <= np.datetime64(end)))
+                for start, end in parse_date_ranges(ranges)]
+
+    if temporal_group == 'doy_windows':
+        groups = []
+        for start, end in parse_doy_windows(ranges):
+            if start <= end:
+                mask = (jdays >= start) & (jdays <= end)
+            else:
+                mask = (jdays >= start) | (jdays <= end)
+            groups.append(("doy_{}-{}".format(start, end), mask))
+        return groups
+
+    raise ValueError("invalid temporal group '{}', the options are: {}"
+                     .format(temporal_group, ", ".join(TEMPORAL_GROUPS)))
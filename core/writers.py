@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ StackComposed
+                          A QGIS plugin processing
+ Compute and generate the composed of a raster images stack
+                              -------------------
+        copyright            : (C) 2021-2022 by Xavier Corredor Llano, SMByC
+        email                : xavier.corredor.llano@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import os
+import shutil
+import threading
+import dask.array as da
+import numpy as np
+from osgeo import gdal, osr
+
+from StackComposed.core.image import Image
+
+# gdal output data types to numpy
+NUMPY_TYPES = {gdal.GDT_Byte: np.uint8, gdal.GDT_UInt16: np.uint16, gdal.GDT_UInt32: np.uint32,
+               gdal.GDT_Int16: np.int16, gdal.GDT_Int32: np.int32, gdal.GDT_Float32: np.float32,
+               gdal.GDT_Float64: np.float64}
+
+# the name of the result array inside the Zarr store
+ZARR_ARRAY_NAME = "composed"
+
+
+def get_nodata(gdal_output_type):
+    """
+    The nodata value depend of the output type
+    """
+    if gdal_output_type in [gdal.GDT_Float32, gdal.GDT_Float64]:
+        return np.nan
+    return 0
+
+
+def get_geotransform():
+    return (Image.wrapper_extent[0], Image.wrapper_x_res, 0,
+            Image.wrapper_extent[1], 0, -Image.wrapper_y_res)
+
+
+def is_zarr(output):
+    return os.path.splitext(output.rstrip("/\\"))[1].lower() == ".zarr"
+
+
+def cast_output(values, gdal_output_type):
+    """
+    Convert the values of the result (float with nan as nodata) to the output
+    type as gdal does when it writes them: rounded and clipped to the range of
+    the integer types, nan as the nodata
+    """
+    dtype = NUMPY_TYPES[gdal_output_type]
+    if np.issubdtype(dtype, np.floating):
+        return values.astype(dtype)
+    info = np.iinfo(dtype)
+    values = np.floor(np.nan_to_num(values, nan=get_nodata(gdal_output_type)) + 0.5)
+    return np.clip(values, info.min, info.max).astype(dtype)
+
+
+class OutputStatistics:
+    """
+    Statistics of each band of the output (min, max, mean, std, valid percent
+    and the histogram) accumulated from the blocks as they are written, for
+    store them in the output without re-read it. The histogram is exact for the
+    8 and 16 bits integer types (counts by value), for the other types it is
+    merged from the histograms of the blocks
+    """
+    # number of buckets of the histogram
+    buckets = 256
+
+    def __init__(self, n_bands, gdal_output_type):
+        self.dtype = np.dtype(NUMPY_TYPES[gdal_output_type])
+        self.nodata = get_nodata(gdal_output_type)
+        self.by_value = np.issubdtype(self.dtype, np.integer) and self.dtype.itemsize <= 2
+        self.total = np.zeros(n_bands, dtype=np.int64)
+        self.count = np.zeros(n_bands, dtype=np.int64)
+        self.mean = np.zeros(n_bands)
+        self.m2 = np.zeros(n_bands)
+        self.min = np.full(n_bands, np.inf)
+        self.max = np.full(n_bands, -np.inf)
+        # the counts by value (from the minimum of the type) or the histograms (min, max, counts) of the blocks
+        self.histograms = [np.zeros(2 ** (8 * self.dtype.itemsize), dtype=np.int64) if self.by_value else []
+                           for _ in range(n_bands)]
+        self._lock = threading.Lock()
+
+    def update(self, nband, values):
+        """
+        Accumulate the values (in the output type) of a block of the band
+        """
+        values = values.ravel()
+        valid = values[~np.isnan(values)] if np.issubdtype(self.dtype, np.floating) else values[values != self.nodata]
+        if valid.size:
+            valid = valid.astype(np.float64)
+            count, mean = valid.size, valid.mean()
+            m2 = ((valid - mean) ** 2).sum()
+            if self.by_value:
+                histogram = np.bincount((valid - np.iinfo(self.dtype).min).astype(np.int64),
+                                        minlength=len(self.histograms[nband]))
+            else:
+                histogram = (valid.min(), valid.max(), np.histogram(valid, bins=self.buckets)[0])
+        with self._lock:
+            self.total[nband] += values.size
+            if not valid.size:
+                return
+            # merge the mean and the sum of squares of differences of the block (Chan et al.)
+            delta = mean - self.mean[nband]
+            total_count = self.count[nband] + count
+            self.mean[nband] += delta * count / total_count
+            self.m2[nband] += m2 + delta ** 2 * self.count[nband] * count / total_count
+            self.count[nband] = total_count
+            self.min[nband] = min(self.min[nband], valid.min())
+            self.max[nband] = max(self.max[nband], valid.max())
+            if self.by_value:
+                self.histograms[nband] += histogram
+            else:
+                self.histograms[nband].append(histogram)
+
+    def histogram(self, nband):
+        """
+        The histogram of the band (min, max, counts) with the buckets between
+        the min and max, for the integer types the min and max are extended
+        by half of a value as the default histogram of gdal
+        """
+        is_integer = np.issubdtype(self.dtype, np.integer)
+        hist_min = self.min[nband] - (0.5 if is_integer else 0)
+        hist_max = self.max[nband] + (0.5 if is_integer else 0)
+        if self.by_value:
+            values = np.arange(len(self.histograms[nband])) + np.iinfo(self.dtype).min
+            counts = self.histograms[nband]
+        else:
+            # the counts of the buckets of the blocks in the centers of its buckets
+            values = np.concatenate([np.linspace(block_min, block_max, self.buckets + 1)[:-1] +
+                                     (block_max - block_min) / self.buckets / 2
+                                     for block_min, block_max, _ in self.histograms[nband]])
+            counts = np.concatenate([block_counts for _, _, block_counts in self.histograms[nband]])
+        buckets = np.clip(np.floor((values - hist_min) / (hist_max - hist_min or 1) * self.buckets),
+                          0, self.buckets - 1).astype(np.int64)
+        nonzero = counts > 0
+        return hist_min, hist_max, np.bincount(buckets[nonzero], weights=counts[nonzero],
+                                               minlength=self.buckets).astype(np.int64)
+
+    def get(self, nband):
+        """
+        The statistics of the band as a dict, None if the band is empty
+        """
+        if not self.count[nband]:
+            return None
+        hist_min, hist_max, counts = self.histogram(nband)
+        return {"min": float(self.min[nband]), "max": float(self.max[nband]), "mean": float(self.mean[nband]),
+                "std": float(np.sqrt(self.m2[nband] / self.count[nband])),
+                "valid_percent": float(100 * self.count[nband] / self.total[nband]),
+                "histogram": {"min": float(hist_min), "max": float(hist_max), "counts": counts.tolist()}}
+
+    def set_band(self, nband, raster_band):
+        """
+        Set the statistics and the default histogram of the band in the gdal
+        band, saved in the band metadata and the PAM (.aux.xml)
+        """
+        band_statistics = self.get(nband)
+        if band_statistics is None:
+            return
+        raster_band.SetStatistics(band_statistics["min"], band_statistics["max"],
+                                  band_statistics["mean"], band_statistics["std"])
+        raster_band.SetMetadataItem("STATISTICS_VALID_PERCENT", "{:.4g}".format(band_statistics["valid_percent"]))
+        histogram = band_statistics["histogram"]
+        raster_band.SetDefaultHistogram(histogram["min"], histogram["max"], histogram["counts"])
+
+
+def overview_levels(shape, min_size=256):
+    """
+    The decimation factors of the overviews (2, 4, 8...) until the overview
+    fits in the min size as the default levels of gdaladdo
+    """
+    levels = []
+    factor = 2
+    while np.ceil(max(shape) / (factor // 2)) > min_size:
+        levels.append(factor)
+        factor *= 2
+    return levels
+
+
+def downsample(values, factor, resampling, gdal_output_type):
+    """
+    Decimate the band (in the output type) by the factor, with the nearest
+    pixel or the average of the valid pixels of each window
+    """
+    rows, cols = int(np.ceil(values.shape[0] / factor)), int(np.ceil(values.shape[1] / factor))
+    if resampling == "nearest":
+        y_index = np.minimum(np.arange(rows) * factor + factor // 2, values.shape[0] - 1)
+        x_index = np.minimum(np.arange(cols) * factor + factor // 2, values.shape[1] - 1)
+        return values[np.ix_(y_index, x_index)]
+    # the windows with the nodata as nan, the pixels outside of the band are nan
+    windows = np.full((rows * factor, cols * factor), np.nan)
+    windows[:values.shape[0], :values.shape[1]] = values
+    if not np.issubdtype(values.dtype, np.floating):
+        windows[windows == get_nodata(gdal_output_type)] = np.nan
+    windows = windows.reshape(rows, factor, cols, factor)
+    counts = (~np.isnan(windows)).sum(axis=(1, 3))
+    averages = np.divide(np.nansum(windows, axis=(1, 3)), counts, out=np.full((rows, cols), np.nan),
+                         where=counts > 0)
+    return cast_output(averages, gdal_output_type)
+
+
+def build_overviews(raster, resampling, bands_values, gdal_output_type):
+    """
+    Build the overviews of the raster from the bands in memory (in the output
+    type), the overviews are created empty and filled without read the raster
+    """
+    levels = overview_levels(Image.wrapper_shape)
+    if not levels:
+        return
+    raster.BuildOverviews("NONE", levels)
+    for nband, values in enumerate(bands_values):
+        raster_band = raster.GetRasterBand(nband + 1)
+        for level, factor in enumerate(levels):
+            raster_band.GetOverview(level).WriteArray(downsample(values, factor, resampling, gdal_output_type))
+
+
+def remove_output(output):
+    """
+    Delete the output (GeoTIFF file or Zarr store) partially written, only
+    for the outputs created by the run
+    """
+    if os.path.isdir(output):
+        shutil.rmtree(output, ignore_errors=True)
+    elif os.path.isfile(output):
+        os.remove(output)
+
+
+def write_gtiff(output, output_array, gdal_output_type, band_names=None, metadata=None, statistics=True,
+                overviews=None):
+    """
+    Write the result (bands, y, x) in memory to a GeoTIFF file, with the
+    metadata (dict) of the dataset if it is defined. The statistics and the
+    histogram of the bands are computed while they are written, and the
+    overviews (resampling nearest or average) are built from the bands in memory
+    """
+    # create output raster
+    driver = gdal.GetDriverByName('GTiff')
+    nbands = output_array.shape[0]
+    outRaster = driver.Create(output, Image.wrapper_shape[1], Image.wrapper_shape[0],
+                              nbands, gdal_output_type)
+    output_statistics = OutputStatistics(nbands, gdal_output_type) if statistics else None
+    bands_values = []
+
+    for nband in range(nbands):
+        outband = outRaster.GetRasterBand(nband + 1)
+
+        # set nodata value depend of the output type
+        outband.SetNoDataValue(get_nodata(gdal_output_type))
+
+        # write band
+        outband.WriteArray(output_array[nband])
+        if band_names is not None:
+            outband.SetDescription(band_names[nband])
+
+        if output_statistics is not None or overviews:
+            # the values of the band as they are written
+            band_values = cast_output(output_array[nband], gdal_output_type)
+            if output_statistics is not None:
+                output_statistics.update(nband, band_values)
+                output_statistics.set_band(nband, outband)
+            if overviews:
+                bands_values.append(band_values)
+            del band_values
+
+    # set projection and geotransform
+    outRasterSRS = osr.SpatialReference()
+    outRasterSRS.ImportFromWkt(Image.projection)
+    outRaster.SetProjection(outRasterSRS.ExportToWkt())
+    outRaster.SetGeoTransform(get_geotransform())
+    if metadata:
+        outRaster.SetMetadata(metadata)
+
+    if overviews:
+        build_overviews(outRaster, overviews, bands_values, gdal_output_type)
+
+    # clean
+    del driver, outRaster, outband, outRasterSRS, bands_values
+
+
+def write_zarr(output, output_array, gdal_output_type, num_process, band_names=None, metadata=None,
+               statistics=True):
+    """
+    Compute and write the result (lazy dask array) to a chunked Zarr store,
+    each block of the statistic is computed and written by its own worker in
+    parallel, without a single writer. The geospatial metadata (CRS and
+    transform) and the coordinates are attached following the conventions
+    of xarray and the GDAL Zarr driver. The statistics of the bands are
+    accumulated from the blocks as they are written, they are returned and
+    attached to the store
+    """
+    import zarr
+
+    # the store is written in the Zarr format 2 (also with zarr-python 3), the
+    # format of the conventions of xarray (_ARRAY_DIMENSIONS) and GDAL (_CRS)
+    zarr_format = {"zarr_format": 2} if int(zarr.__version__.split(".")[0]) >= 3 else {}
+
+    nodata = get_nodata(gdal_output_type)
+    dtype = NUMPY_TYPES[gdal_output_type]
+    if not np.issubdtype(dtype, np.floating):
+        output_array = da.where(da.isnan(output_array), nodata, output_array)
+    output_array = output_array.astype(dtype)
+
+    output_statistics = OutputStatistics(output_array.shape[0], gdal_output_type) if statistics else None
+    if output_statistics is not None:
+        def accumulate(block, block_info=None):
+            first_band = block_info[0]["array-location"][0][0]
+            for nband in range(block.shape[0]):
+                output_statistics.update(first_band + nband, block[nband])
+            return block
+        output_array = output_array.map_blocks(accumulate, dtype=dtype)
+
+    # write the blocks in parallel, the zarr chunks are the same chunks of the statistic,
+    # if the process is canceled (or fails) the store is deleted only if it was created here
+    created = not os.path.exists(output)
+    try:
+        da.to_zarr(output_array, output, component=ZARR_ARRAY_NAME, overwrite=True, compute=False,
+                   fill_value=nodata, **zarr_format).compute(num_workers=num_process, scheduler="threads")
+    except Exception:
+        if created:
+            remove_output(output)
+        raise
+
+    # coordinates of the center of the pixels
+    min_x, x_res, _, max_y, _, y_res = get_geotransform()
+    coords = {"x": min_x + x_res * (np.arange(Image.wrapper_shape[1]) + 0.5),
+              "y": max_y + y_res * (np.arange(Image.wrapper_shape[0]) + 0.5),
+              "band": np.arange(1, output_array.shape[0] + 1)}
+    for name, values in coords.items():
+        da.to_zarr(da.from_array(values), output, component=name, overwrite=True, **zarr_format)
+        zarr.open_array(output, mode="a", path=name).attrs.update({"_ARRAY_DIMENSIONS": [name]})
+
+    zarr.open_array(output, mode="a", path=ZARR_ARRAY_NAME).attrs.update({
+        "_ARRAY_DIMENSIONS": ["band", "y", "x"],
+        "_CRS": {"wkt": Image.projection},
+        "crs_wkt": Image.projection,
+        "transform": list(get_geotransform()),
+        "band_names": list(band_names) if band_names is not None else None,
+        "metadata": dict(metadata) if metadata else None,
+        "statistics": [output_statistics.get(nband) for nband in range(output_array.shape[0])]
+        if output_statistics is not None else None,
+    })
+    zarr.consolidate_metadata(output)
+    return output_statistics
+
+
+def zarr_to_cog(zarr_output, cog_output, statistics=None):
+    """
+    Convert the Zarr store of the result to a Cloud Optimized GeoTIFF, with the
+    statistics of the bands accumulated when the store was written (in the PAM)
+    """
+    gdal.Translate(cog_output, 'ZARR:"{}":/{}'.format(zarr_output, ZARR_ARRAY_NAME), format="COG",
+                   outputSRS=Image.projection, creationOptions=["COMPRESS=DEFLATE", "BIGTIFF=IF_SAFER"])
+    if statistics is not None:
+        cog_raster = gdal.Open(cog_output, gdal.GA_ReadOnly)
+        for nband in range(cog_raster.RasterCount):
+            statistics.set_band(nband, cog_raster.GetRasterBand(nband + 1))
+        del cog_raster
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ StackComposed
+                          A QGIS plugin processing
+ Compute and generate the composed of a raster images stack
+                              -------------------
+        copyright            : (C) 2021-2022 by Xavier Corredor Llano, SMByC
+        email                : xavier.corredor.llano@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+Slow references by pixel of the statistics and the helpers to build the
+random stacks and the synthetic images of the tests
+"""
+import datetime
+import numpy as np
+from osgeo import gdal, osr
+
+from StackComposed.core.stats import HistogramPercentile
+
+# the in-memory directory for the synthetic images and outputs
+VSIMEM_DIR = "/vsimem/StackComposed_tests"
+
+# the nan patterns of the random stacks
+NAN_PATTERNS = ["dense", "random", "empty_pixels", "empty_layers", "single_valid"]
+
+# the integer data types of the random stacks (the values are read as float)
+DATA_TYPES = [np.uint8, np.uint16, np.int16]
+
+
+# the slow references of the statistics by pixel: (values, dates, jdays, weights)
+# with the time series of the pixel (nan as nodata), the dates as days since
+# 1970-01-01, and return the value of the statistic (or a list for several bands)
+def ref_gmean(values, dates, jdays, weights):
+    valid = values[~np.isnan(values)]
+    # the product includes the zeros but the count does not, and a result of 1 is nodata
+    product = np.float64(np.prod(valid))
+    with np.errstate(divide="ignore"):
+        result = product ** (np.float64(1.0) / np.count_nonzero(valid))
+    return np.nan if result == 1 else result
+
+
+def ref_percentile(p):
+    def reference(values, dates, jdays, weights):
+        valid = values[~np.isnan(values)]
+        return np.percentile(valid, p) if valid.size else np.nan
+    return reference
+
+
+def ref_approx_percentile(p):
+    def reference(values, dates, jdays, weights):
+        # the values outside of the range of the histograms are in the first or last bin
+        valid = np.clip(values[~np.isnan(values)], *HistogramPercentile.value_range)
+        return np.percentile(valid, p) if valid.size else np.nan
+    return reference
+
+
+def ref_weighted_mean(values, dates, jdays, weights):
+    valid = ~np.isnan(values)
+    total = weights[valid].sum()
+    return (weights[valid] * values[valid]).sum() / total if total > 0 else np.nan
+
+
+def ref_weighted_median(values, dates, jdays, weights):
+    valid = ~np.isnan(values)
+    order = np.argsort(values[valid], kind="stable")
+    sorted_values, sorted_weights = values[valid][order], weights[valid][order]
+    total = sorted_weights.sum()
+    if total <= 0:
+        return np.nan
+    cumulative = 0
+    for k, (value, weight) in enumerate(zip(sorted_values, sorted_weights)):
+        cumulative += weight
+        if cumulative == total / 2:
+            # exactly the half of the weight, the mean with the next value
+            return (value + sorted_values[k + 1]) / 2
+        if cumulative > total / 2:
+            return value
+
+
+def ref_last_index(values, dates):
+    last = None
+    for t in range(len(values)):
+        # the last layer in the stack for the same dates
+        if not np.isnan(values[t]) and (last is None or dates[t] >= dates[last]):
+            last = t
+    return last
+
+
+def ref_last_pixel(values, dates, jdays, weights):
+    last = ref_last_index(values, dates)
+    return values[last] if last is not None else np.nan
+
+
+def ref_jday_last_pixel(values, dates, jdays, weights):
+    last = ref_last_index(values, dates)
+    return jdays[last] if last is not None else 0
+
+
+def ref_jday_median(values, dates, jdays, weights):
+    valid_jdays = jdays[~np.isnan(values)]
+    return np.ceil(np.median(valid_jdays)) if valid_jdays.size else 0
+
+
+def ref_trim_mean(lower, upper):
+    def reference(values, dates, jdays, weights):
+        valid = values[~np.isnan(values)]
+        if not valid.size:
+            return 0
+        if valid.size <= 2:
+            return np.percentile(valid, (lower + upper) / 2)
+        inside = valid[(valid >= np.percentile(valid, lower)) & (valid <= np.percentile(valid, upper))]
+        return inside.mean()
+    return reference
+
+
+def ref_linear_trend(values, dates, jdays, weights):
+    valid = ~np.isnan(values)
+    if valid.sum() <= 1:
+        return np.nan
+    x, y = dates[valid], values[valid]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.polyfit(x - x.mean(), y, 1)[0] * 1000000 if np.ptp(x) > 0 else np.nan
+
+
+def ref_harmonic(harmonics):
+    def reference(values, dates, jdays, weights):
+        valid = ~np.isnan(values)
+        years = dates[valid] / 365.25
+        design = [np.ones(valid.sum()), years]
+        for k in range(1, harmonics + 1):
+            design += [np.cos(2 * np.pi * k * years), np.sin(2 * np.pi * k * years)]
+        design = np.stack(design, axis=1)
+        n_coefficients = design.shape[1]
+        # the pixels without enough valid values or singular (e.g. repeated dates) are not compared
+        if valid.sum() <= n_coefficients or np.linalg.matrix_rank(design) < n_coefficients:
+            return [None] * (n_coefficients + 1)
+        coefficients = np.linalg.lstsq(design, values[valid], rcond=None)[0]
+        rmse = np.sqrt(((values[valid] - design @ coefficients) ** 2).mean())
+        return list(coefficients) + [rmse]
+    return reference
+
+
+REFERENCES = {
+    "median": lambda values, dates, jdays, weights: np.nanmedian(values) if (~np.isnan(values)).any() else np.nan,
+    "mean": lambda values, dates, jdays, weights: np.nanmean(values) if (~np.isnan(values)).any() else np.nan,
+    "gmean": ref_gmean,
+    "max": lambda values, dates, jdays, weights: np.nanmax(values) if (~np.isnan(values)).any() else np.nan,
+    "min": lambda values, dates, jdays, weights: np.nanmin(values) if (~np.isnan(values)).any() else np.nan,
+    "std": lambda values, dates, jdays, weights: np.nanstd(values) if (~np.isnan(values)).any() else np.nan,
+    "valid_pixels": lambda values, dates, jdays, weights: (~np.isnan(values)).sum(),
+    "percentile_10": ref_percentile(10),
+    "percentile_90": ref_percentile(90),
+    "approx_median": ref_approx_percentile(50),
+    "approx_percentile_25": ref_approx_percentile(25),
+    "weighted_mean": ref_weighted_mean,
+    "weighted_median": ref_weighted_median,
+    "harmonic": ref_harmonic(1),
+    "harmonic_2": ref_harmonic(2),
+    "last_pixel": ref_last_pixel,
+    "jday_last_pixel": ref_jday_last_pixel,
+    "jday_median": ref_jday_median,
+    "trim_mean_10_90": ref_trim_mean(10, 90),
+    "linear_trend": ref_linear_trend,
+}
+
+
+def tolerance(stat, values):
+    """
+    The absolute tolerance of the statistic for the values of the stack
+    """
+    if stat.startswith("approx_"):
+        # the error of the histograms is less than the width of the bins
+        return (HistogramPercentile.value_range[1] - HistogramPercentile.value_range[0]) / HistogramPercentile.bins
+    scale = np.nanmax(np.abs(values)) if (~np.isnan(values)).any() else 1
+    if stat.startswith("harmonic") or stat == "linear_trend":
+        return 1e-6 * max(scale, 1) * 1000
+    return 1e-9 * max(scale, 1)
+
+
+def reference_statistic(stat, stack, dates, jdays, weights=None):
+    """
+    Compute the statistic with the reference by pixel, the result is (bands, y, x)
+    with nan in the pixels not compared
+    """
+    reference = REFERENCES[stat]
+    days = dates.astype("datetime64[D]").astype(np.float64)
+    weights = np.ones(stack.shape[2]) if weights is None else weights
+    pixels = []
+    for y, x in np.ndindex(stack.shape[0:2]):
+        pixel_weights = weights[y, x] if weights.ndim == 3 else weights
+        value = np.atleast_1d(np.array(reference(stack[y, x], days, jdays.astype(np.float64), pixel_weights),
+                                       dtype=object))
+        pixels.append([np.nan if item is None else item for item in value])
+    return np.array(pixels, dtype=float).T.reshape((-1,) + stack.shape[0:2])
+
+
+def compare(stat, result, expected, values):
+    """
+    The number of pixels different to the reference and the maximum error
+    """
+    result = np.asarray(result, dtype=float).reshape(expected.shape)
+    # the pixels without enough valid values or singular are not compared for the harmonic regression
+    compared = ~np.isnan(expected) if stat.startswith("harmonic") else np.ones(expected.shape, dtype=bool)
+    same = np.isclose(result, expected, rtol=0, atol=tolerance(stat, values), equal_nan=True)
+    errors = compared & ~same
+    max_error = np.nanmax(np.abs(result - expected)[errors]) if errors.any() else 0
+    return int(errors.sum()), max_error
+
+
+def random_stack(rng, shape, nan_pattern, data_type):
+    """
+    Random stack (y, x, t) of integer values of the data type (as float with
+    nan as nodata) with the nan pattern, and the random dates (with repeated
+    dates) and julian days of the layers
+    """
+    info = np.iinfo(data_type)
+    stack = rng.integers(max(info.min, -2000), min(info.max, 12000), size=shape, endpoint=True).astype(np.float64)
+    if nan_pattern == "random":
+        stack[rng.random(shape) < rng.uniform(0.1, 0.9)] = np.nan
+    elif nan_pattern == "empty_pixels":
+        stack[rng.random(shape) < 0.3] = np.nan
+        stack[rng.random(shape[0:2]) < 0.3] = np.nan
+    elif nan_pattern == "empty_layers":
+        stack[rng.random(shape) < 0.2] = np.nan
+        stack[:, :, rng.random(shape[2]) < 0.4] = np.nan
+    elif nan_pattern == "single_valid":
+        valid_layer = rng.integers(0, shape[2], size=shape[0:2])
+        stack[np.arange(shape[2]) != valid_layer[:, :, np.newaxis]] = np.nan
+    days = rng.choice(rng.integers(0, 365 * 20, size=max(2, shape[2] - 1)), size=shape[2])
+    dates = np.datetime64("2000-01-01") + days.astype("timedelta64[D]")
+    jdays = np.array([date.timetuple().tm_yday for date in dates.astype(datetime.date)], dtype=np.int16)
+    return stack, dates, jdays
+
+
+def create_image(path, data, x_off, y_off, x_res=30, origin=(500000, 1000000), nodata=0):
+    """
+    Create the GeoTIFF (UInt16) of the data (nan as nodata) in the position
+    (x_off, y_off) of the pixels of the grid
+    """
+    raster = gdal.GetDriverByName("GTiff").Create(path, data.shape[1], data.shape[0], 1, gdal.GDT_UInt16)
+    raster.SetGeoTransform((origin[0] + x_off * x_res, x_res, 0, origin[1] - y_off * x_res, 0, -x_res))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32618)
+    raster.SetProjection(srs.ExportToWkt())
+    band = raster.GetRasterBand(1)
+    band.SetNoDataValue(nodata)
+    band.WriteArray(np.nan_to_num(data, nan=nodata).astype(np.uint16))
+    del raster, band
+
+
+def synthetic_images(rng, n_images, wrapper_shape):
+    """
+    Create the synthetic images (Landsat filenames with its dates) with
+    random extents inside the wrapper, return the paths, the full stack
+    (y, x, t) in the wrapper (nan as nodata), the dates and julian days
+    """
+    paths = []
+    stack = np.full(wrapper_shape + (n_images,), np.nan)
+    dates = np.datetime64("2015-01-01") + np.sort(rng.choice(3650, n_images, replace=False)).astype("timedelta64[D]")
+    for k in range(n_images):
+        if k < 2:
+            # the first images define the corners of the wrapper
+            y_off, x_off = (0, 0) if k == 0 else (wrapper_shape[0] // 2, wrapper_shape[1] // 2)
+            rows, cols = wrapper_shape[0] - y_off, wrapper_shape[1] - x_off
+        else:
+            rows, cols = int(rng.integers(1, wrapper_shape[0] + 1)), int(rng.integers(1, wrapper_shape[1] + 1))
+            y_off, x_off = int(rng.integers(0, wrapper_shape[0] - rows + 1)), int(rng.integers(0, wrapper_shape[1] - cols + 1))
+        data = rng.integers(1, 10000, size=(rows, cols)).astype(np.float64)
+        data[rng.random((rows, cols)) < 0.2] = np.nan
+        stack[y_off:y_off + rows, x_off:x_off + cols, k] = data
+        path = "{}/LC08_L1TP_{:03d}059_{}_20200101_02_T1_SR_B4.tif".format(
+            VSIMEM_DIR, k + 1, str(dates[k]).replace("-", ""))
+        create_image(path, data, x_off, y_off)
+        paths.append(path)
+    jdays = np.array([date.timetuple().tm_yday for date in dates.astype(datetime.date)], dtype=np.int16)
+    return paths, stack, dates, jdays
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ StackComposed
+                          A QGIS plugin processing
+ Compute and generate the composed of a raster images stack
+                              -------------------
+        copyright            : (C) 2021-2022 by Xavier Corredor Llano, SMByC
+        email                : xavier.corredor.llano@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+Tests of the local cache of the chunks stacks
+"""
+import os
+import time
+import numpy as np
+import pytest
+
+pytest.importorskip("osgeo")
+
+from StackComposed.core.chunk_cache import ChunkCache
+from StackComposed.core.dedupe import MergedImage
+from StackComposed.core.image import Image
+
+
+def local_image(path):
+    """
+    Image of a local file with the properties used by the cache, without open it
+    """
+    image = Image.__new__(Image)
+    image.file_path = str(path)
+    image.extent, image.x_res, image.y_res, image.n_bands = [0, 10, 10, 0], 1, 1, 1
+    image.layers, image.nodata, image.warped = [1], [None], False
+    for name in ["data_types", "projection", "filename_metadata", "datetime_tag", "band_dates", "time_units",
+                 "layers_metadata"]:
+        setattr(image, name, None)
+    return image
+
+
+def test_inputs_key_of_merged_scenes(tmp_path):
+    paths = [tmp_path / "scene_1.tif", tmp_path / "scene_2.tif"]
+    [path.write_bytes(b"scene") for path in paths]
+    merged_image = MergedImage([local_image(path) for path in paths])
+    key = ChunkCache.make_inputs_key([merged_image])
+    assert ChunkCache.make_inputs_key([merged_image]) == key
+
+    # a change in any file of the merged scenes changes the key
+    paths[1].write_bytes(b"scene changed")
+    assert ChunkCache.make_inputs_key([merged_image]) != key
+
+
+def test_put_same_window(tmp_path):
+    chunk_cache = ChunkCache(str(tmp_path), 2**30, "inputs")
+    stack = np.random.default_rng(0).uniform(0, 1, size=(8, 9, 5))
+    stack[0, 0] = np.nan
+    chunk_cache.put((0, 9, 0, 8, ()), stack)
+    chunk_cache.put((0, 9, 0, 8, ()), stack)
+    assert chunk_cache._size == sum(path.stat().st_size for path in tmp_path.glob("*.npz"))
+
+    # the stack is saved in its own data type without loss
+    cached = chunk_cache.get((0, 9, 0, 8, ()))
+    assert cached.dtype == stack.dtype
+    np.testing.assert_array_equal(cached, stack)
+
+
+def test_stale_temporary_files(tmp_path):
+    chunk_cache = ChunkCache(str(tmp_path), 2**30, "inputs")
+    chunk_cache.put((0, 9, 0, 8, ()), np.zeros((8, 9, 5)))
+    # a temporary file left by an interrupted run
+    stale_path = tmp_path / "stale.1234.tmp.npz"
+    stale_path.write_bytes(b"0" * 1000)
+    os.utime(stale_path, (time.time() - 60, time.time() - 60))
+
+    chunk_cache = ChunkCache(str(tmp_path), 2**30, "inputs")
+    assert not stale_path.exists()
+    assert chunk_cache._size == sum(path.stat().st_size for path in tmp_path.glob("*.npz"))
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ StackComposed
+                          A QGIS plugin processing
+ Compute and generate the composed of a raster images stack
+                              -------------------
+        copyright            : (C) 2021-2022 by Xavier Corredor Llano, SMByC
+        email                : xavier.corredor.llano@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+Tests of the chunks of the images adjusted into the wrapper against the
+windows of the full stack, for random images and windows (inside, across the
+edges and outside of the images)
+"""
+import os
+import numpy as np
+import pytest
+
+gdal = pytest.importorskip("osgeo.gdal")
+
+from references import VSIMEM_DIR, create_image, synthetic_images
+from StackComposed.core.image import Image
+
+WRAPPER_SHAPE = (37, 53)
+
+
+@pytest.fixture(scope="module")
+def images_in_wrapper():
+    rng = np.random.default_rng(0)
+    paths, stack, _, _ = synthetic_images(rng, 6, WRAPPER_SHAPE)
+    images = [Image(path) for path in paths]
+    Image.wrapper_extent = [min(image.extent[0] for image in images), max(image.extent[1] for image in images),
+                            max(image.extent[2] for image in images), min(image.extent[3] for image in images)]
+    Image.wrapper_x_res, Image.wrapper_y_res = images[0].x_res, images[0].y_res
+    Image.wrapper_shape = WRAPPER_SHAPE
+    Image.nodata_from_arg = None
+    [image.set_bounds() for image in images]
+    yield images, stack
+    [image.close() for image in images]
+    [gdal.Unlink(path) for path in paths]
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_get_chunk_in_wrapper(images_in_wrapper, seed):
+    images, stack = images_in_wrapper
+    rng = np.random.default_rng(seed)
+    yc_size, xc_size = int(rng.integers(1, WRAPPER_SHAPE[0] + 1)), int(rng.integers(1, WRAPPER_SHAPE[1] + 1))
+    yc, xc = int(rng.integers(0, WRAPPER_SHAPE[0] - yc_size + 1)), int(rng.integers(0, WRAPPER_SHAPE[1] - xc_size + 1))
+    for k, image in enumerate(images):
+        chunk = image.get_chunk_in_wrapper([1], xc, xc_size, yc, yc_size)
+        expected = stack[yc:yc + yc_size, xc:xc + xc_size, k]
+        if chunk is None:
+            assert np.isnan(expected).all(), "image {} without chunk in {}".format(
+                k + 1, (xc, xc_size, yc, yc_size))
+        else:
+            assert np.array_equal(chunk[:, :, 0], expected, equal_nan=True), "image {} different in {}".format(
+                k + 1, (xc, xc_size, yc, yc_size))
+
+
+def test_warp_masks_the_nodata_before_resampling():
+    # the nodata of the file (0) and the nodata from arguments (7) are not averaged
+    data = np.array([[0, 7, 10, 30],
+                     [10, 20, 0, 0],
+                     [7, 7, 1, 2],
+                     [7, 0, 3, 4]], dtype=np.float64)
+    path = VSIMEM_DIR + "/warp_nodata.tif"
+    # the origin aligned to the target pixel size
+    create_image(path, np.where(data == 0, np.nan, data), 0, 0, origin=(600000, 1200000), nodata=0)
+    Image.nodata_from_arg = 7
+    image = Image(path)
+    try:
+        image.warp(image.projection, 60, 60, "average")
+        chunk = image.get_chunk([1], 0, 2, 0, 2)[:, :, 0]
+    finally:
+        image.close()
+        Image.nodata_from_arg = None
+        gdal.Unlink(path)
+    np.testing.assert_allclose(chunk, [[(10 + 20) / 2, (10 + 30) / 2], [np.nan, (1 + 2 + 3 + 4) / 4]])
+
+
+@pytest.mark.parametrize("bands", [[2], [1, 2, 3], [2, 3], [1, 3], [3, 1]])
+@pytest.mark.parametrize("interleave", ["bsq", "bil", "bip"])
+def test_get_chunk_from_envi_memmap(tmp_path, interleave, bands):
+    data = np.random.default_rng(0).integers(0, 10000, size=(3, 7, 9)).astype(np.uint16)
+    axes = {"bsq": (0, 1, 2), "bil": (1, 0, 2), "bip": (1, 2, 0)}[interleave]
+    path = tmp_path / "image.img"
+    np.ascontiguousarray(data.transpose(axes)).astype("<u2").tofile(path)
+    (tmp_path / "image.hdr").write_text("ENVI\nsamples = 9\nlines = 7\nbands = 3\nheader offset = 0\n"
+                                        "data type = 12\ninterleave = {}\nbyte order = 0\n".format(interleave))
+    metadata = {"extent": [0, 7, 9, 0], "x_res": 1, "y_res": 1, "n_bands": 3, "data_types": ["UInt16"] * 3,
+                "nodata": [None] * 3, "projection": "", "filename_metadata": None}
+    image = Image(str(path), metadata)
+    assert image.get_memmap() is not None
+    chunk = image.get_chunk(bands, 2, 5, 1, 4)
+    image.close()
+    assert chunk.dtype == np.float32
+    np.testing.assert_array_equal(chunk, np.moveaxis(data[[band - 1 for band in bands], 1:5, 2:7], 0, 2))
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc/self/fd"), reason="requires /proc/self/fd")
+def test_envi_memmap_without_open_files(tmp_path):
+    metadata = {"extent": [0, 4, 4, 0], "x_res": 1, "y_res": 1, "n_bands": 1, "data_types": ["Byte"],
+                "nodata": [None], "projection": "", "filename_metadata": None}
+    images = []
+    for k in range(20):
+        path = tmp_path / "image_{}.img".format(k)
+        np.full((4, 4), k, dtype=np.uint8).tofile(path)
+        (tmp_path / "image_{}.hdr".format(k)).write_text(
+            "ENVI\nsamples = 4\nlines = 4\nbands = 1\ndata type = 1\ninterleave = bsq\n")
+        images.append(Image(str(path), metadata))
+    open_files = len(os.listdir("/proc/self/fd"))
+    chunks = [image.get_chunk([1], 0, 4, 0, 4) for image in images]
+    # the maps are released after read the windows
+    assert len(os.listdir("/proc/self/fd")) <= open_files
+    assert [chunk[0, 0, 0] for chunk in chunks] == list(range(20))
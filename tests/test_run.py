@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ StackComposed
+                          A QGIS plugin processing
+ Compute and generate the composed of a raster images stack
+                              -------------------
+        copyright            : (C) 2021-2022 by Xavier Corredor Llano, SMByC
+        email                : xavier.corredor.llano@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+Tests of the whole run over synthetic GeoTIFFs against the references over
+the full stack, for several chunks sizes and number of workers
+"""
+import numpy as np
+import pytest
+
+gdal = pytest.importorskip("osgeo.gdal")
+osr = pytest.importorskip("osgeo.osr")
+qgis_core = pytest.importorskip("qgis.core")
+
+from references import REFERENCES, VSIMEM_DIR, reference_statistic, compare, synthetic_images
+from StackComposed.core import stack_composed
+from StackComposed.core.image import Image
+from StackComposed.core.stats import get_statistic
+
+WRAPPER_SHAPE = (41, 47)
+
+
+@pytest.fixture(scope="module")
+def synthetic_stack():
+    rng = np.random.default_rng(0)
+    paths, stack, dates, jdays = synthetic_images(rng, 9, WRAPPER_SHAPE)
+    layer_weights = rng.uniform(0.1, 2, size=len(paths))
+    yield paths, stack, dates, jdays, layer_weights
+    [gdal.Unlink(path) for path in paths]
+
+
+@pytest.mark.parametrize("num_process", [1, 4])
+@pytest.mark.parametrize("chunksize", [5, 16, 1000])
+@pytest.mark.parametrize("stat", list(REFERENCES))
+def test_run(synthetic_stack, stat, chunksize, num_process):
+    paths, stack, dates, jdays, layer_weights = synthetic_stack
+    weights = layer_weights if "weight" in get_statistic(stat).metadata else None
+    expected = reference_statistic(stat, stack, dates, jdays, weights)
+    output = VSIMEM_DIR + "/output.tif"
+
+    stack_composed.run(stat=stat, band=1, nodata=None, output=output, output_type="Float64",
+                       num_process=num_process, chunksize=chunksize, images_files=paths,
+                       feedback=qgis_core.QgsProcessingFeedback(),
+                       weights=", ".join(str(weight) for weight in weights) if weights is not None else None,
+                       output_statistics=False)
+    raster = gdal.Open(output)
+    result = raster.ReadAsArray().reshape(expected.shape)
+    del raster
+    gdal.Unlink(output)
+    different, max_error = compare(stat, result, expected, stack)
+    assert not different, "{} pixels different (max error {})".format(different, max_error)
+
+
+class CancelFeedback(qgis_core.QgsProcessingFeedback):
+    """
+    Feedback that cancels the run when the processing of the statistic starts
+    """
+
+    def setProgressText(self, text):
+        super().setProgressText(text)
+        if text.startswith("Processing"):
+            self.cancel()
+
+
+def test_cancel_keeps_existing_output(synthetic_stack, tmp_path):
+    paths = synthetic_stack[0]
+    output = tmp_path / "output.tif"
+    output.write_bytes(b"existing output")
+
+    stack_composed.run(stat="median", band=1, nodata=None, output=str(output), output_type="Float64",
+                       num_process=2, chunksize=5, images_files=paths, feedback=CancelFeedback(),
+                       output_statistics=False)
+    assert output.read_bytes() == b"existing output"
+
+
+def test_cancel_removes_created_zarr(synthetic_stack, tmp_path):
+    pytest.importorskip("zarr")
+    paths = synthetic_stack[0]
+    output = tmp_path / "output.zarr"
+
+    stack_composed.run(stat="median", band=1, nodata=None, output=str(output), output_type="Float64",
+                       num_process=2, chunksize=5, images_files=paths, feedback=CancelFeedback(),
+                       output_statistics=False)
+    assert not output.exists()
+
+
+def test_target_extent_without_warping(synthetic_stack, monkeypatch):
+    paths, stack, dates, jdays, _ = synthetic_stack
+
+    def warp(*args, **kwargs):
+        raise AssertionError("the images in the target grid must not be warped")
+    monkeypatch.setattr(Image, "warp", warp)
+
+    # the same projection and pixel size of the images, and an extent not aligned to the pixels
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32618)
+    target_extent = [500000 + 30 * 3.4, 1000000 - 30 * 2.2, 500000 + 30 * 20.5, 1000000 - 30 * 30.1]
+    output = VSIMEM_DIR + "/output.tif"
+    stack_composed.run(stat="median", band=1, nodata=None, output=output, output_type="Float64", num_process=2,
+                       chunksize=7, images_files=paths, feedback=qgis_core.QgsProcessingFeedback(),
+                       target_crs=srs.ExportToWkt(), target_res=30, target_extent=target_extent,
+                       output_statistics=False)
+    raster = gdal.Open(output)
+    geotransform, result = raster.GetGeoTransform(), raster.ReadAsArray()
+    del raster
+    gdal.Unlink(output)
+
+    # clipped to the pixels of the images that touch the extent
+    assert geotransform == (500000 + 30 * 3, 30, 0, 1000000 - 30 * 2, 0, -30)
+    expected = reference_statistic("median", stack[2:31, 3:21], dates, jdays)
+    different, max_error = compare("median", result, expected, stack)
+    assert not different, "{} pixels different (max error {})".format(different, max_error)
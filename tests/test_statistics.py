@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ StackComposed
+                          A QGIS plugin processing
+ Compute and generate the composed of a raster images stack
+                              -------------------
+        copyright            : (C) 2021-2022 by Xavier Corredor Llano, SMByC
+        email                : xavier.corredor.llano@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+Tests of the reducers of the statistics (with the fast paths: identity,
+dense and streaming) against the slow references by pixel over random
+stacks with several nan patterns, dates and integer types
+"""
+import functools
+import numpy as np
+import pytest
+
+pytest.importorskip("osgeo")
+
+from references import REFERENCES, NAN_PATTERNS, DATA_TYPES, reference_statistic, compare, random_stack
+from StackComposed.core.band_math import BandExpression
+from StackComposed.core.stats import get_statistic, approx_percentile, make_expression_statistic, HistogramPercentile
+
+
+@functools.lru_cache(maxsize=None)
+def make_statistic(stat):
+    # the statistics are made once, the kernels are compiled with numba when they are made
+    return get_statistic(stat)
+
+
+@pytest.mark.parametrize("data_type", DATA_TYPES, ids=lambda data_type: np.dtype(data_type).name)
+@pytest.mark.parametrize("nan_pattern", NAN_PATTERNS)
+@pytest.mark.parametrize("seed", range(4))
+@pytest.mark.parametrize("stat", list(REFERENCES))
+def test_statistic(stat, seed, nan_pattern, data_type):
+    statistic = make_statistic(stat)
+    rng = np.random.default_rng(seed)
+    depth = int(rng.choice([1, 2, 3, 7, 24]))
+    shape = (int(rng.integers(1, 9)), int(rng.integers(1, 9)), depth)
+    stack, dates, jdays = random_stack(rng, shape, nan_pattern, data_type)
+    layer_weights = rng.uniform(0, 2, size=depth)
+    pixel_weights = layer_weights * rng.integers(0, 3, size=shape)
+
+    for weights in ([layer_weights, pixel_weights] if "weight" in statistic.metadata else [None]):
+        metadata = {"date": dates, "jday": jdays}
+        if weights is not None:
+            metadata["weight"] = weights
+        expected = reference_statistic(stat, stack, dates, jdays, weights)
+        for covered in [False, True]:
+            result = statistic.reduce(stack, metadata, covered)
+            different, max_error = compare(stat, result, expected, stack)
+            assert not different, "{} pixels different (max error {}) for the shape {}, weights={}, covered={}".format(
+                different, max_error, shape, None if weights is None else weights.ndim, covered)
+
+
+def test_approx_percentile_range_of_the_run():
+    stack = np.random.default_rng(0).uniform(0, 100, size=(5, 6, 40))
+    statistic = approx_percentile("approx_percentile_25", value_range=(0, 100), bins=50)
+    result = statistic.reduce(stack, {}, True)
+    np.testing.assert_allclose(result, np.percentile(stack, 25, axis=2), atol=100 / 50)
+    # the defaults of the histograms are not changed for the next runs
+    assert (HistogramPercentile.value_range, HistogramPercentile.bins) == ((0, 10000), 500)
+
+
+def test_expression_statistic_is_not_registered():
+    statistic = make_expression_statistic("np.nanmax(stack, axis=2) - np.nanmin(stack, axis=2)")
+    stack = np.random.default_rng(0).uniform(0, 100, size=(3, 4, 5))
+    np.testing.assert_allclose(statistic.reduce(stack, {}, True), np.ptp(stack, axis=2))
+    assert get_statistic("median").name == "median"
+    with pytest.raises(ValueError):
+        get_statistic("custom")
+
+
+@pytest.mark.parametrize("expression", ["stack.__class__", "np._core", "__import__('os')", "_stack + 1"])
+def test_expression_private_names(expression):
+    with pytest.raises(ValueError):
+        make_expression_statistic(expression)
+    with pytest.raises(ValueError):
+        BandExpression(expression.replace("stack", "b1"))
+
+
+@pytest.mark.parametrize("expression", ["np.save('out', stack)", "np.load('in.npy')", "np.fromfile('in.raw')",
+                                        "np.lib.npyio.save('out', stack)", "stack.tofile('out')", "np",
+                                        "np.nanmax(stack, axis=2) + np.sum(np, axis=0)"])
+def test_expression_numpy_names(expression):
+    with pytest.raises(ValueError):
+        make_expression_statistic(expression)
+    with pytest.raises(ValueError):
+        BandExpression(expression.replace("stack", "b1"))
+
+
+def test_expression_allowed_numpy_names():
+    statistic = make_expression_statistic("np.nanmean(np.where(stack > 50, stack, np.nan), axis=2)")
+    stack = np.random.default_rng(0).uniform(0, 100, size=(3, 4, 5))
+    np.testing.assert_allclose(statistic.reduce(stack, {}, True),
+                               np.nanmean(np.where(stack > 50, stack, np.nan), axis=2))
+    assert BandExpression("np.sqrt(b2.astype(np.float64)) / np.nanmax(b1.shape)").bands == [1, 2]
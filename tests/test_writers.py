@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ StackComposed
+                          A QGIS plugin processing
+ Compute and generate the composed of a raster images stack
+                              -------------------
+        copyright            : (C) 2021-2022 by Xavier Corredor Llano, SMByC
+        email                : xavier.corredor.llano@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+Tests of the writers of the output
+"""
+import numpy as np
+import pytest
+
+gdal = pytest.importorskip("osgeo.gdal")
+zarr = pytest.importorskip("zarr")
+da = pytest.importorskip("dask.array")
+
+from StackComposed.core.image import Image
+from StackComposed.core.writers import write_zarr, ZARR_ARRAY_NAME, NUMPY_TYPES
+
+
+@pytest.fixture
+def wrapper():
+    Image.wrapper_extent = [500000, 1000000, 500000 + 30 * 23, 1000000 - 30 * 17]
+    Image.wrapper_x_res, Image.wrapper_y_res = 30, 30
+    Image.wrapper_shape = (17, 23)
+    Image.projection = 'PROJCS["WGS 84 / UTM zone 18N",GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,' \
+                       '298.257223563]],PRIMEM["Greenwich",0],UNIT["degree",0.0174532925199433]],' \
+                       'PROJECTION["Transverse_Mercator"],PARAMETER["central_meridian",-75],' \
+                       'PARAMETER["scale_factor",0.9996],PARAMETER["false_easting",500000],UNIT["metre",1]]'
+
+
+@pytest.mark.parametrize("output_type", ["UInt16", "Float32"])
+def test_write_zarr_dimensions_and_coordinates(wrapper, tmp_path, output_type):
+    gdal_output_type = getattr(gdal, "GDT_" + output_type)
+    output = str(tmp_path / "output.zarr")
+    values = np.random.default_rng(0).uniform(1, 1000, size=(2,) + Image.wrapper_shape)
+    write_zarr(output, da.from_array(values, chunks=(1, 5, 7)), gdal_output_type, 2, band_names=["a", "b"])
+
+    group = zarr.open_group(output, mode="r")
+    assert group.metadata.zarr_format == 2
+    composed = group[ZARR_ARRAY_NAME]
+    assert composed.shape == (2,) + Image.wrapper_shape
+    assert composed.attrs["_ARRAY_DIMENSIONS"] == ["band", "y", "x"]
+    assert composed.attrs["_CRS"]["wkt"] == Image.projection
+    np.testing.assert_allclose(composed[:], values.astype(NUMPY_TYPES[gdal_output_type]))
+    for name in ["x", "y", "band"]:
+        assert group[name].attrs["_ARRAY_DIMENSIONS"] == [name]
+    np.testing.assert_allclose(group["x"][:], 500000 + 30 * (np.arange(23) + 0.5))
+    np.testing.assert_allclose(group["y"][:], 1000000 - 30 * (np.arange(17) + 0.5))
+    np.testing.assert_array_equal(group["band"][:], [1, 2])
+
+    xr = pytest.importorskip("xarray")
+    dataset = xr.open_zarr(output)
+    assert dataset[ZARR_ARRAY_NAME].dims == ("band", "y", "x")
+    np.testing.assert_allclose(dataset["x"].values, group["x"][:])
+    np.testing.assert_allclose(dataset["y"].values, group["y"][:])
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ StackComposed
+                          A QGIS plugin processing
+ Compute and generate the composed of a raster images stack
+                              -------------------
+        copyright            : (C) 2021-2022 by Xavier Corredor Llano, SMByC
+        email                : xavier.corredor.llano@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+def parallel_map(func, items, num_workers=None, feedback=None):
+    """
+    Apply the function to all items in a thread pool, streaming the progress
+    through the feedback. Return the results and the errors (exceptions) by
+    position, the result is None for the items with errors
+    """
+    results = [None] * len(items)
+    errors = {}
+    if not items:
+        return results, errors
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = {executor.submit(func, item): idx for idx, item in enumerate(items)}
+        for done, future in enumerate(as_completed(futures), start=1):
+            idx = futures[future]
+            try:
+                results[idx] = future.result()
+            except Exception as err:
+                errors[idx] = err
+            if feedback is not None:
+                if feedback.isCanceled():
+                    for pending in futures:
+                        pending.cancel()
+                    break
+                feedback.setProgress(int(100 * done / len(items)))
+
+    return results, errors
@@ -1,3 +1,5 @@
+import datetime
+import sys
 import threading
 import time
 from timeit import default_timer
@@ -5,16 +7,46 @@ from timeit import default_timer
 from dask.callbacks import Callback
 
 
+def memory_usage():
+    """
+    The memory used by the process in bytes and its description, the resident
+    memory with psutil or the peak memory without it, None if it is unknown
+    """
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss, "memory"
+    except ImportError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None, None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # in kilobytes in Linux and bytes in macOS
+    return max_rss if sys.platform == "darwin" else max_rss * 1024, "peak memory"
+
+
 class ProgressBar(Callback):
-    def __init__(self, minimum=0, dt=0.1, feedback=None):
+    """
+    Progress of the dask computation through the feedback, the tasks are
+    weighted by the expected cost of its chunk (the costs by block index
+    (y, x), such as the pixels by layers read), then the empty chunks do not
+    advance the progress as the dense ones. The rate, ETA and memory are
+    pushed as info each info_interval seconds (0 for disable it)
+    """
+
+    def __init__(self, minimum=0, dt=0.1, feedback=None, costs=None, info_interval=60):
         self._minimum = minimum
         self._dt = dt
         self._feedback = feedback
+        self._costs = costs or {}
+        self._info_interval = info_interval
         self.last_duration = 0
 
     def _start(self, dsk):
         self._state = None
         self._start_time = default_timer()
+        self._last_info = self._start_time
         # Start background thread
         self._running = True
         self._timer = threading.Thread(target=self._timer_func)
@@ -44,17 +76,58 @@ class ProgressBar(Callback):
                 self._update_bar()
             time.sleep(self._dt)
 
+    def _block_index(self, key):
+        # the keys of the chunks tasks are (name, band, y, x)
+        if isinstance(key, tuple) and len(key) >= 3 and key[-2:] in self._costs:
+            return key[-2:]
+
+    def _progress(self, state):
+        """
+        The fraction of the work done weighted by the cost of the tasks, by
+        the number of tasks without costs, and the blocks finished
+        """
+        finished = list(state["finished"])
+        pending = list(state["ready"]) + list(state["waiting"]) + list(state["running"])
+        blocks_done = {self._block_index(key) for key in finished} - {None}
+        if self._costs:
+            cost_done = sum(self._costs[self._block_index(key)] for key in finished if self._block_index(key))
+            cost_total = cost_done + sum(self._costs[self._block_index(key)] for key in pending
+                                         if self._block_index(key))
+            if cost_total:
+                return cost_done / cost_total, blocks_done
+        ntasks = len(finished) + len(pending)
+        return (len(finished) / ntasks if ntasks else 0), blocks_done
+
     def _update_bar(self):
         s = self._state
         if not s:
             self._draw_bar(0)
             return
-        ndone = len(s["finished"])
-        ntasks = sum(len(s[k]) for k in ["ready", "waiting", "running"]) + ndone
-        if ndone < ntasks:
-            self._draw_bar(ndone / ntasks if ntasks else 0)
+        frac, blocks_done = self._progress(s)
+        if frac < 1:
+            self._draw_bar(frac)
+        now = default_timer()
+        if self._info_interval and now - self._last_info >= self._info_interval:
+            self._last_info = now
+            self._push_info(frac, blocks_done, now - self._start_time)
+
+    def _push_info(self, frac, blocks_done, elapsed):
+        if self._feedback is None or self._feedback.isCanceled():
+            return
+        info = ["  progress {}%".format(int(100 * frac))]
+        if self._costs:
+            cost_done = sum(self._costs[block] for block in blocks_done)
+            info.append("{}/{} chunks".format(len(blocks_done), len(self._costs)))
+            info.append("{:.2f} chunks/s".format(len(blocks_done) / elapsed))
+            info.append("{:.1f} Mpx×layers/s".format(cost_done / elapsed / 1e6))
+        if frac > 0:
+            info.append("ETA {}".format(datetime.timedelta(seconds=int(elapsed * (1 - frac) / frac))))
+        memory, memory_desc = memory_usage()
+        if memory is not None:
+            info.append("{} {:.1f} GB".format(memory_desc, memory / 1024**3))
+        self._feedback.pushInfo(", ".join(info))
 
     def _draw_bar(self, frac):
         percent = int(100 * frac)
         if not self._feedback.isCanceled():
-            self._feedback.setProgress(percent)
\ No newline at end of file
+            self._feedback.setProgress(percent)